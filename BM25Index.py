@@ -0,0 +1,103 @@
+import heapq
+import math
+import re
+from collections import Counter
+from operator import itemgetter
+
+# In-memory BM25 inverted index over chunks of Zim pages. Pages can be added,
+# replaced and removed individually so the index can follow edits to the
+# notebook without being rebuilt.
+
+term_pattern = re.compile(r"\w+", re.UNICODE)
+
+def terms(text):
+    return term_pattern.findall(text.lower())
+
+def chunk_term_counts(chunks):
+    # {term: frequency} for each chunk, what the postings are made from.
+    return [Counter(terms(text)) for text in chunks]
+
+class BM25Index:
+    def __init__(self, k1=1.5, b=0.75):
+        self.k1 = k1
+        self.b = b
+        # relative_path -> (key, [chunk ids]), key is whatever the caller uses to spot changes
+        self.pages = {}
+        # chunk id -> (relative_path, text, length in terms)
+        self.chunks = {}
+        # term -> {chunk id: term frequency}
+        self.postings = {}
+        self.total_length = 0
+        self.next_id = 0
+
+    def __len__(self):
+        return len(self.chunks)
+
+    def page_key(self, relative_path):
+        page = self.pages.get(relative_path)
+        return page[0] if page else None
+
+    def add_page(self, relative_path, key, chunks, term_counts=None):
+        """
+        Index a page's chunks, replacing whatever was indexed for it before.
+        term_counts, the chunk_term_counts of the chunks, is worked out if not given.
+        """
+        self.remove_page(relative_path)
+        if term_counts is None:
+            term_counts = chunk_term_counts(chunks)
+        chunk_ids = []
+        for text, counts in zip(chunks, term_counts):
+            chunk_id = self.next_id
+            self.next_id += 1
+            length = sum(counts.values())
+            for term, frequency in counts.items():
+                self.postings.setdefault(term, {})[chunk_id] = frequency
+            self.chunks[chunk_id] = (relative_path, text, length)
+            self.total_length += length
+            chunk_ids.append(chunk_id)
+        self.pages[relative_path] = (key, chunk_ids)
+
+    def remove_page(self, relative_path):
+        page = self.pages.pop(relative_path, None)
+        if page is None:
+            return
+        for chunk_id in page[1]:
+            _, text, length = self.chunks.pop(chunk_id)
+            self.total_length -= length
+            for term in set(terms(text)):
+                postings = self.postings[term]
+                del postings[chunk_id]
+                if not postings:
+                    del self.postings[term]
+
+    def search(self, query, top_k=10, max_df_ratio=0.5):
+        """
+        The top_k chunks for query as a list of (score, chunk id), best first.
+
+        Terms found in more than max_df_ratio of all chunks ("the", "and", ...) are
+        skipped unless nothing else matches. Their idf is close to zero so they
+        barely move the ranking, but their posting lists are by far the longest
+        and would dominate the query time.
+        """
+        chunk_count = len(self.chunks)
+        if chunk_count == 0:
+            return []
+        query_postings = [self.postings[term] for term in set(terms(query)) if term in self.postings]
+        selective = [postings for postings in query_postings if len(postings) <= chunk_count * max_df_ratio]
+        if selective:
+            query_postings = selective
+        average_length = self.total_length / chunk_count
+        k1 = self.k1
+        scores = {}
+        for postings in query_postings:
+            idf = math.log(1 + (chunk_count - len(postings) + 0.5) / (len(postings) + 0.5))
+            # Precompute what doesn't depend on the chunk to keep the inner loop tight.
+            numerator = idf * (k1 + 1)
+            length_norm = k1 * (1 - self.b)
+            length_scale = k1 * self.b / average_length
+            chunks = self.chunks
+            for chunk_id, frequency in postings.items():
+                denominator = frequency + length_norm + length_scale * chunks[chunk_id][2]
+                scores[chunk_id] = scores.get(chunk_id, 0.0) + numerator * frequency / denominator
+        best = heapq.nlargest(top_k, scores.items(), key=itemgetter(1))
+        return [(score, chunk_id) for chunk_id, score in best]
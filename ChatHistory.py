@@ -0,0 +1,102 @@
+from TokenCounter import get_tokenizer
+
+# Keeps the history sent with each request within a token budget. The newest
+# turns are sent as they are; older turns are folded into a running summary
+# (written by the LLM in the background) that rides along in the system message.
+
+summary_prompt = ("Summarize the following conversation between a user and an assistant so that it can be continued"
+                  " without the original. Keep names, facts, decisions and open questions; leave out pleasantries.")
+
+class HistoryManager:
+    def __init__(self, config):
+        self.config = config
+        self.summary = ""
+        # How many messages after the system message have been folded into the summary
+        self.summarized_count = 0
+        self.token_counts = {}
+
+    def budget(self):
+        return self.config.get("history_tokens", 0)
+
+    def count(self, message):
+        # Finished messages don't change, so counts are remembered by content.
+        key = (message["role"], message["content"])
+        count = self.token_counts.get(key)
+        if count is None:
+            count = get_tokenizer(self.config).count(message["content"]) + 4
+            if len(self.token_counts) > 10000:
+                self.token_counts.clear()
+            self.token_counts[key] = count
+        return count
+
+    def reset(self, summary="", summarized_count=0):
+        self.summary = summary
+        self.summarized_count = summarized_count
+
+    def window_start(self, messages):
+        """
+        Index of the oldest message that still fits in the budget, counting back
+        from the newest. Everything from the newest user message on always goes,
+        however long it is, and the window starts on a user message so turns
+        aren't split.
+        """
+        budget = self.budget()
+        if not budget:
+            return 1
+        user_indexes = [index for index, message in enumerate(messages) if message["role"] == "user"]
+        last_user = user_indexes[-1] if user_indexes else len(messages)
+        used = 0
+        start = len(messages)
+        while start > 1:
+            tokens = self.count(messages[start - 1])
+            if start - 1 < last_user and used + tokens > budget:
+                break
+            used += tokens
+            start -= 1
+        while start < last_user and messages[start]["role"] != "user":
+            start += 1
+        return start
+
+    def request_messages(self, messages):
+        """
+        The messages to actually send: the system message, with the summary of
+        older turns added to it, and the newest turns that fit in the budget.
+        """
+        # The conversation may have been undone or replaced underneath the summary.
+        if self.summarized_count > len(messages) - 1:
+            self.reset()
+        start = max(self.window_start(messages), 1)
+        system_message = messages[0]
+        if self.summary and start > 1:
+            system_message = {"role": "system",
+                              "content": f"{system_message['content']}\n\nSummary of the conversation so far:\n{self.summary}"}
+        return [system_message] + messages[start:]
+
+    def pending_summary(self, messages):
+        """
+        Messages that have dropped out of the budget window but aren't in the summary yet.
+        Returns (messages to fold in, new summarized_count).
+        """
+        if not self.budget():
+            return [], self.summarized_count
+        # Leave room for the next question and its answer so the window doesn't
+        # need summarizing again straight away.
+        start = self.window_start(messages + [{"role": "user", "content": ""}, {"role": "assistant", "content": ""}])
+        end = min(start, len(messages)) - 1
+        if end <= self.summarized_count:
+            return [], self.summarized_count
+        return messages[1 + self.summarized_count:1 + end], end
+
+    def summary_request(self, new_messages):
+        transcript = "\n\n".join(f'{message["role"].capitalize()}: {message["content"]}' for message in new_messages)
+        content = summary_prompt
+        if self.summary:
+            content += f"\n\nSummary so far:\n{self.summary}"
+        content += f"\n\nConversation to add to the summary:\n{transcript}"
+        return [{"role": "user", "content": content}]
+
+    def to_json(self):
+        return {"text": self.summary, "messages": self.summarized_count}
+
+    def from_json(self, data):
+        self.reset(data.get("text", ""), data.get("messages", 0))
@@ -0,0 +1,199 @@
+import json
+import os
+import re
+import sys
+import time
+
+# Conversations are autosaved as an append-only journal, one JSON record per
+# line, so a crash loses at most the response that was being written:
+#   {"type": "journal", "version": 1}
+#   {"type": "turn", "size": 2, "messages": [...]}   a completed question and answer
+#   {"type": "roll_back"}                            undo of the latest turn still standing
+#   {"type": "summary", "summary": {...}}            the history summary, as in ChatHistory
+# Opening a journal only reads where each line starts, the turns themselves are
+# read when they're needed, newest first. The folder is the "journal_dir" config
+# setting, blank turns autosaving off.
+
+default_journal_dir = "conversations"
+journal_version = 1
+
+# Records are written with "type" (and "size") first so they can be told apart
+# without parsing the rest of the line.
+record_pattern = re.compile(rb'\{"type": "(\w+)"(?:, "size": (\d+))?')
+
+def group_turns(messages):
+    """
+    Split a message list into turns, each starting with a user message.
+    """
+    turns = []
+    for message in messages:
+        if message["role"] == "user" or not turns:
+            turns.append([])
+        turns[-1].append(message)
+    return turns
+
+def new_journal_path(journal_dir):
+    os.makedirs(journal_dir, exist_ok=True)
+    name = time.strftime("%Y-%m-%d %H-%M-%S")
+    path = os.path.join(journal_dir, name + ".jsonl")
+    number = 2
+    while os.path.exists(path):
+        path = os.path.join(journal_dir, f"{name} ({number}).jsonl")
+        number += 1
+    return path
+
+def is_journal(path):
+    with open(path, "rb") as file:
+        return record_pattern.match(file.readline()) is not None
+
+class ConversationJournal:
+    def __init__(self, path):
+        self.path = path
+        # (offset, message count) of each turn still standing, oldest first
+        self.turns = []
+        self.summary_offset = None
+        # Turns before this one haven't been read into the conversation yet
+        self.loaded_from = 0
+        self.scan()
+
+    @classmethod
+    def create(cls, path, turns=(), summary=None):
+        with open(path, "w", encoding="utf-8") as file:
+            file.write(json.dumps({"type": "journal", "version": journal_version}) + "\n")
+            for messages in turns:
+                file.write(turn_record(messages))
+            if summary and summary.get("text"):
+                file.write(json.dumps({"type": "summary", "summary": summary}) + "\n")
+        return cls(path)
+
+    def scan(self):
+        with open(self.path, "rb") as file:
+            data = file.read()
+        end = data.rfind(b"\n") + 1
+        if end < len(data):
+            # A record cut off part way through writing, most likely by a crash.
+            print(f"Dropping an incomplete record at the end of {self.path}", file=sys.stderr)
+            with open(self.path, "r+b") as file:
+                file.truncate(end)
+        offset = 0
+        while offset < end:
+            line_end = data.index(b"\n", offset) + 1
+            match = record_pattern.match(data, offset, line_end)
+            if match is None:
+                print(f"Skipping an unreadable record in {self.path}", file=sys.stderr)
+            elif match.group(1) == b"turn":
+                self.turns.append((offset, int(match.group(2))))
+            elif match.group(1) == b"roll_back":
+                if self.turns:
+                    self.turns.pop()
+            elif match.group(1) == b"summary":
+                self.summary_offset = offset
+            offset = line_end
+
+    def _append(self, line):
+        with open(self.path, "ab") as file:
+            offset = file.tell()
+            file.write(line.encode("utf-8"))
+            file.flush()
+            os.fsync(file.fileno())
+        return offset
+
+    def _read(self, offset):
+        with open(self.path, "rb") as file:
+            file.seek(offset)
+            return json.loads(file.readline())
+
+    def append_turn(self, messages):
+        offset = self._append(turn_record(messages))
+        self.turns.append((offset, len(messages)))
+
+    def roll_back(self):
+        if self.turns:
+            self._append(json.dumps({"type": "roll_back"}) + "\n")
+            self.turns.pop()
+            self.loaded_from = min(self.loaded_from, len(self.turns))
+
+    def write_summary(self, summary):
+        """
+        summary is HistoryManager.to_json(), counting messages from the start of the whole conversation.
+        """
+        self.summary_offset = self._append(json.dumps({"type": "summary", "summary": summary}) + "\n")
+
+    def read_summary(self):
+        if self.summary_offset is None:
+            return {}
+        return self._read(self.summary_offset)["summary"]
+
+    def read_turns(self, start, end):
+        messages = []
+        for offset, _ in self.turns[start:end]:
+            messages.extend(self._read(offset)["messages"])
+        return messages
+
+    @property
+    def unloaded_messages(self):
+        return sum(size for _, size in self.turns[:self.loaded_from])
+
+    def open(self, initial_turns=20, load_all=False):
+        """
+        Read the newest turns to start the conversation with. Older turns are only
+        left on disk if they're already in the summary, so nothing the LLM still
+        needs to see is missing. Returns the messages and the summary, which
+        counts from the first message returned.
+        """
+        summary = self.read_summary()
+        self.loaded_from = 0
+        if not load_all and summary.get("text"):
+            summarized = summary.get("messages", 0)
+            skipped = 0
+            while self.loaded_from < len(self.turns) - initial_turns:
+                size = self.turns[self.loaded_from][1]
+                if skipped + size > summarized:
+                    break
+                skipped += size
+                self.loaded_from += 1
+        if summary:
+            summary = dict(summary, messages=max(0, summary.get("messages", 0) - self.unloaded_messages))
+        return self.read_turns(self.loaded_from, len(self.turns)), summary
+
+    def load_earlier(self, turns):
+        """
+        Read up to turns more of the older turns, returns their messages.
+        """
+        start = max(0, self.loaded_from - turns)
+        messages = self.read_turns(start, self.loaded_from)
+        self.loaded_from = start
+        return messages
+
+    def save_as(self, path, summary=None):
+        """
+        Write the turns still standing to a new journal without the undone ones,
+        returns the new journal. summary is as for write_summary.
+        """
+        turns = [self._read(offset)["messages"] for offset, _ in self.turns]
+        journal = ConversationJournal.create(path, turns, summary)
+        journal.loaded_from = self.loaded_from
+        return journal
+
+def turn_record(messages):
+    return json.dumps({"type": "turn", "size": len(messages), "messages": messages}) + "\n"
+
+def read_conversation(conv_path):
+    """
+    Read a .conv file saved by earlier versions (a list of messages, or a dict
+    with them and the summary). Returns the messages and the summary.
+    """
+    with open(conv_path, "r") as file:
+        messages = json.load(file)
+    summary = {}
+    if isinstance(messages, dict):
+        summary = messages.get("summary") or {}
+        messages = messages["messages"]
+    return messages, summary
+
+def import_conversation(conv_path, journal_path):
+    """
+    Turn a .conv file saved by earlier versions into a journal.
+    """
+    messages, summary = read_conversation(conv_path)
+    return ConversationJournal.create(journal_path, group_turns(messages), summary)
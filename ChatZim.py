@@ -1,21 +1,29 @@
 import sys
 import os
-from PyQt6.QtWidgets import QApplication, QMainWindow, QTextEdit, QLineEdit, QVBoxLayout, QWidget, QToolBar, QPushButton, QLabel, QScrollArea, QFileDialog, QDialog, QMenu, QToolButton
-from PyQt6.QtGui import QAction, QTextCursor
+from PyQt6.QtWidgets import QApplication, QMainWindow, QVBoxLayout, QWidget, QToolBar, QPushButton, QLabel, QScrollArea, QFileDialog, QDialog, QMenu, QToolButton, QTabWidget
+from PyQt6.QtGui import QAction
 from PyQt6.QtCore import Qt
 import json
+import sqlite3
 
 from ChatZimFilesDialog import ChatZimFilesDialog
 from ChatZimConfigDialog import ChatZimConfigDialog
-from OpenAIInterface import queryLLMStreamed
+from ChatZimSession import ChatSession
+from OpenAIInterface import warmUpLLM
+from ZimContext import get_system_message, context_budget, compact_page_order, update_page_order, page_cache, SystemContext
+from ZimPageIndex import ZimPageIndex
+from ZimMarkup import CompactingTokenizer
+from ZimDedup import fingerprint_cache
+from TokenCounter import get_tokenizer
+from ZimRetrieval import NotebookRetriever, retrieval_system_message
+from ZimMapReduce import map_reduce_system_message
+from EmbeddingStore import SemanticRetriever, get_embedder
+from ChatZimWatcher import NotebookWatcher
+from ChatJournal import default_journal_dir
 
 import sys
 import traceback
 
-role_info = {"user":{"color":"#ff0000", "name":"User"},
-             "assistant":{"color":"#0000ff", "name":"Assistant"}
-             }
-
 config_filename = "ChatZim.conf"
 
 """
@@ -41,65 +49,6 @@ def excepthook(exc_type, exc_value, exc_tb):
 
 sys.excepthook = excepthook
 
-def get_system_message(context_settings, config):
-    file_path_list = []
-    for page in context_settings["pages"].items():
-        if page[1]["selected"]:
-            file_path = os.path.join(context_settings["root_path"], page[1]["relative_path"])
-            file_path_list.append(file_path)
-
-    file_path_list.sort()
-    context_list = []
-    for file_path in file_path_list:
-        try:
-            with open(file_path, 'r', encoding="utf-8") as file:
-                    lines = file.readlines()
-                    lines = lines[3:]
-                    context_list.append(''.join(lines))
-        except:
-            print(f"Unable to read file {file_path}")
-
-    message = {
-        "role": "system",
-        "content": config["system_prompt"] + "\n\n" + "\n\n".join(context_list)
-        }
-    return message
-
-#Very quick and dirty.
-def word_count(context):
-    return len(context.split())
-
-# Function to remove the last character from a QTextEdit window
-# TODO: improve how the chat window is managed so that hacky things like this
-# aren't needed.
-def remove_last_character(text_edit):
-    cursor = text_edit.textCursor()
-    cursor.movePosition(QTextCursor.MoveOperation.End)
-    cursor.movePosition(QTextCursor.MoveOperation.PreviousCharacter, QTextCursor.MoveMode.KeepAnchor)
-    cursor.removeSelectedText()
-    text_edit.setTextCursor(cursor)
-
-from PyQt6.QtCore import QThread, pyqtSignal, QObject
-class WorkerStreamed(QObject):
-    new_token = pyqtSignal(dict)
-    finished = pyqtSignal()
-    error = pyqtSignal(str)
-
-    def __init__(self, messages, config):
-        super().__init__()
-        self.messages = messages
-        self.config = config
-
-    def run(self):
-        try:
-            for llm_response in queryLLMStreamed(self.messages, self.config):
-                if llm_response is None:
-                    break
-                self.new_token.emit(llm_response)
-            self.finished.emit()
-        except Exception as e:
-            self.error.emit(str(e))
-
 class ChatWindow(QMainWindow):
     def __init__(self):
         super().__init__()
@@ -129,7 +78,18 @@ class ChatWindow(QMainWindow):
         except:
             self.context_settings = {"pages":{}, "root_path":None, "name":None}
 
-        self.messages = [get_system_message(self.context_settings, self.config)]
+        # The system message every tab's conversation starts with, see ZimContext.SystemContext
+        self.system_context = SystemContext(get_system_message(self.context_settings, self.config), get_tokenizer(self.config))
+        self.retriever = None
+        self.retriever_mode = None
+        self.warm_up_cancel = None
+        self.warmed_content = None
+        # Closed tabs with a summary or a stopped worker still running in the background
+        self.closed_sessions = []
+        self.session_count = 0
+        self.pages_summary = ""
+        self.watcher = NotebookWatcher(self)
+        self.watcher.pages_changed.connect(self.on_pages_changed)
 
         # Main layout
         layout = QVBoxLayout()
@@ -151,20 +111,31 @@ class ChatWindow(QMainWindow):
         export_context_action.triggered.connect(self.export_context)
         toolbar.addAction(export_context_action)
 
+        compact_context_action = QAction("Compact Page Order", self)
+        compact_context_action.triggered.connect(self.compact_context)
+        toolbar.addAction(compact_context_action)
+
         conversation_menu = QMenu("Conversation", self)
 
         save_conversation_action = QAction("Save", self)
-        save_conversation_action.triggered.connect(self.save_conversation)
+        save_conversation_action.triggered.connect(lambda: self.current_session().save_conversation())
         conversation_menu.addAction(save_conversation_action)
         
         load_conversation_action = QAction("Load", self)
-        load_conversation_action.triggered.connect(self.load_conversation)
+        load_conversation_action.triggered.connect(lambda: self.current_session().load_conversation())
         conversation_menu.addAction(load_conversation_action)
 
         new_conversation_action = QAction("New", self)
-        new_conversation_action.triggered.connect(self.new_conversation)
+        new_conversation_action.triggered.connect(lambda: self.current_session().new_conversation())
         conversation_menu.addAction(new_conversation_action)
 
+        new_tab_action = QAction("New Tab", self)
+        new_tab_action.setShortcut("Ctrl+T")
+        new_tab_action.triggered.connect(self.new_session)
+        conversation_menu.addAction(new_tab_action)
+        # Shortcuts of actions only in a menu need the window to know about them
+        self.addAction(new_tab_action)
+
         # Create a tool button and set the menu
         conversation_tool_button = QToolButton()
         conversation_tool_button.setText("Conversation")
@@ -173,9 +144,23 @@ class ChatWindow(QMainWindow):
         conversation_tool_button.setToolButtonStyle(Qt.ToolButtonStyle.ToolButtonTextOnly)
         toolbar.addWidget(conversation_tool_button) 
 
-        back_conversation_action = QAction("Undo Last Response", self)
-        back_conversation_action.triggered.connect(self.roll_back)
-        toolbar.addAction(back_conversation_action)
+        self.stop_action = QAction("Stop", self)
+        self.stop_action.setShortcut("Esc")
+        self.stop_action.setEnabled(False)
+        self.stop_action.triggered.connect(self.stop_response)
+        toolbar.addAction(self.stop_action)
+
+        # Only shown when there's a response cache, unchecking it asks the server again.
+        self.use_cache_action = QAction("Use Cached Answers", self)
+        self.use_cache_action.setCheckable(True)
+        self.use_cache_action.setChecked(True)
+        self.use_cache_action.setVisible(bool(self.config.get("response_cache")))
+        toolbar.addAction(self.use_cache_action)
+
+        # Disabled while the tab is answering, the turn being undone isn't finished yet.
+        self.roll_back_action = QAction("Undo Last Response", self)
+        self.roll_back_action.triggered.connect(self.roll_back)
+        toolbar.addAction(self.roll_back_action)
 
         configure_action = QAction("Configure", self)
         configure_action.triggered.connect(self.open_config_dialog)
@@ -184,83 +169,167 @@ class ChatWindow(QMainWindow):
         self.header_label = QLabel()
         layout.addWidget(self.header_label)
 
-        # Chat display
-        self.chat_display = QTextEdit()
-        self.chat_display.setReadOnly(True)
-        layout.addWidget(self.chat_display)
+        # Timings of the latest request
+        self.statusBar()
 
-        # Text input
-        self.text_input = QLineEdit()
-        self.text_input.returnPressed.connect(self.handle_return_pressed)
-        layout.addWidget(self.text_input)
+        # One tab per conversation
+        self.tabs = QTabWidget()
+        self.tabs.setTabsClosable(True)
+        self.tabs.setDocumentMode(True)
+        self.tabs.tabCloseRequested.connect(self.close_session)
+        self.tabs.currentChanged.connect(self.on_tab_changed)
+        layout.addWidget(self.tabs)
 
         # Central widget
         container = QWidget()
         container.setLayout(layout)
         self.setCentralWidget(container)
 
+        self.new_session()
         self.update_documents()
 
-    def add_message(self, message):
-        self.messages.append(message)
-        self.add_message_to_chat_display(message)
-
-    def add_message_to_chat_display(self, message):
-        current_role = role_info[message["role"]]
-        content = message["content"].replace("\n", "<br>")
-        formatted_message = f'<b><span style="color:{current_role["color"]};">{current_role["name"]}:</span></b> {content}<br>'
-        self.chat_display.append(formatted_message)
-
-    def append_token(self, token):
-        self.messages[-1]["content"] = self.messages[-1]["content"] + token
-        cursor = self.chat_display.textCursor()
-        cursor.movePosition(QTextCursor.MoveOperation.End)
-        cursor.insertText(token)
-        self.chat_display.setTextCursor(cursor)
-
-    def handle_return_pressed(self):
-        user_text = self.text_input.text()
-        self.text_input.clear()
-        
-        user_message = {"role": "user", "content": user_text}
-        self.add_message(user_message)
-        assistant_message = {"role": "assistant", "content": ""}
-        self.add_message(assistant_message)
-        remove_last_character(self.chat_display) # gets rid of the line return that add_message adds
-
-        self.text_input.setDisabled(True)  # Disable the input field
-        self.text_input.setText("(Processing prompt...)")
-
-        self.thread = QThread()
-        self.worker = WorkerStreamed(self.messages, self.config)
-        self.worker.moveToThread(self.thread)
-
-        self.worker.new_token.connect(self.on_llm_response)
-        self.worker.finished.connect(self.on_llm_response_complete)
-        self.worker.error.connect(self.on_llm_error)
-        self.thread.started.connect(self.worker.run)
-        self.thread.start()
-
-    def on_llm_response(self, response):
-        self.append_token(response["choices"][0]["delta"]["content"])
-        if self.text_input.text() != "(Responding...)":
-            self.text_input.setText("(Responding...)")
-
-    def on_llm_response_complete(self):
-        self.chat_display.append("") # add a line break after LLM response
-        self.text_input.setDisabled(False)  # Re-enable the input field
-        self.text_input.setText("")
-        self.thread.quit()
-        self.thread.wait()
-        self.thread = None
-
-    def on_llm_error(self, error_message):
-        self.chat_display.append(f"\n{error_message}")
-        self.text_input.setDisabled(False)  # Re-enable the input field
-        self.text_input.setText("")
-        self.thread.quit()
-        self.thread.wait()
-        self.thread = None
+    def current_session(self):
+        return self.tabs.currentWidget()
+
+    def sessions(self):
+        return [self.tabs.widget(index) for index in range(self.tabs.count())]
+
+    def new_session(self):
+        self.session_count += 1
+        session = ChatSession(self, f"Chat {self.session_count}")
+        self.tabs.setCurrentIndex(self.tabs.addTab(session, session.title))
+        session.text_input.setFocus()
+        return session
+
+    def close_session(self, index):
+        session = self.tabs.widget(index)
+        session.stop_response()
+        self.tabs.removeTab(index)
+        if session.idle():
+            session.deleteLater()
+        else:
+            # Its threads have to outlive it, it's kept until they finish.
+            self.closed_sessions.append(session)
+            for thread in session.running_threads():
+                thread.finished.connect(self.reap_closed_sessions)
+        if self.tabs.count() == 0:
+            self.new_session()
+
+    def reap_closed_sessions(self):
+        # finished is sent just before the thread is done, wait for it to be.
+        thread = self.sender()
+        if thread is not None:
+            thread.wait()
+        for session in [closed for closed in self.closed_sessions if closed.idle()]:
+            self.closed_sessions.remove(session)
+            session.deleteLater()
+
+    def on_tab_changed(self, index):
+        if index >= 0:
+            self.show_session_state(self.current_session())
+
+    def show_session_state(self, session, header=True):
+        """
+        Bring the tab's title up to date, and the header, status bar and Stop button
+        if it's the current tab. header=False leaves the header as it is, it has to
+        count the conversation's tokens.
+        """
+        index = self.tabs.indexOf(session)
+        if index < 0:
+            return
+        if session.busy():
+            self.tabs.setTabText(index, session.title + (" (answering)" if session.streaming else " (waiting)"))
+        else:
+            self.tabs.setTabText(index, session.title)
+        if session is not self.current_session():
+            return
+        self.stop_action.setEnabled(session.busy())
+        self.roll_back_action.setEnabled(not session.busy())
+        self.statusBar().showMessage(session.status)
+        if header:
+            self.update_header()
+
+    def show_session_status(self, session):
+        # Just the status bar, for the timings of a response as it streams in.
+        if session is self.current_session():
+            self.statusBar().showMessage(session.status)
+
+    def stop_response(self):
+        self.current_session().stop_response()
+
+    def roll_back(self):
+        self.current_session().roll_back()
+
+    def history_token_count(self):
+        return self.current_session().history_token_count()
+
+    def retrieval_enabled(self):
+        return self.config.get("context_mode") in ("bm25", "semantic") and bool(self.context_settings.get("root_path"))
+
+    def get_retriever(self):
+        root_path = self.context_settings["root_path"]
+        mode = self.config["context_mode"]
+        if self.retriever is None or self.retriever.root_path != root_path or self.retriever_mode != mode:
+            if mode == "semantic":
+                self.retriever = SemanticRetriever(root_path, get_embedder(self.config))
+            else:
+                self.retriever = NotebookRetriever(root_path)
+            self.retriever_mode = mode
+        return self.retriever
+
+    def retrieval_preparer(self, session):
+        """
+        In retrieval mode, a function for WorkerStreamed that searches the notebook
+        and swaps in a system message made of the best matching chunks.
+        """
+        if not self.retrieval_enabled():
+            return None
+        try:
+            retriever = self.get_retriever()
+        except RuntimeError as e:
+            session.transcript.append_note(f"Retrieval unavailable: {e}")
+            return None
+        relative_paths = [page["relative_path"] for page in self.context_settings["pages"].values()]
+        config = self.config
+        tokenizer = get_tokenizer(config)
+        def prepare(messages, metrics=None, canceller=None):
+            return [retrieval_system_message(retriever, relative_paths, messages, config, tokenizer)] + messages[1:]
+        return prepare
+
+    def map_reduce_enabled(self):
+        return self.config.get("context_mode") == "mapreduce" and bool(self.context_settings.get("root_path"))
+
+    def map_reduce_preparer(self):
+        """
+        In map-reduce mode, a function for WorkerStreamed that asks the selected
+        pages about the question in parts and swaps in a system message of the
+        notes that came back.
+        """
+        if not self.map_reduce_enabled():
+            return None
+        # Copied, the selection may change while the worker is busy.
+        context_settings = json.loads(json.dumps(self.context_settings))
+        config = self.config
+        tokenizer = get_tokenizer(config)
+        def prepare(messages, metrics=None, canceller=None):
+            return [map_reduce_system_message(context_settings, messages, config, tokenizer, metrics, canceller)] + messages[1:]
+        return prepare
+
+    def request_preparer(self, session):
+        """
+        The function the tab's WorkerStreamed uses to turn the whole conversation into what's
+        sent: retrieval or map-reduce (if enabled) first, then trimming to the history budget.
+        """
+        retrieval = self.retrieval_preparer(session) or self.map_reduce_preparer()
+        history = session.history
+        prefix_tracker = session.prefix_tracker
+        def prepare(messages, metrics=None, canceller=None):
+            if retrieval:
+                messages = retrieval(messages, metrics, canceller)
+            messages = history.request_messages(messages)
+            prefix_tracker.update(messages)
+            return messages
+        return prepare
 
     def open_docsets_dialog(self):
         self.docsets_dialog = ChatZimFilesDialog(self)
@@ -268,59 +337,150 @@ class ChatWindow(QMainWindow):
         self.docsets_dialog.exec()
 
     def update_documents(self):
+        # The selection may have changed, new pages go after the ones already in the stable order.
+        update_page_order(self.context_settings)
         enabled = 0
         total = 0
         for pages in self.context_settings["pages"].items():
             if pages[1]["selected"]:
                 enabled = enabled + 1
             total = total + 1
-        self.messages[0] = get_system_message(self.context_settings, self.config)
-        words = word_count(self.messages[0]["content"])
-        self.header_label.setText(f'{self.context_settings["name"]}: {enabled}/{total} pages selected, {words} words in context')
+        # Made once and shared, each tab only gets a reference to it.
+        self.system_context = SystemContext(self.current_system_message(), get_tokenizer(self.config))
+        for session in self.sessions():
+            session.set_system_message(self.system_context.message)
+        if self.retrieval_enabled():
+            self.pages_summary = f'{self.context_settings["name"]}: retrieving from all {total} pages'
+        elif self.map_reduce_enabled():
+            self.pages_summary = f'{self.context_settings["name"]}: {enabled}/{total} pages selected, asked in parts if they don\'t fit'
+        else:
+            self.pages_summary = f'{self.context_settings["name"]}: {enabled}/{total} pages selected'
+        self.update_header()
+        self.watch_notebook()
+        self.warm_up()
+
+    def watch_notebook(self):
+        if not self.config.get("watch_notebook", True):
+            self.watcher.stop()
+            return
+        selected = [page["relative_path"] for page in self.context_settings["pages"].values() if page["selected"]]
+        self.watcher.watch(self.context_settings.get("root_path"), selected)
+
+    def on_pages_changed(self, relative_paths):
+        """
+        Pages were edited, added or removed in Zim. Only those pages are looked
+        at again: the index, the cached contents and the page set are updated for
+        them and the context is rebuilt, which rereads nothing else.
+        """
+        root_path = self.context_settings.get("root_path")
+        if not root_path:
+            return
+        try:
+            tokenizer = get_tokenizer(self.config)
+            markup = self.config.get("markup", "raw")
+            # The compacted counts too, the pages dialog shows what compaction saves from them.
+            compact_tokenizer = CompactingTokenizer(tokenizer, markup) if markup != "raw" else None
+            with ZimPageIndex(root_path) as index:
+                changed, removed = index.refresh_paths(relative_paths, tokenizer, compact_tokenizer)
+                changed_pages = [index.page(relative_path) for relative_path in changed]
+        except sqlite3.Error as e:
+            print(f"Unable to update the page index: {e}")
+            return
+        if not changed and not removed:
+            return
+        for relative_path in changed + removed:
+            file_path = os.path.join(root_path, relative_path)
+            page_cache.discard(file_path)
+            fingerprint_cache.discard(file_path)
+
+        # Pages are keyed by creation date, so a page that was moved or renamed
+        # comes back under the same key and stays selected.
+        pages = self.context_settings["pages"]
+        keys = {page["relative_path"]: key for key, page in pages.items()}
+        gone = {}
+        for relative_path in removed:
+            key = keys.get(relative_path)
+            if key is not None:
+                gone[key] = pages.pop(key)
+        for page in changed_pages:
+            key = page["creation_date"]
+            if key is None or page["relative_path"] in keys and keys[page["relative_path"]] == key:
+                continue
+            if key in pages:
+                print(page["relative_path"] + " has an identical creation date to " + pages[key]["relative_path"])
+                continue
+            pages[key] = {"relative_path": page["relative_path"], "selected": gone.get(key, {}).get("selected", False)}
+        self.update_documents()
+
+    def warm_up(self):
+        """
+        If enabled, get the server started on a new system message in the background
+        so it's already in its prompt cache by the time the question is typed. Any
+        earlier warm-up still going is abandoned. In retrieval and map-reduce modes
+        the system message isn't known until the question is, so there's nothing to warm up.
+        """
+        content = self.system_context.message["content"]
+        if not self.config.get("warm_up") or self.retrieval_enabled() or self.map_reduce_enabled() or content == self.warmed_content:
+            return
+        # It would only hold up the tabs' requests
+        if any(session.busy() for session in self.sessions()):
+            return
+        self.cancel_warm_up()
+        self.warmed_content = content
+        # Laid out like the next real request in the current tab will be, so its prefix matches.
+        session = self.current_session()
+        messages = session.history.request_messages(session.messages) + [{"role": "user", "content": ""}]
+        self.warm_up_cancel = warmUpLLM(messages, self.config)
+
+    def cancel_warm_up(self):
+        if self.warm_up_cancel is not None:
+            self.warm_up_cancel.cancel()
+            self.warm_up_cancel = None
+
+    def current_system_message(self):
+        if self.retrieval_enabled() or self.map_reduce_enabled():
+            # The system message is assembled per question by the worker
+            return {"role": "system", "content": self.config["system_prompt"]}
+        return get_system_message(self.context_settings, self.config)
+
+    def update_header(self):
+        session = self.current_session()
+        if session is None:
+            return
+        tokens = self.system_context.tokens
+        header = f'{self.pages_summary}, {self.system_context.words} words / {tokens} tokens in context'
+        budget = context_budget(self.config, session.history_token_count())
+        if budget is not None and tokens > budget:
+            header += f' - over the {self.config["context_size"]} token context by {tokens - budget} tokens'
+            self.header_label.setStyleSheet("color: red;")
+        else:
+            self.header_label.setStyleSheet("")
+        if session.prefix_tracker.report:
+            unchanged_bytes, total_bytes, unchanged_tokens, total_tokens = session.prefix_tracker.report
+            header += f'\nLast request: {unchanged_tokens}/{total_tokens} tokens ({unchanged_bytes}/{total_bytes} bytes) unchanged from the one before'
+        self.header_label.setText(header)
+
+    def compact_context(self):
+        # Only does anything with the stable page order, see ZimContext.selected_file_paths
+        compact_page_order(self.context_settings)
+        self.update_documents()
 
     def export_context(self):
-        system_message = get_system_message(self.context_settings, self.config)
         fileName, _ = QFileDialog.getSaveFileName(self, "Export Context", "", "TXT Files (*.txt);;All Files (*)")
         if fileName:
             with open(fileName, 'w', encoding="utf-8") as file:
-                file.write(self.messages[0]["content"])
+                file.write(self.system_context.message["content"])
 
     def open_config_dialog(self):
         self.config_dialog = ChatZimConfigDialog(self)
         if self.config_dialog.exec() == QDialog.DialogCode.Accepted:
+            self.use_cache_action.setVisible(bool(self.config.get("response_cache")))
             self.update_documents()
             with open(config_filename, "w") as writefile:
                 json.dump(self.config, writefile, indent=4, sort_keys=True)
 
-    def save_conversation(self):
-        fileName, _ = QFileDialog.getSaveFileName(self, "Save Conversation", "", "CONV Files (*.conv);;All Files (*)")
-        if fileName:
-            with open(fileName, 'w') as file:
-                #omit the system message at the beginning.
-                json.dump(self.messages[1:], file, indent=4, sort_keys=True)
-
-    def load_conversation(self):
-        fileName, _ = QFileDialog.getOpenFileName(self, "Load Conversation", "", "CONV Files (*.conv);;All Files (*)")
-        if fileName:
-            with open(fileName, 'r') as file:
-                self.chat_display.clear()
-                messages = json.load(file)
-                self.messages = [get_system_message(self.context_settings, self.config)]
-                for message in messages:
-                    self.add_message(message)
-
-    def new_conversation(self):
-        self.chat_display.clear()
-        self.messages = [get_system_message(self.context_settings, self.config)]
-
-    def roll_back(self):
-        if len(self.messages) >= 3:
-            self.messages.pop() #delete last response
-            user_message = self.messages.pop()
-            self.text_input.setText(user_message["content"])
-            self.chat_display.clear()
-            for message in self.messages[1:]:
-                self.add_message_to_chat_display(message)
+    def journal_dir(self):
+        return self.config.get("journal_dir", default_journal_dir)
 
 if __name__ == "__main__":
     app = QApplication(sys.argv)
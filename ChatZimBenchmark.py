@@ -0,0 +1,326 @@
+import argparse
+import io
+import json
+import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from ZimPageIndex import ZimPageIndex
+from ZimPageScanner import scan_notebook, list_page_files
+from ZimRetrieval import NotebookRetriever
+from ZimContext import get_system_message, update_page_order, PageContentCache
+from TokenCounter import EstimateTokenizer
+from OpenAIInterface import get_client, queryLLMStreamed
+from SSEParser import SSEParser, StreamDelta, StreamError, chat_event, orjson, stdlib_json_loads
+from RequestMetrics import RequestMetrics
+from MockOpenAIServer import MockOpenAIServer
+from ZimNotebookGenerator import make_synthetic_notebook, words
+from ZimMapReduce import map_reduce_system_message
+
+# Benchmarks for ChatZim's hot paths. Run with "python ChatZimBenchmark.py"
+# (see --help for the options).
+
+# The original serial scan from ChatZimFilesDialog, kept as a baseline.
+def legacy_get_creation_date_in_seconds(file_path):
+    with open(file_path, 'r', encoding="utf-8") as file:
+        lines = file.readlines()
+        if len(lines) >= 3:
+            creation_date_line = lines[2].strip()
+            if creation_date_line.startswith("Creation-Date:"):
+                creation_date_str = creation_date_line.split(":", 1)[1].strip()
+                return str(int(time.mktime(time.strptime(creation_date_str, "%Y-%m-%dT%H:%M:%S%z"))))
+    return None
+
+def legacy_count_words_in_file(file_path):
+    with open(file_path, 'r', encoding="utf-8") as file:
+        lines = file.readlines()
+        lines = lines[3:]
+        return len(''.join(lines).split())
+
+def legacy_scan(root_path):
+    pages = []
+    for root, dirs, files in os.walk(root_path):
+        for file in files:
+            if file.endswith(".txt"):
+                file_path = os.path.join(root, file)
+                creation_date = legacy_get_creation_date_in_seconds(file_path)
+                if creation_date is not None:
+                    pages.append((os.path.relpath(file_path, root_path), creation_date, legacy_count_words_in_file(file_path)))
+    return pages
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return time.perf_counter() - start, result
+
+def bench_scan(root_path):
+    print("Notebook scan")
+    elapsed, legacy_pages = timed(legacy_scan, root_path)
+    print(f"  legacy serial readlines scan: {elapsed:8.3f}s ({len(legacy_pages)} pages)")
+
+    index_path = os.path.join(root_path, "bench_index.sqlite")
+    for label, max_workers in (("serial header-only scan:     ", 1), ("parallel header-only scan:   ", None)):
+        if os.path.exists(index_path):
+            os.remove(index_path)
+        with ZimPageIndex(root_path, index_path) as index:
+            elapsed, complete = timed(scan_notebook, index, None, None, max_workers)
+            pages = index.pages()
+            print(f"  {label} {elapsed:8.3f}s ({len(pages)} pages)")
+    with ZimPageIndex(root_path, index_path) as index:
+        elapsed, pages = timed(index.refresh)
+        print(f"  rescan with warm index:       {elapsed:8.3f}s")
+    os.remove(index_path)
+
+    legacy_pages = {page[0]: (page[1], page[2]) for page in legacy_pages}
+    mismatches = [page["relative_path"] for page in pages
+                  if legacy_pages.get(page["relative_path"]) != (page["creation_date"], page["word_count"])]
+    if mismatches:
+        print(f"  WARNING: {len(mismatches)} pages differ from the legacy scan")
+
+def bench_retrieval(root_path):
+    print("BM25 retrieval")
+    relative_paths = [page_file[0] for page_file in list_page_files(root_path)]
+    retriever = NotebookRetriever(root_path, index_path=os.path.join(root_path, "bench_bm25.sqlite"))
+    elapsed, _ = timed(retriever.refresh, relative_paths)
+    print(f"  build index:                  {elapsed:8.3f}s ({len(retriever.index)} chunks)")
+    tokenizer = EstimateTokenizer()
+    queries = ["where is the dragon1234 castle", "what did the wizard77 say about the quest treasure", "rogue4000"]
+    start = time.perf_counter()
+    for query in queries * 10:
+        retriever.retrieve(query, tokenizer, 2048)
+    print(f"  query:                        {(time.perf_counter() - start) / 30 * 1000:8.3f}ms")
+    with open(os.path.join(root_path, relative_paths[0]), "a", encoding="utf-8") as file:
+        file.write("\nedited\n")
+    elapsed, _ = timed(retriever.refresh, relative_paths)
+    print(f"  refresh after one edit:       {elapsed:8.3f}s")
+    retriever.close()
+    elapsed, reloaded = timed(NotebookRetriever, root_path, 200, retriever.index_path)
+    print(f"  load saved index:             {elapsed:8.3f}s ({len(reloaded.index)} chunks)")
+    reloaded.close()
+    os.remove(retriever.index_path)
+
+def bench_http(requests_count=500):
+    print("HTTP request overhead")
+    # Answers every chat request immediately so only the client's overhead is measured.
+    server = MockOpenAIServer(reply_tokens=1).start()
+    url = server.url
+    messages = [{"role": "user", "content": "hello"}]
+    data = json.dumps({"messages": messages, "max_completion_tokens": 16, "stream": False})
+    try:
+        start = time.perf_counter()
+        for _ in range(requests_count):
+            requests.post(url, headers={"Content-Type": "application/json"}, data=data)
+        elapsed = time.perf_counter() - start
+        print(f"  new connection per request:   {elapsed / requests_count * 1000:8.3f}ms per request")
+        client = get_client({"api_url": url, "metrics_log": ""})
+        start = time.perf_counter()
+        for _ in range(requests_count):
+            client.query(messages)
+        elapsed = time.perf_counter() - start
+        print(f"  pooled keep-alive client:     {elapsed / requests_count * 1000:8.3f}ms per request")
+    finally:
+        server.stop()
+
+def bench_context(root_path, page_count=2000):
+    print(f"Context assembly, {page_count} selected pages")
+    relative_paths = [page_file[0] for page_file in list_page_files(root_path)][:page_count]
+    context_settings = {"root_path": root_path, "name": "bench",
+                        "pages": {str(key): {"relative_path": relative_path, "selected": True}
+                                  for key, relative_path in enumerate(relative_paths)}}
+    config = {"system_prompt": "You are a helpful assistant."}
+    cache = PageContentCache()
+    elapsed, message = timed(get_system_message, context_settings, config, cache)
+    print(f"  get_system_message, cold:     {elapsed * 1000:8.1f}ms ({len(message['content']) // 1024} KB)")
+    elapsed, _ = timed(get_system_message, context_settings, config, cache)
+    print(f"  get_system_message, cached:   {elapsed * 1000:8.1f}ms")
+    config["context_order"] = "stable"
+    elapsed, _ = timed(get_system_message, context_settings, config, cache)
+    print(f"  stable order, cached:         {elapsed * 1000:8.1f}ms")
+    config["markup"] = "markdown"
+    elapsed, message = timed(get_system_message, context_settings, config, cache)
+    print(f"  markdown compaction, cold:    {elapsed * 1000:8.1f}ms ({len(message['content']) // 1024} KB)")
+    elapsed, _ = timed(get_system_message, context_settings, config, cache)
+    print(f"  markdown compaction, cached:  {elapsed * 1000:8.1f}ms")
+    # Fingerprinting and comparing every paragraph the first time, after that only
+    # the pages from the first one that changed are compared.
+    config["dedup"] = "reference"
+    last_page = context_settings["pages"][str(len(relative_paths) - 1)]
+    last_page["selected"] = False
+    update_page_order(context_settings)
+    elapsed, _ = timed(get_system_message, context_settings, config, cache)
+    print(f"  repeat removal, cold:         {elapsed * 1000:8.1f}ms")
+    elapsed, _ = timed(get_system_message, context_settings, config, cache)
+    print(f"  repeat removal, cached:       {elapsed * 1000:8.1f}ms")
+    # Added at the end in the stable order, as it is when selected in the pages dialog
+    last_page["selected"] = True
+    update_page_order(context_settings)
+    elapsed, _ = timed(get_system_message, context_settings, config, cache)
+    print(f"  repeat removal, page added:   {elapsed * 1000:8.1f}ms")
+
+def bench_map_reduce(root_path, page_count=500, context_size=8192, ttft=0.2, tokens_per_second=500):
+    print(f"Map-reduce over {page_count} pages, {context_size} token context, server {ttft}s to first token at {tokens_per_second} tok/s")
+    relative_paths = [page_file[0] for page_file in list_page_files(root_path)][:page_count]
+    context_settings = {"root_path": root_path, "name": "bench",
+                        "pages": {str(key): {"relative_path": relative_path, "selected": True}
+                                  for key, relative_path in enumerate(relative_paths)}}
+    question = [None, {"role": "user", "content": "Where is the dragon?"}]
+    with MockOpenAIServer(ttft=ttft, tokens_per_second=tokens_per_second, reply_tokens=100) as server:
+        for concurrency in (1, 4, 8):
+            config = {"api_url": server.url, "metrics_log": "", "system_prompt": "You are a helpful assistant.",
+                      "context_size": context_size, "map_concurrency": concurrency, "map_response_limit": 100,
+                      "concurrent_streams": concurrency}
+            metrics = RequestMetrics()
+            elapsed, _ = timed(map_reduce_system_message, context_settings, question, config, EstimateTokenizer(), metrics)
+            stages = ", ".join(f"{name} {parts} parts {seconds:.2f}s" for name, parts, seconds in metrics.stages)
+            print(f"  {concurrency} at once:                  {elapsed:8.2f}s ({stages})")
+
+def bench_sse_parsing(event_count=20000):
+    print(f"SSE parsing in queryLLMStreamed, {event_count} events")
+    with MockOpenAIServer(reply_tokens=event_count) as server:
+        config = {"api_url": server.url, "response_limit": event_count, "metrics_log": ""}
+        start = time.perf_counter()
+        received = sum(1 for event in queryLLMStreamed([{"role": "user", "content": "hello"}], config)
+                       if isinstance(event, StreamDelta) and event.content)
+        elapsed = time.perf_counter() - start
+    print(f"  parse:                        {elapsed / received * 1000000:8.2f}us per event ({received / elapsed:.0f} events/s)")
+
+def record_stream(event_count):
+    # The raw bytes of a streamed response from the mock server, to parse over and over.
+    with MockOpenAIServer(reply_tokens=event_count) as server:
+        data = {"messages": [{"role": "user", "content": "hello"}], "stream": True, "max_completion_tokens": event_count}
+        with requests.post(server.url, json=data, stream=True) as response:
+            return response.raw.read()
+
+def legacy_parse_stream(stream, chunk_size=512):
+    # What queryLLMStreamed used to do: requests' iter_lines, then decode and slice each line.
+    response = requests.Response()
+    response.raw = io.BytesIO(stream)
+    contents = 0
+    for line in response.iter_lines(chunk_size):
+        if line and line != b'data: [DONE]':
+            chunk = json.loads(line.decode('utf-8')[len("data: "):])
+            choices = chunk.get("choices")
+            if choices and choices[0].get("delta", {}).get("content"):
+                contents += 1
+    return contents
+
+def parse_stream(stream, loads, chunk_size=65536):
+    parser = SSEParser()
+    contents = 0
+    for start in range(0, len(stream), chunk_size):
+        for event in parser.feed(stream[start:start + chunk_size]):
+            if event.data != b"[DONE]" and chat_event(loads(event.data)).content:
+                contents += 1
+    return contents
+
+def bench_sse_parser(event_count=100000):
+    stream = record_stream(event_count)
+    print(f"SSE parser on a recorded stream of {event_count} events ({len(stream) // 1024} KB)")
+    runs = [("iter_lines, json (before):", legacy_parse_stream, (stream,)),
+            ("SSEParser 512 B reads, json:", parse_stream, (stream, stdlib_json_loads, 512)),
+            ("SSEParser 64 KB reads, json:", parse_stream, (stream, stdlib_json_loads))]
+    if orjson is not None:
+        runs.append(("SSEParser 64 KB reads, orjson:", parse_stream, (stream, orjson.loads)))
+    for label, function, args in runs:
+        elapsed, contents = timed(function, *args)
+        print(f"  {label:30}{elapsed * 1000:8.1f}ms ({contents / elapsed:.0f} events/s)")
+
+def bench_streaming(streams=8, tokens_per_second=200, reply_tokens=400, ttft=0.05):
+    print(f"Headless streaming, {streams} concurrent streams at {tokens_per_second} tok/s each")
+    with MockOpenAIServer(ttft=ttft, tokens_per_second=tokens_per_second, reply_tokens=reply_tokens) as server:
+        config = {"api_url": server.url, "response_limit": reply_tokens, "metrics_log": "", "concurrent_streams": streams}
+        def stream(_):
+            metrics = RequestMetrics()
+            for event in queryLLMStreamed([{"role": "user", "content": "hello"}], config, metrics):
+                if isinstance(event, StreamError):
+                    break
+            return metrics
+        start = time.perf_counter()
+        with ThreadPoolExecutor(streams) as executor:
+            results = list(executor.map(stream, range(streams)))
+        elapsed = time.perf_counter() - start
+    tokens = sum(metrics.tokens() for metrics in results)
+    mean_ttft = sum(metrics.first_token or 0 for metrics in results) / streams
+    worst_p99 = max(metrics.inter_token()["p99"] or 0 for metrics in results)
+    print(f"  aggregate:                    {tokens / elapsed:8.1f} tok/s (ideal {streams * tokens_per_second})")
+    print(f"  time to first token:          {(mean_ttft - ttft) * 1000:8.1f}ms over the server's {ttft * 1000:.0f}ms")
+    print(f"  worst inter-token p99:        {worst_p99 * 1000:8.1f}ms (pace {1000 / tokens_per_second:.1f}ms)")
+
+def bench_rendering(token_count=10000, tokens_per_batch=20):
+    print("Streamed response rendering (GUI thread time)")
+    try:
+        os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+        from PyQt6.QtWidgets import QApplication
+        from PyQt6.QtGui import QTextCursor
+        from ChatZim import ChatWindow
+    except ImportError as e:
+        print(f"  skipped, {e}")
+        return
+    app = QApplication.instance() or QApplication([])
+    tokens = [f" {words[i % len(words)]}" for i in range(token_count)]
+
+    session = ChatWindow().current_session()
+    message = {"role": "assistant", "content": ""}
+    session.add_message(message)
+    start = time.perf_counter()
+    # What append_token used to do for every token
+    for token in tokens:
+        message["content"] = message["content"] + token
+        cursor = session.chat_display.textCursor()
+        cursor.movePosition(QTextCursor.MoveOperation.End)
+        cursor.insertText(token)
+        session.chat_display.setTextCursor(cursor)
+    elapsed = time.perf_counter() - start
+    print(f"  per token, {token_count} tokens:   {elapsed * 1000:8.1f}ms")
+
+    session = ChatWindow().current_session()
+    message = {"role": "assistant", "content": ""}
+    cursor = session.add_message(message)
+    start = time.perf_counter()
+    session.start_response(message, cursor)
+    for batch in range(0, token_count, tokens_per_batch):
+        session.append_text("".join(tokens[batch:batch + tokens_per_batch]))
+    session.finish_response()
+    elapsed = time.perf_counter() - start
+    print(f"  batched, {token_count} tokens:     {elapsed * 1000:8.1f}ms")
+
+    print("Chat transcript")
+    conversation = [{"role": "user" if i % 2 == 0 else "assistant", "content": " ".join(words * 10)} for i in range(2000)]
+    session = ChatWindow().current_session()
+    session.messages[1:] = conversation
+    elapsed, _ = timed(session.transcript.set_messages, session.messages)
+    print(f"  open 2000 message conversation: {elapsed * 1000:6.1f}ms")
+    elapsed, _ = timed(session.roll_back)
+    print(f"  undo last response:           {elapsed * 1000:8.1f}ms")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark ChatZim's hot paths.")
+    parser.add_argument("--pages", type=int, default=50000, help="pages in the synthetic notebook")
+    parser.add_argument("--notebook", help="use (or create) the synthetic notebook here instead of a temporary directory")
+    args = parser.parse_args()
+
+    root_path = args.notebook or tempfile.mkdtemp(prefix="chatzim_bench_")
+    try:
+        if not os.path.exists(os.path.join(root_path, "notebook.zim")):
+            os.makedirs(root_path, exist_ok=True)
+            print(f"Generating {args.pages} pages in {root_path}")
+            make_synthetic_notebook(root_path, args.pages)
+        bench_scan(root_path)
+        bench_context(root_path)
+        bench_retrieval(root_path)
+        bench_map_reduce(root_path)
+        bench_http()
+        bench_sse_parsing()
+        bench_sse_parser()
+        bench_streaming()
+        bench_rendering()
+    finally:
+        if not args.notebook:
+            shutil.rmtree(root_path)
+
+if __name__ == "__main__":
+    main()
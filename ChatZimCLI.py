@@ -0,0 +1,156 @@
+import argparse
+import json
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from OpenAIInterface import queryLLMStreamed
+from SSEParser import StreamError
+from ZimContext import get_system_message
+from ZimRetrieval import NotebookRetriever, retrieval_system_message
+from ZimMapReduce import map_reduce_system_message
+from EmbeddingStore import SemanticRetriever, get_embedder
+from TokenCounter import get_tokenizer
+from RequestMetrics import RequestMetrics, percentile
+
+# Asks a batch of questions without the GUI, using the same ChatZim.conf and
+# .pages files. Each prompt is sent on its own with the page set's system
+# message, several at a time for servers with parallel slots, and the answers
+# are written out as JSON lines as they finish. For example:
+#   python ChatZimCLI.py --pages campaign.pages --prompts questions.txt --output answers.jsonl --concurrency 4
+# Prompts are one per line, or JSON lines with "prompt" and optionally "id".
+
+def read_prompts(file):
+    prompts = []
+    for line_number, line in enumerate(file, 1):
+        line = line.strip()
+        if not line:
+            continue
+        if line.startswith("{"):
+            item = json.loads(line)
+            prompts.append((item.get("id", line_number), item["prompt"]))
+        else:
+            prompts.append((line_number, line))
+    return prompts
+
+class BatchRunner:
+    def __init__(self, config, context_settings, output, use_cache=True):
+        self.config = config
+        self.use_cache = use_cache
+        self.context_settings = context_settings
+        self.output = output
+        self.output_lock = threading.Lock()
+        self.retriever = None
+        if config.get("context_mode") in ("bm25", "semantic"):
+            if config["context_mode"] == "semantic":
+                self.retriever = SemanticRetriever(context_settings["root_path"], get_embedder(config))
+            else:
+                self.retriever = NotebookRetriever(context_settings["root_path"])
+            self.relative_paths = [page["relative_path"] for page in context_settings["pages"].values()]
+            self.retriever.refresh(self.relative_paths)
+        elif config.get("context_mode") == "mapreduce":
+            # Each prompt asks the pages about itself, see run_prompt
+            self.system_message = None
+        else:
+            # Built once, every prompt gets the same one
+            self.system_message = get_system_message(context_settings, config)
+
+    def run_prompt(self, prompt_id, prompt):
+        """
+        Ask one prompt and write its answer out, returns (metrics, failed). A prompt
+        that fails, before or during the request, gets an error record instead.
+        """
+        metrics = RequestMetrics()
+        try:
+            return self.ask(prompt_id, prompt, metrics)
+        except Exception as e:
+            self.write_result({"id": prompt_id, "prompt": prompt, "response": "", "status": "error", "cached": False,
+                               "metrics": metrics.to_dict(), "error": str(e)})
+            return metrics, True
+
+    def ask(self, prompt_id, prompt, metrics):
+        user_message = {"role": "user", "content": prompt}
+        if self.retriever is not None:
+            system_message = retrieval_system_message(self.retriever, self.relative_paths, [None, user_message],
+                                                      self.config, get_tokenizer(self.config))
+        elif self.system_message is None:
+            system_message = map_reduce_system_message(self.context_settings, [None, user_message], self.config,
+                                                       get_tokenizer(self.config), metrics)
+        else:
+            system_message = self.system_message
+        parts = []
+        error = None
+        for event in queryLLMStreamed([system_message, user_message], self.config, metrics, use_cache=self.use_cache):
+            if isinstance(event, StreamError):
+                error = event.message
+                break
+            parts.append(event.content)
+        failed = error is not None
+        result = {"id": prompt_id, "prompt": prompt, "response": "".join(parts),
+                  "status": "error" if failed else "ok", "cached": metrics.status == "cached",
+                  "metrics": metrics.to_dict()}
+        if failed:
+            result["error"] = error
+        self.write_result(result)
+        return metrics, failed
+
+    def write_result(self, result):
+        with self.output_lock:
+            self.output.write(json.dumps(result) + "\n")
+            self.output.flush()
+
+def print_summary(results, elapsed, file):
+    # Prompts that failed before their request was sent have no timings.
+    durations = sorted(metrics.duration for metrics, _ in results if metrics.duration is not None)
+    first_tokens = sorted(metrics.first_token for metrics, _ in results if metrics.first_token is not None)
+    tokens = sum(metrics.tokens() for metrics, _ in results)
+    failed = sum(1 for _, failed in results if failed)
+    print(f"{len(results)} prompts, {failed} failed, in {elapsed:.1f}s", file=file)
+    print(f"{tokens} tokens generated, {tokens / max(elapsed, 1e-9):.1f} tok/s overall", file=file)
+    if first_tokens:
+        print(f"time to first token p50 {percentile(first_tokens, 0.5):.2f}s, p90 {percentile(first_tokens, 0.9):.2f}s", file=file)
+    if durations:
+        print(f"request duration p50 {percentile(durations, 0.5):.2f}s, p90 {percentile(durations, 0.9):.2f}s", file=file)
+
+def main():
+    parser = argparse.ArgumentParser(description="Ask ChatZim a batch of questions from the command line.")
+    parser.add_argument("--pages", required=True, help="the .pages file with the notebook and page selection")
+    parser.add_argument("--config", default="ChatZim.conf", help="configuration file, as saved by ChatZim")
+    parser.add_argument("--prompts", default="-", help="file of prompts, one per line, - for stdin")
+    parser.add_argument("--output", default="-", help="JSONL file for the answers, - for stdout")
+    parser.add_argument("--concurrency", type=int, default=4, help="requests to have in flight at once")
+    parser.add_argument("--no-cache", action="store_true", help="ask the server even when the response cache has an answer")
+    args = parser.parse_args()
+
+    with open(args.config) as file:
+        config = json.load(file)
+    with open(args.pages) as file:
+        context_settings = json.load(file)
+    # Enough pooled connections and request slots for every request in flight
+    config["max_connections"] = max(config.get("max_connections", 8), args.concurrency)
+    config["concurrent_streams"] = max(1, args.concurrency)
+
+    if args.prompts == "-":
+        prompts = read_prompts(sys.stdin)
+    else:
+        with open(args.prompts, encoding="utf-8") as file:
+            prompts = read_prompts(file)
+
+    # Error messages are printed to stderr, so stdout only gets the JSON lines.
+    output = sys.stdout if args.output == "-" else open(args.output, "a", encoding="utf-8")
+    results = []
+    start = time.perf_counter()
+    try:
+        runner = BatchRunner(config, context_settings, output, not args.no_cache)
+        with ThreadPoolExecutor(max(1, args.concurrency)) as executor:
+            futures = [executor.submit(runner.run_prompt, prompt_id, prompt) for prompt_id, prompt in prompts]
+            for future in as_completed(futures):
+                results.append(future.result())
+    finally:
+        if output is not sys.stdout:
+            output.close()
+        print_summary(results, time.perf_counter() - start, sys.stderr)
+
+if __name__ == "__main__":
+    main()
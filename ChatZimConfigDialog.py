@@ -1,10 +1,13 @@
 import sys
 from PyQt6.QtWidgets import (
-    QApplication, QDialog, QVBoxLayout, QFormLayout, QLineEdit, QTextEdit, QPushButton, QMessageBox, QLabel, QFileDialog
+    QApplication, QDialog, QVBoxLayout, QFormLayout, QLineEdit, QTextEdit, QPushButton, QMessageBox, QLabel, QFileDialog, QComboBox, QCheckBox
 )
 from PyQt6.QtGui import QIntValidator, QRegularExpressionValidator
 from PyQt6.QtCore import QRegularExpression
 
+from RequestMetrics import default_metrics_log
+from ChatJournal import default_journal_dir
+
 class ChatZimConfigDialog(QDialog):
     def __init__(self, parent=None):
         super().__init__(parent)
@@ -19,6 +22,62 @@ class ChatZimConfigDialog(QDialog):
         self.response_limit.setValidator(QIntValidator(1, 2147483647, self))
         form_layout.addRow("Response limit:", self.response_limit)
 
+        self.context_size = QLineEdit()
+        self.context_size.setValidator(QIntValidator(0, 2147483647, self))
+        self.context_size.setPlaceholderText("0 to not check the token budget")
+        form_layout.addRow("Context size (tokens):", self.context_size)
+
+        self.history_tokens = QLineEdit()
+        self.history_tokens.setValidator(QIntValidator(0, 2147483647, self))
+        self.history_tokens.setPlaceholderText("0 to always send the whole conversation")
+        form_layout.addRow("History budget (tokens):", self.history_tokens)
+
+        self.context_mode = QComboBox()
+        self.context_mode.addItem("Selected pages", "pages")
+        self.context_mode.addItem("Retrieve relevant chunks (BM25)", "bm25")
+        self.context_mode.addItem("Retrieve relevant chunks (embeddings)", "semantic")
+        self.context_mode.addItem("Selected pages, asked in parts if they don't fit (map-reduce)", "mapreduce")
+        form_layout.addRow("Context:", self.context_mode)
+
+        self.context_order = QComboBox()
+        self.context_order.addItem("Alphabetical", "sorted")
+        self.context_order.addItem("Stable, new pages added at the end (reuses the server's prompt cache)", "stable")
+        form_layout.addRow("Page order:", self.context_order)
+
+        self.markup = QComboBox()
+        self.markup.addItem("Zim markup as it is", "raw")
+        self.markup.addItem("Compact, light markdown", "markdown")
+        self.markup.addItem("Compact, plain text", "plain")
+        form_layout.addRow("Page text:", self.markup)
+
+        self.dedup = QComboBox()
+        self.dedup.addItem("Keep", "off")
+        self.dedup.addItem("Drop", "drop")
+        self.dedup.addItem("Drop, noting where they appeared", "reference")
+        form_layout.addRow("Repeated paragraphs:", self.dedup)
+
+        self.watch_notebook = QCheckBox("Pick up pages edited in Zim straight away")
+        form_layout.addRow("Watch notebook:", self.watch_notebook)
+
+        self.warm_up = QCheckBox("Send the server new context in the background when the pages change")
+        form_layout.addRow("Warm up:", self.warm_up)
+
+        self.retrieval_tokens = QLineEdit()
+        self.retrieval_tokens.setValidator(QIntValidator(1, 2147483647, self))
+        form_layout.addRow("Retrieval budget (tokens):", self.retrieval_tokens)
+
+        self.map_concurrency = QLineEdit()
+        self.map_concurrency.setValidator(QIntValidator(1, 64, self))
+        form_layout.addRow("Parts asked at once:", self.map_concurrency)
+
+        self.concurrent_streams = QLineEdit()
+        self.concurrent_streams.setValidator(QIntValidator(1, 64, self))
+        form_layout.addRow("Requests sent at once:", self.concurrent_streams)
+
+        self.tokenizer = QLineEdit()
+        self.tokenizer.setPlaceholderText("estimate, server, or the path to a tokenizer.json")
+        form_layout.addRow("Tokenizer:", self.tokenizer)
+
         self.api_url = QLineEdit()
         url_regex = QRegularExpression(r"(https?|ftp)://[^\s/$.?#].[^\s]*")
         self.api_url.setValidator(QRegularExpressionValidator(url_regex, self))
@@ -36,6 +95,26 @@ class ChatZimConfigDialog(QDialog):
         self.model = QLineEdit()
         form_layout.addRow("Model:", self.model)
 
+        self.embedding_model = QLineEdit()
+        self.embedding_model.setPlaceholderText("defaults to the chat model")
+        form_layout.addRow("Embedding model:", self.embedding_model)
+
+        self.metrics_log = QLineEdit()
+        self.metrics_log.setPlaceholderText("blank to not log request timings")
+        form_layout.addRow("Metrics log:", self.metrics_log)
+
+        self.journal_dir = QLineEdit()
+        self.journal_dir.setPlaceholderText("blank to not autosave conversations")
+        form_layout.addRow("Autosave folder:", self.journal_dir)
+
+        self.response_cache = QLineEdit()
+        self.response_cache.setPlaceholderText("blank to not cache answers")
+        form_layout.addRow("Response cache:", self.response_cache)
+
+        self.response_cache_mb = QLineEdit()
+        self.response_cache_mb.setValidator(QIntValidator(1, 2147483647, self))
+        form_layout.addRow("Response cache size (MB):", self.response_cache_mb)
+
         self.system_prompt = QTextEdit()
         form_layout.addRow("System Prompt:", self.system_prompt)
 
@@ -70,11 +149,28 @@ class ChatZimConfigDialog(QDialog):
 
     def load_config(self):
         self.response_limit.setText(str(self.config.get("response_limit", "")))
+        self.context_size.setText(str(self.config.get("context_size", 0)))
+        self.history_tokens.setText(str(self.config.get("history_tokens", 0)))
+        self.tokenizer.setText(self.config.get("tokenizer", "estimate"))
+        self.context_mode.setCurrentIndex(max(0, self.context_mode.findData(self.config.get("context_mode", "pages"))))
+        self.context_order.setCurrentIndex(max(0, self.context_order.findData(self.config.get("context_order", "sorted"))))
+        self.markup.setCurrentIndex(max(0, self.markup.findData(self.config.get("markup", "raw"))))
+        self.dedup.setCurrentIndex(max(0, self.dedup.findData(self.config.get("dedup", "off"))))
+        self.watch_notebook.setChecked(self.config.get("watch_notebook", True))
+        self.warm_up.setChecked(self.config.get("warm_up", False))
+        self.retrieval_tokens.setText(str(self.config.get("retrieval_tokens", 2048)))
+        self.map_concurrency.setText(str(self.config.get("map_concurrency", 4)))
+        self.concurrent_streams.setText(str(self.config.get("concurrent_streams", 1)))
         self.api_url.setText(self.config.get("api_url", ""))
         self.api_key.setText(self.config.get("api_key", ""))
         self.organization_id.setText(self.config.get("organization_id", ""))
         self.project_id.setText(self.config.get("project_id", ""))
         self.model.setText(self.config.get("model", ""))
+        self.embedding_model.setText(self.config.get("embedding_model", ""))
+        self.metrics_log.setText(self.config.get("metrics_log", default_metrics_log))
+        self.journal_dir.setText(self.config.get("journal_dir", default_journal_dir))
+        self.response_cache.setText(self.config.get("response_cache", ""))
+        self.response_cache_mb.setText(str(self.config.get("response_cache_mb", 100)))
         self.system_prompt.setPlainText(self.config.get("system_prompt", ""))
         self.default_page_set_label.setText(self.config.get("default_pages", ""))
         #No need to do default_pages, it's already set when the file dialogue selects it
@@ -84,11 +180,34 @@ class ChatZimConfigDialog(QDialog):
             if not self.response_limit.text().isdigit() or int(self.response_limit.text()) <= 0:
                 raise ValueError("Response limit must be a positive integer.")
             self.config["response_limit"] = int(self.response_limit.text())
+            if self.context_size.text() and not self.context_size.text().isdigit():
+                raise ValueError("Context size must be a positive integer, or 0.")
+            self.config["context_size"] = int(self.context_size.text() or 0)
+            if self.history_tokens.text() and not self.history_tokens.text().isdigit():
+                raise ValueError("History budget must be a positive integer, or 0.")
+            self.config["history_tokens"] = int(self.history_tokens.text() or 0)
+            self.config["tokenizer"] = self.tokenizer.text().strip() or "estimate"
+            self.config["context_mode"] = self.context_mode.currentData()
+            self.config["context_order"] = self.context_order.currentData()
+            self.config["markup"] = self.markup.currentData()
+            self.config["dedup"] = self.dedup.currentData()
+            self.config["watch_notebook"] = self.watch_notebook.isChecked()
+            self.config["warm_up"] = self.warm_up.isChecked()
+            if not self.retrieval_tokens.text().isdigit() or int(self.retrieval_tokens.text()) <= 0:
+                raise ValueError("Retrieval budget must be a positive integer.")
+            self.config["retrieval_tokens"] = int(self.retrieval_tokens.text())
+            self.config["map_concurrency"] = int(self.map_concurrency.text() or 4)
+            self.config["concurrent_streams"] = int(self.concurrent_streams.text() or 1)
             self.config["api_url"] = self.api_url.text()
             self.config["api_key"] = self.api_key.text()
             self.config["organization_id"] = self.organization_id.text()
             self.config["project_id"] = self.project_id.text()
             self.config["model"] = self.model.text()
+            self.config["embedding_model"] = self.embedding_model.text()
+            self.config["metrics_log"] = self.metrics_log.text().strip()
+            self.config["journal_dir"] = self.journal_dir.text().strip()
+            self.config["response_cache"] = self.response_cache.text().strip()
+            self.config["response_cache_mb"] = int(self.response_cache_mb.text() or 100)
             self.config["system_prompt"] = self.system_prompt.toPlainText()
             self.accept()
         except ValueError as e:
@@ -1,6 +1,8 @@
 import os
-from PyQt6.QtWidgets import QLineEdit, QVBoxLayout, QWidget, QPushButton, QDialog, QCheckBox, QVBoxLayout, QScrollArea, QLabel, QHBoxLayout, QFileDialog, QSpacerItem, QSizePolicy
+from PyQt6.QtWidgets import QLineEdit, QVBoxLayout, QPushButton, QDialog, QLabel, QHBoxLayout, QFileDialog, QProgressBar, QTableView, QHeaderView, QComboBox, QAbstractItemView
+from PyQt6.QtCore import Qt, QThread, QTimer, pyqtSignal, QObject
 import json
+import threading
 
 import configparser
 def extract_name_from_ini(root_path):
@@ -13,30 +15,39 @@ def extract_name_from_ini(root_path):
     except:
         return None
 
-import time
-def get_creation_date_in_seconds(file_path):
-    with open(file_path, 'r', encoding="utf-8") as file:
-        lines = file.readlines()
-        if len(lines) >= 3:
-            creation_date_line = lines[2].strip()
-            if creation_date_line.startswith("Creation-Date:"):
-                creation_date_str = creation_date_line.split(":", 1)[1].strip()
-                # Convert the creation date to Unix epoch format in seconds
-                creation_date_epoch = str(int(time.mktime(time.strptime(creation_date_str, "%Y-%m-%dT%H:%M:%S%z"))))
-                return creation_date_epoch
-    return None
-
-def count_words_in_file(file_path):
-    with open(file_path, 'r', encoding="utf-8") as file:
-        lines = file.readlines()
-        lines = lines[3:]
-        return len(''.join(lines).split())
-
-def clearLayout(layout):
-  while layout.count():
-    child = layout.takeAt(0)
-    if child.widget():
-      child.widget().deleteLater()
+from ZimPageIndex import ZimPageIndex
+from ChatZimPagesModel import PageTableModel, PageFilterProxyModel
+from TokenCounter import get_tokenizer
+from ZimContext import context_budget, pages_over_budget, dedup_savings
+from ZimMarkup import CompactingTokenizer
+
+class ScanWorker(QObject):
+    progress = pyqtSignal(int, int)
+    finished = pyqtSignal(object)
+    error = pyqtSignal(str)
+
+    def __init__(self, root_path, tokenizer, markup="raw"):
+        super().__init__()
+        self.root_path = root_path
+        self.tokenizer = tokenizer
+        # Pages are counted a second time as they'll be after compaction, to show what it saves.
+        self.compact_tokenizer = CompactingTokenizer(tokenizer, markup) if markup != "raw" else None
+        self.cancel_event = threading.Event()
+
+    def run(self):
+        try:
+            # The index has to be opened on the thread that uses it.
+            with ZimPageIndex(self.root_path) as index:
+                pages = index.refresh(self.progress.emit, self.cancel_event, self.tokenizer, self.compact_tokenizer)
+        except Exception as e:
+            # A locked or unreadable index, say, the dialog would otherwise wait forever.
+            print(f"Unable to scan {self.root_path}: {e}")
+            self.error.emit(str(e))
+            return
+        self.finished.emit(pages)
+
+    def cancel(self):
+        self.cancel_event.set()
 
 class ChatZimFilesDialog(QDialog):
     def __init__(self, parent=None):
@@ -46,6 +57,10 @@ class ChatZimFilesDialog(QDialog):
         self.parent = parent
 
         self.file_list = []
+        self.scan_thread = None
+        self.scan_worker = None
+        # Cancelled scans left to wind down on their own
+        self.cancelled_scans = []
 
         main_layout = QVBoxLayout()
 
@@ -57,13 +72,67 @@ class ChatZimFilesDialog(QDialog):
         top_layout.addWidget(load_files_button)
         main_layout.addLayout(top_layout)
 
-        # Checkbox area
-        scroll_area = QScrollArea()
-        scroll_area.setWidgetResizable(True)
-        main_layout.addWidget(scroll_area)
-        container_widget = QWidget()
-        scroll_area.setWidget(container_widget)
-        self.file_checkboxes_layout = QVBoxLayout(container_widget)
+        scan_layout = QHBoxLayout()
+        self.scan_progress = QProgressBar()
+        self.scan_progress.setFormat("Scanning pages: %v/%m")
+        scan_layout.addWidget(self.scan_progress)
+        self.cancel_scan_button = QPushButton("Cancel Scan")
+        self.cancel_scan_button.clicked.connect(self.cancel_scan)
+        scan_layout.addWidget(self.cancel_scan_button)
+        main_layout.addLayout(scan_layout)
+        self.set_scan_widgets_visible(False)
+
+        filter_layout = QHBoxLayout()
+        self.namespace_filter = QComboBox()
+        self.namespace_filter.currentIndexChanged.connect(self.namespace_filter_changed)
+        filter_layout.addWidget(self.namespace_filter)
+        self.text_filter = QLineEdit()
+        self.text_filter.setPlaceholderText("Filter pages")
+        self.text_filter.setClearButtonEnabled(True)
+        filter_layout.addWidget(self.text_filter)
+        main_layout.addLayout(filter_layout)
+
+        # Page list
+        self.page_model = PageTableModel(self)
+        self.page_proxy = PageFilterProxyModel(self)
+        self.page_proxy.setSourceModel(self.page_model)
+        self.text_filter.textChanged.connect(self.page_proxy.set_text)
+        self.page_view = QTableView()
+        self.page_view.setModel(self.page_proxy)
+        self.page_view.setSortingEnabled(True)
+        self.page_view.sortByColumn(PageTableModel.PATH_COLUMN, Qt.SortOrder.AscendingOrder)
+        self.page_view.setSelectionBehavior(QAbstractItemView.SelectionBehavior.SelectRows)
+        self.page_view.setShowGrid(False)
+        self.page_view.setWordWrap(False)
+        self.page_view.verticalHeader().hide()
+        # Fixed row heights so the view never has to measure rows it isn't showing.
+        self.page_view.verticalHeader().setSectionResizeMode(QHeaderView.ResizeMode.Fixed)
+        self.page_view.horizontalHeader().setSectionResizeMode(PageTableModel.PATH_COLUMN, QHeaderView.ResizeMode.Stretch)
+        self.page_view.horizontalHeader().setSectionResizeMode(PageTableModel.WORDS_COLUMN, QHeaderView.ResizeMode.ResizeToContents)
+        self.page_view.horizontalHeader().setSectionResizeMode(PageTableModel.TOKENS_COLUMN, QHeaderView.ResizeMode.ResizeToContents)
+        self.page_view.horizontalHeader().setSectionResizeMode(PageTableModel.SAVED_COLUMN, QHeaderView.ResizeMode.ResizeToContents)
+        main_layout.addWidget(self.page_view)
+
+        budget_layout = QHBoxLayout()
+        self.budget_label = QLabel()
+        budget_layout.addWidget(self.budget_label)
+        self.dedup_label = QLabel()
+        self.dedup_label.setToolTip("Tokens saved by dropping paragraphs repeated from earlier pages")
+        budget_layout.addWidget(self.dedup_label)
+        self.fit_budget_button = QPushButton("Fit to Budget")
+        self.fit_budget_button.setToolTip("Deselect the largest pages until the selection fits in the context size")
+        self.fit_budget_button.clicked.connect(self.fit_to_budget)
+        budget_layout.addWidget(self.fit_budget_button)
+        main_layout.addLayout(budget_layout)
+        self.page_model.dataChanged.connect(self.update_budget)
+        self.page_model.modelReset.connect(self.update_budget)
+        # Finding repeats means reading the selected pages, so wait for the clicking to stop.
+        self.dedup_timer = QTimer(self)
+        self.dedup_timer.setSingleShot(True)
+        self.dedup_timer.setInterval(300)
+        self.dedup_timer.timeout.connect(self.update_dedup_savings)
+        self.page_model.dataChanged.connect(self.dedup_timer.start)
+        self.page_model.modelReset.connect(self.dedup_timer.start)
 
         bottom_layout = QHBoxLayout()
 
@@ -98,74 +167,158 @@ class ChatZimFilesDialog(QDialog):
         if name is None:
             return
 
-        clearLayout(self.file_checkboxes_layout)
+        self.cancel_scan()
+        self.page_model.set_pages([], {})
+        self.update_namespace_filter()
 
         self.parent.context_settings["root_path"] = root_path
         self.parent.context_settings["name"] = name
-        
+
+        # Scanning a large notebook can take a while, so it's done off the GUI thread.
+        self.scan_progress.setRange(0, 0)
+        self.set_scan_widgets_visible(True)
+        self.scan_thread = QThread()
+        self.scan_worker = ScanWorker(root_path, get_tokenizer(self.parent.config), self.parent.config.get("markup", "raw"))
+        self.scan_worker.moveToThread(self.scan_thread)
+        self.scan_worker.progress.connect(self.on_scan_progress)
+        self.scan_worker.finished.connect(self.on_scan_finished)
+        self.scan_worker.error.connect(self.on_scan_error)
+        # Whether it finished, failed or was cancelled, the thread is done once the worker is.
+        self.scan_worker.finished.connect(self.scan_thread.quit)
+        self.scan_worker.error.connect(self.scan_thread.quit)
+        self.scan_thread.started.connect(self.scan_worker.run)
+        self.scan_thread.start()
+
+    def set_scan_widgets_visible(self, visible):
+        self.scan_progress.setVisible(visible)
+        self.cancel_scan_button.setVisible(visible)
+
+    def on_scan_progress(self, done, total):
+        self.scan_progress.setRange(0, total)
+        self.scan_progress.setValue(done)
+
+    def cancel_scan(self):
+        """
+        Stop the scan without waiting for it, the worker stops at the end of the
+        batch it's on and is cleaned up when its thread finishes.
+        """
+        if self.scan_thread is None:
+            return
+        self.scan_worker.cancel()
+        self.scan_worker.progress.disconnect(self.on_scan_progress)
+        self.scan_worker.finished.disconnect(self.on_scan_finished)
+        self.scan_worker.error.disconnect(self.on_scan_error)
+        self.cancelled_scans.append((self.scan_thread, self.scan_worker))
+        self.scan_thread.finished.connect(self.reap_cancelled_scans)
+        self.scan_thread = None
+        self.scan_worker = None
+        self.set_scan_widgets_visible(False)
+
+    def reap_cancelled_scans(self):
+        self.cancelled_scans = [(thread, worker) for thread, worker in self.cancelled_scans if not thread.isFinished()]
+
+    def finish_scan_thread(self):
+        # The worker has returned, so this is only waiting for the thread's event loop to stop.
+        self.scan_thread.quit()
+        self.scan_thread.wait()
+        self.scan_thread = None
+        self.scan_worker = None
+        self.set_scan_widgets_visible(False)
+
+    def on_scan_error(self, error_message):
+        if self.sender() is not self.scan_worker:
+            # A cancelled scan reporting in late.
+            return
+        self.finish_scan_thread()
+        self.root_path.setText(f"{self.root_path.text()} (unable to scan: {error_message})")
+
+    def on_scan_finished(self, pages):
+        if self.sender() is not self.scan_worker:
+            return
+        self.finish_scan_thread()
+        if pages is None:
+            # Cancelled, leave the previous page selection as it was.
+            return
+
         old_context_settings = self.parent.context_settings["pages"]
         new_context_settings = {}
         self.parent.context_settings["pages"] = new_context_settings
 
-        checkboxes = []
-        for root, dirs, files in os.walk(root_path):
-            for file in files:
-                if file.endswith(".txt"):
-                    file_path = os.path.join(root, file)
-                    relative_path = os.path.relpath(file_path, root_path)
-                    creation_date = get_creation_date_in_seconds(file_path)
-                    if creation_date is None:
-                        print(relative_path + " had no creation date")
-                        continue
-                    if creation_date in new_context_settings:
-                        print(relative_path + " has an identical creation date to " + new_context_settings[creation_date]["relative_path"])
-                        continue
-
-                    #TODO simplify
-                    if creation_date in old_context_settings:
-                        new_context_settings[creation_date] = {"relative_path":relative_path,
-                                                    "selected": old_context_settings[creation_date]["selected"]}
-                    else:
-                        new_context_settings[creation_date] = {"relative_path":relative_path,
-                                                    "selected": False}
-
-                    checkbox_container = QWidget()
-                    layout = QHBoxLayout(checkbox_container)
-                    layout.setContentsMargins(0, 0, 0, 0)
-                    layout.setSpacing(5)
-        
-                    # Checkbox for the file
-                    checkbox = QCheckBox(relative_path)
-                    checkbox.setProperty("creation_date", creation_date)
-                    checkbox.setChecked(new_context_settings[creation_date]["selected"])
-                    checkbox.stateChanged.connect(self.file_toggled)
-
-                    # Spacer item to push the label to the right
-                    spacer = QSpacerItem(40, 20, QSizePolicy.Policy.Expanding, QSizePolicy.Policy.Minimum)
-         
-                    # Label for the word count
-                    word_count_label = QLabel(f"{count_words_in_file(file_path)} words")
-        
-                    # Add the checkbox and word count label to the layout
-                    layout.addWidget(checkbox)
-                    layout.addItem(spacer)
-                    layout.addWidget(word_count_label)
-
-                    checkboxes.append(checkbox_container)
-
-        #Sort the files by name
-        checkboxes.sort(key=lambda cb:cb.layout().itemAt(0).widget().text())
-        for checkbox_container in checkboxes:
-            self.file_checkboxes_layout.addWidget(checkbox_container)
-
-        #Add a spacer at the bottom to push the contents to the top.
-        self.file_checkboxes_layout.addItem(QSpacerItem(0, 0, QSizePolicy.Policy.Minimum, QSizePolicy.Policy.Expanding))
-
-    def file_toggled(self):
-        checkbox = self.sender()
-        creation_date = checkbox.property("creation_date")
-        new_state = checkbox.isChecked()
-        self.parent.context_settings["pages"][creation_date]["selected"] = new_state
+        listed_pages = []
+        for page in pages:
+            relative_path = page["relative_path"]
+            creation_date = page["creation_date"]
+            if creation_date is None:
+                print(relative_path + " had no creation date")
+                continue
+            if creation_date in new_context_settings:
+                print(relative_path + " has an identical creation date to " + new_context_settings[creation_date]["relative_path"])
+                continue
+
+            #TODO simplify
+            if creation_date in old_context_settings:
+                new_context_settings[creation_date] = {"relative_path":relative_path,
+                                            "selected": old_context_settings[creation_date]["selected"]}
+            else:
+                new_context_settings[creation_date] = {"relative_path":relative_path,
+                                            "selected": False}
+            listed_pages.append(page)
+
+        self.page_model.set_pages(listed_pages, new_context_settings)
+        self.update_namespace_filter()
+
+    def update_namespace_filter(self):
+        self.namespace_filter.blockSignals(True)
+        self.namespace_filter.clear()
+        self.namespace_filter.addItem("All namespaces", None)
+        for namespace in self.page_model.namespaces():
+            self.namespace_filter.addItem(namespace, namespace)
+        self.namespace_filter.blockSignals(False)
+        self.page_proxy.set_namespace(None)
+
+    def budget(self):
+        """
+        Tokens available for selected pages, or None if no context size is configured.
+        """
+        tokenizer = get_tokenizer(self.parent.config)
+        budget = context_budget(self.parent.config, self.parent.history_token_count())
+        if budget is None:
+            return None
+        return budget - tokenizer.count(self.parent.config["system_prompt"])
+
+    def update_budget(self):
+        page_tokens = self.page_model.selected_token_counts()
+        selected_tokens = sum(page_tokens.values())
+        budget = self.budget()
+        if budget is None:
+            self.budget_label.setText(f"{len(page_tokens)} pages selected, {selected_tokens} tokens (set a context size to check the budget)")
+            self.budget_label.setStyleSheet("")
+            self.fit_budget_button.setEnabled(False)
+            return
+        self.budget_label.setText(f"{len(page_tokens)} pages selected, {selected_tokens} of {budget} available tokens")
+        self.budget_label.setStyleSheet("color: red;" if selected_tokens > budget else "")
+        self.fit_budget_button.setEnabled(selected_tokens > budget)
+
+    def update_dedup_savings(self):
+        config = self.parent.config
+        if config.get("dedup", "off") == "off" or not self.parent.context_settings.get("root_path"):
+            self.dedup_label.setText("")
+            return
+        saved = dedup_savings(self.parent.context_settings, config, get_tokenizer(config))
+        self.dedup_label.setText(f"{saved} tokens saved by dropping repeated paragraphs")
+
+    def fit_to_budget(self):
+        budget = self.budget()
+        if budget is not None:
+            self.page_model.set_selected(pages_over_budget(self.page_model.selected_token_counts(), budget), False)
+
+    def namespace_filter_changed(self):
+        self.page_proxy.set_namespace(self.namespace_filter.currentData())
+
+    def done(self, result):
+        self.dedup_timer.stop()
+        self.cancel_scan()
+        super().done(result)
 
     def load_notebook(self):
         fileName, _ = QFileDialog.getOpenFileName(self, "Load Notebook", "", "ZIM Files (*.zim);;All Files (*)")
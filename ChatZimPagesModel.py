@@ -0,0 +1,178 @@
+import os
+from PyQt6.QtCore import Qt, QAbstractTableModel, QModelIndex, QSortFilterProxyModel
+
+# Table model for the page list in ChatZimFilesDialog. Only the rows that are
+# actually visible get rendered by the view, so notebooks with thousands of
+# pages don't need thousands of widgets.
+
+root_namespace = "(top level)"
+
+def page_namespace(relative_path):
+    parts = relative_path.split(os.sep)
+    return parts[0] if len(parts) > 1 else root_namespace
+
+def context_tokens(page):
+    # Tokens the page takes up in the context, after compaction if that's on.
+    if page.get("compact_token_count") is not None:
+        return page["compact_token_count"]
+    return page["token_count"]
+
+def saved_tokens(page):
+    if page.get("compact_token_count") is None or page["token_count"] is None:
+        return None
+    return page["token_count"] - page["compact_token_count"]
+
+class PageTableModel(QAbstractTableModel):
+    PATH_COLUMN = 0
+    WORDS_COLUMN = 1
+    TOKENS_COLUMN = 2
+    SAVED_COLUMN = 3
+    headers = ["Page", "Words", "Tokens", "Saved"]
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.pages = []
+        self.selection = {}
+        self.sort_column = self.PATH_COLUMN
+        self.sort_order = Qt.SortOrder.AscendingOrder
+
+    def set_pages(self, pages, selection):
+        """
+        pages is a list of dicts with creation_date, relative_path, word_count and token_count,
+        and compact_token_count if markup compaction is on.
+        selection is context_settings["pages"], checking a row updates it directly.
+        """
+        self.beginResetModel()
+        self.pages = pages
+        self.selection = selection
+        for page in self.pages:
+            page["namespace"] = page_namespace(page["relative_path"])
+        self._sort_pages()
+        self.endResetModel()
+
+    def _sort_pages(self):
+        if self.sort_column == self.WORDS_COLUMN:
+            key = lambda page: page["word_count"]
+        elif self.sort_column == self.TOKENS_COLUMN:
+            key = lambda page: context_tokens(page) or 0
+        elif self.sort_column == self.SAVED_COLUMN:
+            key = lambda page: saved_tokens(page) or 0
+        else:
+            key = lambda page: page["relative_path"].lower()
+        self.pages.sort(key=key, reverse=self.sort_order == Qt.SortOrder.DescendingOrder)
+
+    def sort(self, column, order=Qt.SortOrder.AscendingOrder):
+        # Sorting the list directly is far quicker than letting the proxy call
+        # data() for every comparison.
+        self.layoutAboutToBeChanged.emit()
+        # The view's selection and current index have to follow their pages to the new rows.
+        old_indexes = self.persistentIndexList()
+        old_pages = [self.pages[index.row()] for index in old_indexes]
+        self.sort_column = column
+        self.sort_order = order
+        self._sort_pages()
+        rows = {id(page): row for row, page in enumerate(self.pages)}
+        self.changePersistentIndexList(old_indexes, [self.index(rows[id(page)], index.column())
+                                                     for index, page in zip(old_indexes, old_pages)])
+        self.layoutChanged.emit()
+
+    def namespaces(self):
+        return sorted({page["namespace"] for page in self.pages})
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.pages)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.headers)
+
+    def headerData(self, section, orientation, role=Qt.ItemDataRole.DisplayRole):
+        if role == Qt.ItemDataRole.DisplayRole and orientation == Qt.Orientation.Horizontal:
+            return self.headers[section]
+        return None
+
+    def data(self, index, role=Qt.ItemDataRole.DisplayRole):
+        if not index.isValid():
+            return None
+        page = self.pages[index.row()]
+        column = index.column()
+        if column == self.PATH_COLUMN:
+            if role == Qt.ItemDataRole.DisplayRole:
+                return page["relative_path"]
+            if role == Qt.ItemDataRole.CheckStateRole:
+                selected = self.selection[page["creation_date"]]["selected"]
+                return Qt.CheckState.Checked if selected else Qt.CheckState.Unchecked
+        elif column == self.WORDS_COLUMN:
+            if role == Qt.ItemDataRole.DisplayRole:
+                return f"{page['word_count']} words"
+            if role == Qt.ItemDataRole.TextAlignmentRole:
+                return Qt.AlignmentFlag.AlignRight | Qt.AlignmentFlag.AlignVCenter
+        elif column == self.TOKENS_COLUMN:
+            if role == Qt.ItemDataRole.DisplayRole:
+                tokens = context_tokens(page)
+                return "?" if tokens is None else f"{tokens} tokens"
+            if role == Qt.ItemDataRole.TextAlignmentRole:
+                return Qt.AlignmentFlag.AlignRight | Qt.AlignmentFlag.AlignVCenter
+        elif column == self.SAVED_COLUMN:
+            if role == Qt.ItemDataRole.DisplayRole:
+                saved = saved_tokens(page)
+                if saved is None:
+                    return ""
+                return f"{saved} ({saved * 100 // max(page['token_count'], 1)}%)"
+            if role == Qt.ItemDataRole.TextAlignmentRole:
+                return Qt.AlignmentFlag.AlignRight | Qt.AlignmentFlag.AlignVCenter
+        return None
+
+    def setData(self, index, value, role=Qt.ItemDataRole.EditRole):
+        if role == Qt.ItemDataRole.CheckStateRole and index.column() == self.PATH_COLUMN:
+            page = self.pages[index.row()]
+            self.selection[page["creation_date"]]["selected"] = Qt.CheckState(value) == Qt.CheckState.Checked
+            self.dataChanged.emit(index, index, [role])
+            return True
+        return False
+
+    def selected_token_counts(self):
+        """
+        Cached token counts of the selected pages, keyed by creation date.
+        """
+        return {page["creation_date"]: context_tokens(page) or 0 for page in self.pages
+                if self.selection[page["creation_date"]]["selected"]}
+
+    def set_selected(self, keys, selected):
+        for key in keys:
+            self.selection[key]["selected"] = selected
+        if self.pages:
+            self.dataChanged.emit(self.index(0, self.PATH_COLUMN), self.index(len(self.pages) - 1, self.PATH_COLUMN),
+                                  [Qt.ItemDataRole.CheckStateRole])
+
+    def flags(self, index):
+        flags = Qt.ItemFlag.ItemIsEnabled | Qt.ItemFlag.ItemIsSelectable
+        if index.column() == self.PATH_COLUMN:
+            flags |= Qt.ItemFlag.ItemIsUserCheckable
+        return flags
+
+class PageFilterProxyModel(QSortFilterProxyModel):
+    """
+    Filters the pages by namespace and by a case insensitive substring of the path.
+    Sorting is handed to the source model so the proxy keeps its order.
+    """
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.namespace = None
+        self.text = ""
+
+    def sort(self, column, order=Qt.SortOrder.AscendingOrder):
+        self.sourceModel().sort(column, order)
+
+    def set_namespace(self, namespace):
+        self.namespace = namespace
+        self.invalidateFilter()
+
+    def set_text(self, text):
+        self.text = text.lower()
+        self.invalidateFilter()
+
+    def filterAcceptsRow(self, source_row, source_parent):
+        page = self.sourceModel().pages[source_row]
+        if self.namespace is not None and page["namespace"] != self.namespace:
+            return False
+        return self.text in page["relative_path"].lower()
@@ -0,0 +1,495 @@
+import os
+import sys
+import threading
+from PyQt6.QtWidgets import QWidget, QTextEdit, QLineEdit, QVBoxLayout, QFileDialog
+from PyQt6.QtCore import QThread, QTimer, pyqtSignal, QObject
+
+from ChatZimTranscript import ChatTranscript
+from OpenAIInterface import queryLLM, queryLLMStreamed, StreamCanceller
+from SSEParser import StreamError
+from ZimContext import PrefixTracker
+from TokenCounter import get_tokenizer
+from ChatHistory import HistoryManager
+from RequestMetrics import RequestMetrics
+from ChatJournal import ConversationJournal, new_journal_path, is_journal, import_conversation, read_conversation, group_turns
+
+# One conversation, in its own tab of the chat window. Each has its own
+# messages, history summary, autosave journal and worker thread, so questions
+# asked in different tabs are answered at the same time. The settings, the
+# selected pages and the system message made from them belong to the window and
+# are shared by every tab. Every request waits for a slot in the client (see
+# OpenAIInterface.RequestSlots), so no more are sent at once than the server can handle.
+
+class StreamBuffer:
+    """
+    Text the worker thread has received and the GUI thread hasn't shown yet.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.parts = []
+
+    def put(self, text):
+        with self.lock:
+            self.parts.append(text)
+
+    def take(self):
+        with self.lock:
+            parts = self.parts
+            self.parts = []
+        return "".join(parts)
+
+class WorkerStreamed(QObject):
+    # Tokens are collected in a StreamBuffer rather than sent one signal at a
+    # time, a cross-thread signal and a document edit per token can't keep up
+    # with a fast server. text_ready only goes out for the first token so it's
+    # shown straight away, the tab drains the rest on a timer (see flush_interval).
+    text_ready = pyqtSignal()
+    finished = pyqtSignal()
+    error = pyqtSignal(str)
+
+    def __init__(self, messages, config, prepare=None, use_cache=True, after=None):
+        super().__init__()
+        self.messages = messages
+        self.config = config
+        self.use_cache = use_cache
+        # Optional callable run on the worker thread to produce the messages actually
+        # sent, given the messages, the metrics and the canceller.
+        self.prepare = prepare
+        # Optional callable run on the worker thread once the response is complete,
+        # for work that shouldn't hold up the request.
+        self.after = after
+        # Filled in as the response arrives, the window reads it for the status bar.
+        self.metrics = RequestMetrics()
+        self.canceller = StreamCanceller()
+        self.buffer = StreamBuffer()
+
+    def stop(self):
+        # Called from the GUI thread, the worker's own thread is busy reading the response.
+        self.canceller.cancel()
+
+    def run(self):
+        try:
+            messages = self.prepare(self.messages, self.metrics, self.canceller) if self.prepare else self.messages
+            if self.canceller.is_set():
+                self.finished.emit()
+                return
+            first = True
+            for event in queryLLMStreamed(messages, self.config, self.metrics, self.canceller, self.use_cache):
+                if isinstance(event, StreamError):
+                    self.error.emit(event.message)
+                    return
+                if event.content:
+                    self.buffer.put(event.content)
+                    if first:
+                        first = False
+                        self.text_ready.emit()
+            if self.after:
+                self.after()
+            self.finished.emit()
+        except Exception as e:
+            self.error.emit(str(e))
+
+class SummaryWorker(QObject):
+    # Folds turns that have dropped out of the history budget into the running summary.
+    finished = pyqtSignal(object)
+
+    def __init__(self, messages, config):
+        super().__init__()
+        self.messages = messages
+        self.config = config
+
+    def run(self):
+        # finished has to go out whatever happens, or no more summaries are made.
+        try:
+            response = queryLLM(self.messages, self.config)
+            summary = response["content"] if response else None
+        except Exception as e:
+            print(f"Unable to summarize the conversation: {e}", file=sys.stderr)
+            summary = None
+        self.finished.emit(summary)
+
+class ChatSession(QWidget):
+    # How often the text of a response being streamed is shown
+    flush_interval = 50 # milliseconds
+
+    def __init__(self, chat_window, title):
+        super().__init__()
+        self.chat_window = chat_window
+        self.config = chat_window.config
+        self.title = title
+        # messages[0] is the window's shared system message, it's swapped for the
+        # new one when the pages change but never edited.
+        self.messages = [chat_window.system_context.message]
+        self.response_message = None
+        self.response_parts = []
+        self.history = HistoryManager(self.config)
+        self.prefix_tracker = PrefixTracker()
+        self.thread = None
+        self.worker = None
+        # True once the request has been sent, until then it's waiting for a slot
+        self.streaming = False
+        # Stopped workers that haven't finished unwinding yet
+        self.stopped_threads = []
+        self.flush_timer = QTimer(self)
+        self.flush_timer.setInterval(self.flush_interval)
+        self.flush_timer.timeout.connect(self.flush_text)
+        self.summary_thread = None
+        # Bumped whenever the conversation is replaced, so a summary of the old one is thrown away.
+        self.conversation_id = 0
+        # Where the conversation is autosaved, made when the first turn is finished
+        self.journal = None
+        # Timings of the latest request, shown in the status bar while this tab is the current one
+        self.status = ""
+
+        layout = QVBoxLayout()
+        layout.setContentsMargins(0, 0, 0, 0)
+
+        # Chat display
+        self.chat_display = QTextEdit()
+        self.chat_display.setReadOnly(True)
+        layout.addWidget(self.chat_display)
+        self.transcript = ChatTranscript(self.chat_display, self.messages)
+        self.transcript.load_earlier = self.load_earlier_turns
+
+        # Text input
+        self.text_input = QLineEdit()
+        self.text_input.returnPressed.connect(self.handle_return_pressed)
+        layout.addWidget(self.text_input)
+
+        self.setLayout(layout)
+
+    def busy(self):
+        return self.thread is not None
+
+    def idle(self):
+        # Nothing left running in the background, the tab can be thrown away.
+        return self.thread is None and not self.running_threads()
+
+    def running_threads(self):
+        threads = [thread for thread, _ in self.stopped_threads if not thread.isFinished()]
+        if self.summary_thread is not None:
+            threads.append(self.summary_thread)
+        return threads
+
+    def show_status(self, status):
+        self.status = status
+        self.chat_window.show_session_state(self)
+
+    def add_message(self, message):
+        return self.transcript.append(message)
+
+    def start_response(self, message, cursor):
+        """
+        Begin streaming into message, with cursor at the end of its rendering. The
+        text is collected in a list and only joined into the message when the
+        response ends, see finish_response.
+        """
+        self.response_message = message
+        self.response_parts = []
+        self.response_cursor = cursor
+
+    def append_text(self, text):
+        self.response_parts.append(text)
+        scroll_bar = self.chat_display.verticalScrollBar()
+        at_bottom = scroll_bar.value() >= scroll_bar.maximum() - 4
+        self.response_cursor.insertText(text)
+        if at_bottom:
+            scroll_bar.setValue(scroll_bar.maximum())
+
+    def finish_response(self):
+        if self.response_message is not None:
+            self.response_message["content"] += "".join(self.response_parts)
+            self.response_message = None
+            self.response_parts = []
+
+    def handle_return_pressed(self):
+        user_text = self.text_input.text()
+        self.text_input.clear()
+
+        user_message = {"role": "user", "content": user_text}
+        self.add_message(user_message)
+        assistant_message = {"role": "assistant", "content": ""}
+        self.start_response(assistant_message, self.add_message(assistant_message))
+
+        self.text_input.setDisabled(True)  # Disable the input field
+        self.text_input.setText("(Waiting for the server...)")
+        self.chat_window.cancel_warm_up()
+
+        self.thread = QThread()
+        self.worker = WorkerStreamed(list(self.messages), self.config, self.chat_window.request_preparer(self),
+                                     self.chat_window.use_cache_action.isChecked(), self.count_prefix_tokens)
+        self.worker.moveToThread(self.thread)
+
+        self.worker.text_ready.connect(self.on_llm_response)
+        self.worker.finished.connect(self.on_llm_response_complete)
+        self.worker.error.connect(self.on_llm_error)
+        self.thread.started.connect(self.worker.run)
+        self.thread.start()
+        # The timer also notices when the request is sent, see flush_text.
+        self.flush_timer.start()
+        self.chat_window.show_session_state(self)
+
+    def on_llm_response(self):
+        # The first token, the rest are picked up by the timer.
+        self.streaming = True
+        self.flush_text()
+        self.text_input.setText("(Responding...)")
+
+    def flush_text(self):
+        if not self.streaming and self.worker.metrics.started is not None:
+            # It's had its slot and been sent.
+            self.streaming = True
+            self.text_input.setText("(Processing prompt...)")
+            self.chat_window.show_session_state(self, header=False)
+        text = self.worker.buffer.take()
+        if text:
+            self.append_text(text)
+            # Only the timings change while it streams, the header waits for the end of the turn.
+            self.status = self.worker.metrics.summary()
+            self.chat_window.show_session_status(self)
+
+    def on_llm_response_complete(self):
+        self.flush_text()
+        self.finish_response()
+        self.journal_turn()
+        if self.worker.metrics.status == "cached":
+            self.transcript.append_note("(Answered from the response cache)")
+        self.end_response()
+        self.thread.wait()
+        self.thread = None
+        self.show_status(self.worker.metrics.summary())
+        self.start_summary()
+
+    def on_llm_error(self, error_message):
+        self.flush_text()
+        self.finish_response()
+        self.journal_turn()
+        self.transcript.append_note(error_message)
+        self.end_response()
+        self.thread.wait()
+        self.thread = None
+        self.chat_window.show_session_state(self)
+
+    def end_response(self):
+        self.flush_timer.stop()
+        self.text_input.setDisabled(False)  # Re-enable the input field
+        self.text_input.setText("")
+        self.thread.quit()
+        self.streaming = False
+
+    def stop_response(self):
+        """
+        Abandon the response being streamed, keeping what's arrived so far. The
+        connection is dropped so the server stops generating, and the worker is
+        left to unwind on its own so a new question can be asked straight away.
+        A request that hasn't been sent yet is simply dropped, and its question
+        put back in the input box.
+        """
+        if self.thread is None:
+            return
+        self.reap_stopped_threads()
+        self.worker.stop()
+        self.worker.text_ready.disconnect()
+        self.worker.finished.disconnect()
+        self.worker.error.disconnect()
+        sent = self.streaming or self.worker.metrics.started is not None
+        if sent:
+            # Whatever has arrived is kept.
+            self.flush_text()
+            self.finish_response()
+            self.journal_turn()
+        else:
+            self.response_message = None
+            self.response_parts = []
+            user_message = self.messages[-2]
+            del self.messages[-2:]
+            self.transcript.truncate()
+        self.end_response()
+        self.stopped_threads.append((self.thread, self.worker))
+        self.thread.finished.connect(self.reap_stopped_threads)
+        self.thread = None
+        if sent:
+            self.show_status(self.worker.metrics.summary() + ", stopped")
+            self.start_summary()
+        else:
+            self.text_input.setText(user_message["content"])
+            self.show_status("Stopped before it was sent")
+
+    def reap_stopped_threads(self):
+        self.stopped_threads = [(thread, worker) for thread, worker in self.stopped_threads if not thread.isFinished()]
+
+    def start_summary(self):
+        """
+        If turns have fallen out of the history budget, summarize them in the
+        background. Only one summary is worked on at a time, anything still
+        pending is picked up after the next response.
+        """
+        if self.summary_thread is not None:
+            return
+        messages, summarized_count = self.history.pending_summary(self.messages)
+        if not messages:
+            return
+        self.summary_thread = QThread()
+        self.summary_worker = SummaryWorker(self.history.summary_request(messages), self.config)
+        self.summary_worker.moveToThread(self.summary_thread)
+        conversation_id = self.conversation_id
+        # Counted from the start of the whole conversation, older turns may be read in meanwhile.
+        summarized_count += self.unloaded_messages()
+        self.summary_worker.finished.connect(lambda summary: self.on_summary_complete(summary, summarized_count, conversation_id))
+        self.summary_thread.started.connect(self.summary_worker.run)
+        self.summary_thread.start()
+
+    def on_summary_complete(self, summary, summarized_count, conversation_id):
+        self.summary_thread.quit()
+        self.summary_thread.wait()
+        self.summary_thread = None
+        summarized_count -= self.unloaded_messages()
+        # Undo may have removed some of what was summarized while the request was out.
+        if summary and conversation_id == self.conversation_id and summarized_count <= len(self.messages) - 1:
+            self.history.reset(summary, summarized_count)
+            self.chat_window.show_session_state(self)
+            if self.journal is not None:
+                try:
+                    self.journal.write_summary(self.journal_summary())
+                except OSError as e:
+                    print(f"Unable to autosave the conversation: {e}")
+        elif not summary:
+            print("Unable to summarize the conversation history")
+
+    def set_system_message(self, message):
+        # In place, the transcript has the same list.
+        self.messages[0] = message
+
+    def count_prefix_tokens(self):
+        # Run on the worker thread after the response, so a server tokenizer isn't
+        # asked to count the whole prompt before it's sent. Messages are counted
+        # once each; the window's system message was counted when it was made.
+        system_context = self.chat_window.system_context
+        def count(message):
+            if message is system_context.message:
+                return system_context.tokens + 4
+            return self.history.count(message)
+        self.prefix_tracker.count_tokens(count)
+
+    def history_token_count(self):
+        # Only what will actually be sent counts, the summary included. The system
+        # message is counted once by the window, so only what's added to it is counted here.
+        sent = self.history.request_messages(self.messages)
+        added = sent[0]["content"][len(self.messages[0]["content"]):]
+        return sum(self.history.count(message) for message in sent[1:]) + (get_tokenizer(self.config).count(added) if added else 0)
+
+    def journal_dir(self):
+        return self.chat_window.journal_dir()
+
+    def unloaded_messages(self):
+        return self.journal.unloaded_messages if self.journal is not None else 0
+
+    def journal_summary(self):
+        summary = self.history.to_json()
+        summary["messages"] += self.unloaded_messages()
+        return summary
+
+    def journal_turn(self):
+        """
+        Autosave the turn that just finished, the last question and its answer.
+        """
+        if not self.journal_dir():
+            return
+        try:
+            if self.journal is None:
+                self.journal = ConversationJournal.create(new_journal_path(self.journal_dir()), group_turns(self.messages[1:-2]))
+            self.journal.append_turn(self.messages[-2:])
+        except OSError as e:
+            print(f"Unable to autosave the conversation: {e}")
+
+    def load_earlier_turns(self, turns=20):
+        """
+        Read older turns of a journal into the start of the conversation, returns how many messages were added.
+        """
+        if self.journal is None or not self.journal.loaded_from:
+            return 0
+        try:
+            messages = self.journal.load_earlier(turns)
+        except (OSError, ValueError) as e:
+            print(f"Unable to read {self.journal.path}: {e}")
+            return 0
+        # In place, the transcript has the same list. Turns are only left on disk
+        # when they're in the summary, so these are too.
+        self.messages[1:1] = messages
+        if self.history.summary:
+            self.history.summarized_count += len(messages)
+        return len(messages)
+
+    def save_conversation(self):
+        fileName, _ = QFileDialog.getSaveFileName(self, "Save Conversation", "", "Conversation Files (*.jsonl);;All Files (*)")
+        if fileName:
+            if self.journal is not None and self.journal_dir():
+                # Carries on autosaving into the new file.
+                self.journal = self.journal.save_as(fileName, self.journal_summary())
+            else:
+                # Without autosave a journal from an earlier Save or Open stops there,
+                # only the turns not read in yet are taken from it.
+                loaded_from = self.journal.loaded_from if self.journal is not None else 0
+                earlier = self.journal.read_turns(0, loaded_from) if loaded_from else []
+                journal = ConversationJournal.create(fileName, group_turns(earlier) + group_turns(self.messages[1:]),
+                                                     self.journal_summary())
+                journal.loaded_from = loaded_from
+                self.journal = journal
+            self.title = os.path.splitext(os.path.basename(fileName))[0]
+            self.chat_window.show_session_state(self)
+
+    def load_conversation(self):
+        fileName, _ = QFileDialog.getOpenFileName(self, "Load Conversation", "", "Conversation Files (*.jsonl *.conv);;All Files (*)")
+        if fileName:
+            self.open_conversation(fileName)
+
+    def open_conversation(self, fileName):
+        try:
+            if is_journal(fileName):
+                journal = ConversationJournal(fileName)
+            elif self.journal_dir():
+                # Saved by an older version, converted so it's autosaved from here on.
+                journal = import_conversation(fileName, new_journal_path(self.journal_dir()))
+            else:
+                # Without autosave nothing is written until it's saved.
+                journal = None
+                messages, summary = read_conversation(fileName)
+            if journal is not None:
+                # Without a history budget every message is sent, so all of them are needed.
+                messages, summary = journal.open(load_all=not self.history.budget())
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Unable to load conversation {fileName}: {e}")
+            return
+        self.journal = journal
+        self.messages = [self.messages[0]] + messages
+        self.conversation_id += 1
+        self.history.from_json(summary)
+        self.transcript.set_messages(self.messages)
+        self.title = os.path.splitext(os.path.basename(fileName))[0]
+        self.chat_window.show_session_state(self)
+
+    def new_conversation(self):
+        self.messages = [self.messages[0]]
+        self.conversation_id += 1
+        self.journal = None
+        self.history.reset()
+        self.transcript.set_messages(self.messages)
+        self.chat_window.show_session_state(self)
+
+    def roll_back(self):
+        if self.busy():
+            return
+        if self.journal is not None and self.journal.loaded_from and len(self.messages) - 3 < self.history.summarized_count:
+            # Undoing into the summary throws it away, the turns it covered have to be read back in.
+            self.transcript.first_rendered += self.load_earlier_turns(len(self.journal.turns))
+        if len(self.messages) >= 3:
+            self.messages.pop() #delete last response
+            user_message = self.messages.pop()
+            self.text_input.setText(user_message["content"])
+            self.transcript.truncate()
+            # As with journal_turn, a journal from Save or Open is only kept up to date while autosaving.
+            if self.journal is not None and self.journal_dir():
+                try:
+                    self.journal.roll_back()
+                except OSError as e:
+                    print(f"Unable to autosave the conversation: {e}")
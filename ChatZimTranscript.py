@@ -0,0 +1,133 @@
+from PyQt6.QtGui import QTextCursor, QTextCharFormat, QColor, QFont
+
+role_info = {"user":{"color":"#ff0000", "name":"User"},
+             "assistant":{"color":"#0000ff", "name":"Assistant"}
+             }
+
+class ChatTranscript:
+    """
+    Keeps the chat display in step with the conversation's message list without
+    ever re-rendering it wholesale. A QTextCursor is held at the start of each
+    rendered message; Qt moves those along as the document changes, so the text of
+    any message can be found and trailing messages removed directly.
+
+    Long conversations are rendered lazily: only the newest messages at first,
+    with older ones filled in above them as the view is scrolled to the top.
+    messages is the window's list, index 0 (the system message) is never shown.
+    Once everything in it is shown, load_earlier (if set) is called to insert
+    older messages from disk at the start of the list, it returns how many.
+    """
+    def __init__(self, text_edit, messages, initial_messages=40, batch_messages=40):
+        self.text_edit = text_edit
+        self.document = text_edit.document()
+        self.messages = messages
+        self.initial_messages = initial_messages
+        self.batch_messages = batch_messages
+        # Index into messages of the oldest rendered message, and a cursor at the
+        # start of each rendered message from there on.
+        self.first_rendered = 1
+        self.starts = []
+        self.load_earlier = None
+        self.text_edit.verticalScrollBar().valueChanged.connect(self.on_scroll)
+
+    def role_format(self, role):
+        role_format = QTextCharFormat()
+        role_format.setFontWeight(QFont.Weight.Bold)
+        role_format.setForeground(QColor(role_info[role]["color"]))
+        return role_format
+
+    def _insert_message(self, cursor, message):
+        cursor.insertText(f'{role_info[message["role"]]["name"]}:', self.role_format(message["role"]))
+        cursor.insertText(f' {message["content"]}', QTextCharFormat())
+
+    def _cursor_at(self, position):
+        cursor = QTextCursor(self.document)
+        cursor.setPosition(position)
+        return cursor
+
+    def set_messages(self, messages):
+        """
+        Show a whole new conversation, only the newest messages are rendered.
+        """
+        self.messages = messages
+        self.document.clear()
+        self.starts = []
+        self.first_rendered = max(1, len(messages) - self.initial_messages)
+        for message in messages[self.first_rendered:]:
+            self.append(message, add_to_messages=False)
+        scroll_bar = self.text_edit.verticalScrollBar()
+        scroll_bar.setValue(scroll_bar.maximum())
+
+    def append(self, message, add_to_messages=True):
+        """
+        Render a message at the end, returns a cursor at the end of it to stream more text in with.
+        """
+        if add_to_messages:
+            self.messages.append(message)
+        cursor = QTextCursor(self.document)
+        cursor.movePosition(QTextCursor.MoveOperation.End)
+        if not self.document.isEmpty():
+            cursor.insertBlock()
+        start = cursor.position()
+        self._insert_message(cursor, message)
+        self.starts.append(self._cursor_at(start))
+        return cursor
+
+    def append_note(self, text):
+        # Something that isn't part of the conversation, like an error. It belongs
+        # with the message before it and goes if that message is removed.
+        cursor = QTextCursor(self.document)
+        cursor.movePosition(QTextCursor.MoveOperation.End)
+        cursor.insertBlock()
+        cursor.insertText(text, QTextCharFormat())
+
+    def truncate(self):
+        """
+        Remove the rendering of any messages that are no longer in the message list.
+        """
+        keep = len(self.messages) - self.first_rendered
+        if keep < 0:
+            self.set_messages(self.messages)
+            return
+        if keep >= len(self.starts):
+            return
+        start = self.starts[keep].position()
+        cursor = self._cursor_at(max(0, start - 1)) # include the block separator before it
+        cursor.movePosition(QTextCursor.MoveOperation.End, QTextCursor.MoveMode.KeepAnchor)
+        cursor.removeSelectedText()
+        del self.starts[keep:]
+
+    def load_older(self):
+        """
+        Render the next batch of older messages above the ones already shown,
+        keeping the view where it was.
+        """
+        if self.first_rendered <= 1:
+            return
+        scroll_bar = self.text_edit.verticalScrollBar()
+        old_maximum = scroll_bar.maximum()
+        old_value = scroll_bar.value()
+
+        first = max(1, self.first_rendered - self.batch_messages)
+        cursor = QTextCursor(self.document)
+        cursor.beginEditBlock()
+        new_starts = []
+        for message in self.messages[first:self.first_rendered]:
+            start = cursor.position()
+            self._insert_message(cursor, message)
+            cursor.insertBlock()
+            new_starts.append(start)
+        cursor.endEditBlock()
+        # Made after the inserting is done, so they stay where the messages begin.
+        self.starts[:0] = [self._cursor_at(start) for start in new_starts]
+        self.first_rendered = first
+
+        scroll_bar.setValue(old_value + scroll_bar.maximum() - old_maximum)
+
+    def on_scroll(self, value):
+        if value != self.text_edit.verticalScrollBar().minimum():
+            return
+        if self.first_rendered <= 1 and self.load_earlier is not None:
+            self.first_rendered += self.load_earlier()
+        if self.first_rendered > 1:
+            self.load_older()
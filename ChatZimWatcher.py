@@ -0,0 +1,125 @@
+import os
+
+from PyQt6.QtCore import QObject, QFileSystemWatcher, QTimer, pyqtSignal
+
+class NotebookWatcher(QObject):
+    """
+    Watches a notebook for pages being added, removed or edited and reports the
+    pages that may have changed, relative to the notebook root, once a burst of
+    changes has settled (Zim saves as you type). Every directory is watched for
+    pages coming and going, but only the given pages, normally the selected
+    ones, are watched for edits; the rest get picked up by the next full scan.
+    """
+    pages_changed = pyqtSignal(list)
+
+    def __init__(self, parent=None, debounce_ms=500):
+        super().__init__(parent)
+        self.root_path = None
+        # Page file names in each watched directory, to tell what came and went
+        self.directory_pages = {}
+        # (mtime_ns, size) of each watched page as last reported
+        self.file_stats = {}
+        self.pending = set()
+        self.watcher = QFileSystemWatcher(self)
+        self.watcher.directoryChanged.connect(self.on_directory_changed)
+        self.watcher.fileChanged.connect(self.on_file_changed)
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.setInterval(debounce_ms)
+        self.timer.timeout.connect(self.flush)
+
+    def watch(self, root_path, relative_paths):
+        """
+        Watch root_path and the given pages in it, only what's different from the last call is changed.
+        """
+        if root_path != self.root_path:
+            self.stop()
+            self.root_path = root_path
+            if root_path is None or not os.path.isdir(root_path):
+                return
+            for directory, dirs, files in os.walk(root_path):
+                dirs[:] = [name for name in dirs if not name.startswith(".")]
+                self.add_directory(directory, files)
+        if self.root_path is None:
+            return
+        wanted = {os.path.join(self.root_path, relative_path) for relative_path in relative_paths}
+        watched = set(self.watcher.files())
+        if watched - wanted:
+            self.watcher.removePaths(list(watched - wanted))
+            for file_path in watched - wanted:
+                self.file_stats.pop(file_path, None)
+        missing = [file_path for file_path in wanted - watched if os.path.exists(file_path)]
+        if missing:
+            self.watcher.addPaths(missing)
+            for file_path in missing:
+                self.stat_changed(file_path)
+
+    def stop(self):
+        self.timer.stop()
+        self.pending.clear()
+        self.directory_pages = {}
+        self.file_stats = {}
+        paths = self.watcher.files() + self.watcher.directories()
+        if paths:
+            self.watcher.removePaths(paths)
+        self.root_path = None
+
+    def add_directory(self, directory, files):
+        self.directory_pages[directory] = {file for file in files if file.endswith(".txt")}
+        self.watcher.addPath(directory)
+
+    def stat_changed(self, file_path):
+        """
+        Whether the page's mtime or size is different from when this was last asked.
+        """
+        try:
+            stat = os.stat(file_path)
+            file_stat = (stat.st_mtime_ns, stat.st_size)
+        except OSError:
+            file_stat = None
+        changed = self.file_stats.get(file_path) != file_stat
+        self.file_stats[file_path] = file_stat
+        return changed
+
+    def on_directory_changed(self, directory):
+        old_pages = self.directory_pages.get(directory, set())
+        try:
+            entries = list(os.scandir(directory))
+        except OSError:
+            # The directory itself went, along with everything in it.
+            for watched in [path for path in self.directory_pages if path == directory or path.startswith(directory + os.sep)]:
+                self.pending.update(os.path.join(watched, name) for name in self.directory_pages.pop(watched))
+            self.timer.start()
+            return
+        new_pages = {entry.name for entry in entries if entry.is_file() and entry.name.endswith(".txt")}
+        for entry in entries:
+            # Hidden folders aren't namespaces
+            if entry.is_dir() and not entry.name.startswith(".") and entry.path not in self.directory_pages:
+                # A new namespace, and possibly pages already in it
+                for subdirectory, dirs, files in os.walk(entry.path):
+                    dirs[:] = [name for name in dirs if not name.startswith(".")]
+                    self.add_directory(subdirectory, files)
+                    self.pending.update(os.path.join(subdirectory, file) for file in files if file.endswith(".txt"))
+        self.directory_pages[directory] = new_pages
+        self.pending.update(os.path.join(directory, name) for name in old_pages ^ new_pages)
+        # A page saved by replacing the file shows up here too. Anything else
+        # coming and going (such as the index's own journal file) is ignored.
+        self.pending.update(path for path in self.watcher.files()
+                            if os.path.dirname(path) == directory and self.stat_changed(path))
+        if self.pending:
+            self.timer.start()
+
+    def on_file_changed(self, file_path):
+        self.stat_changed(file_path)
+        self.pending.add(file_path)
+        # Files replaced rather than written to drop out of the watch, put them back.
+        if os.path.exists(file_path) and file_path not in self.watcher.files():
+            self.watcher.addPath(file_path)
+        self.timer.start()
+
+    def flush(self):
+        if not self.pending or self.root_path is None:
+            return
+        relative_paths = sorted(os.path.relpath(path, self.root_path) for path in self.pending)
+        self.pending.clear()
+        self.pages_changed.emit(relative_paths)
@@ -0,0 +1,292 @@
+import hashlib
+import json
+import os
+import sys
+import threading
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from OpenAIInterface import queryEmbeddings
+from ZimPageScanner import read_page_body
+from ZimRetrieval import chunk_page
+from BM25Index import terms
+
+# Semantic retrieval: chunks of the notebook are embedded through the server's
+# /v1/embeddings endpoint and the vectors kept in a flat float32 file that's
+# memory mapped, so even a very large notebook opens instantly and only the
+# parts of the matrix a query touches get paged in. A JSON sidecar maps each
+# row back to its page and chunk. Needs numpy.
+
+vectors_filename = ".chatzim_embeddings.f32"
+meta_filename = ".chatzim_embeddings.json"
+store_version = 1
+
+def chunk_hash(text):
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+class RemoteEmbedder:
+    """
+    Embeds through the OpenAI compatible embeddings endpoint, batch_size texts per request.
+    """
+    def __init__(self, config, batch_size=64):
+        self.config = config
+        self.batch_size = batch_size
+        self.name = f"remote:{config.get('embedding_model') or config.get('model') or ''}"
+
+    def embed(self, texts):
+        vectors = []
+        for start in range(0, len(texts), self.batch_size):
+            vectors.extend(queryEmbeddings(texts[start:start + self.batch_size], self.config))
+        return np.asarray(vectors, dtype=np.float32)
+
+class HashingEmbedder:
+    """
+    Local stand-in for an embedding model: hashes terms into a fixed size vector.
+    Only as good as keyword overlap, but needs no server, which makes it handy for
+    trying the machinery out.
+    """
+    def __init__(self, dimensions=256):
+        self.dimensions = dimensions
+        self.name = f"hashing:{dimensions}"
+
+    def embed(self, texts):
+        vectors = np.zeros((len(texts), self.dimensions), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for term in terms(text):
+                digest = hashlib.md5(term.encode("utf-8")).digest()
+                bucket = int.from_bytes(digest[:4], "little") % self.dimensions
+                vectors[row, bucket] += 1.0 if digest[4] & 1 else -1.0
+        return vectors
+
+def get_embedder(config):
+    if config.get("embeddings") == "local":
+        return HashingEmbedder()
+    return RemoteEmbedder(config, config.get("embedding_batch_size", 64))
+
+def normalize(vectors):
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+class EmbeddingStore:
+    """
+    Row oriented store of unit length vectors. Rows are appended to the end of the
+    vectors file; removed rows are zeroed and dropped by compact().
+    rows[i] is [relative_path, chunk_index, hash] or None for a free row.
+    """
+    def __init__(self, vectors_path, meta_path, model):
+        self.vectors_path = vectors_path
+        self.meta_path = meta_path
+        self.model = model
+        self.dimensions = None
+        self.rows = []
+        # relative_path -> [mtime_ns, size, [row ids]]
+        self.pages = {}
+        self.vectors = None
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.meta_path, "r", encoding="utf-8") as file:
+                meta = json.load(file)
+            if meta["version"] == store_version and meta["model"] == self.model:
+                self.dimensions = meta["dimensions"]
+                self.rows = meta["rows"]
+                self.pages = meta["pages"]
+                self._map()
+                return
+        except (OSError, ValueError, KeyError):
+            pass
+        # Missing, stale or for a different model, start over.
+        self.dimensions = None
+        self.rows = []
+        self.pages = {}
+        if os.path.exists(self.vectors_path):
+            os.remove(self.vectors_path)
+
+    def _map(self):
+        if not self.rows:
+            self.vectors = None
+            return
+        expected = len(self.rows) * self.dimensions * 4
+        if not os.path.exists(self.vectors_path) or os.path.getsize(self.vectors_path) != expected:
+            raise ValueError("Embedding vectors don't match their index")
+        self.vectors = np.memmap(self.vectors_path, dtype=np.float32, mode="r+", shape=(len(self.rows), self.dimensions))
+
+    def save(self):
+        if self.vectors is not None:
+            self.vectors.flush()
+        meta = {"version": store_version, "model": self.model, "dimensions": self.dimensions,
+                "rows": self.rows, "pages": self.pages}
+        with open(self.meta_path, "w", encoding="utf-8") as file:
+            json.dump(meta, file)
+
+    def append(self, vectors, rows):
+        """
+        Add vectors (already normalized) with their row metadata, returns the new row ids.
+        """
+        if len(rows) == 0:
+            return []
+        if self.dimensions is None:
+            self.dimensions = vectors.shape[1]
+        first = len(self.rows)
+        # Flush and drop the old mapping before growing the file underneath it.
+        if self.vectors is not None:
+            self.vectors.flush()
+            self.vectors = None
+        with open(self.vectors_path, "ab") as file:
+            file.write(np.ascontiguousarray(vectors, dtype=np.float32).tobytes())
+        self.rows.extend(rows)
+        self._map()
+        return list(range(first, len(self.rows)))
+
+    def free(self, row_ids):
+        for row_id in row_ids:
+            self.rows[row_id] = None
+            self.vectors[row_id] = 0.0
+
+    def free_rows(self):
+        return sum(1 for row in self.rows if row is None)
+
+    def compact(self):
+        """
+        Rewrite the vectors file without the free rows.
+        """
+        live = [row_id for row_id, row in enumerate(self.rows) if row is not None]
+        remap = {old: new for new, old in enumerate(live)}
+        vectors = np.array(self.vectors[live]) if live else np.zeros((0, self.dimensions or 0), dtype=np.float32)
+        self.vectors = None
+        with open(self.vectors_path, "wb") as file:
+            file.write(vectors.tobytes())
+        self.rows = [self.rows[row_id] for row_id in live]
+        for page in self.pages.values():
+            page[2] = [remap[row_id] for row_id in page[2]]
+        self._map()
+
+    def search(self, query_vector, top_k):
+        """
+        The top_k rows by dot product with query_vector as (score, row id), best first.
+        """
+        if self.vectors is None:
+            return []
+        scores = self.vectors @ query_vector
+        # Free rows are zeroed, but a score of 0 can still beat a live row's, so
+        # rule them out rather than filtering them from the top_k afterwards.
+        free = [row_id for row_id, row in enumerate(self.rows) if row is None]
+        if free:
+            scores[free] = -np.inf
+        top_k = min(top_k, len(scores) - len(free))
+        if top_k <= 0:
+            return []
+        best = np.argpartition(-scores, top_k - 1)[:top_k]
+        best = best[np.argsort(-scores[best])]
+        return [(float(scores[row_id]), int(row_id)) for row_id in best]
+
+class SemanticRetriever:
+    """
+    Same interface as ZimRetrieval.NotebookRetriever, ranking chunks by embedding
+    similarity instead of BM25. Chunks are only embedded when their content hash
+    isn't in the store already.
+    """
+    def __init__(self, root_path, embedder, chunk_words=200):
+        if np is None:
+            raise RuntimeError("Semantic retrieval needs numpy installed")
+        self.root_path = root_path
+        self.embedder = embedder
+        self.chunk_words = chunk_words
+        self.lock = threading.Lock()
+        self.store = EmbeddingStore(os.path.join(root_path, vectors_filename),
+                                    os.path.join(root_path, meta_filename),
+                                    f"{embedder.name}/{chunk_words}")
+
+    def refresh(self, relative_paths):
+        with self.lock:
+            store = self.store
+            wanted = set(relative_paths)
+            changed = False
+            for relative_path in list(store.pages):
+                if relative_path not in wanted:
+                    store.free(store.pages.pop(relative_path)[2])
+                    changed = True
+
+            # Chunk every new or modified page first so that the new chunks of all
+            # of them go to the server in full batches.
+            updates = []
+            for relative_path in wanted:
+                file_path = os.path.join(self.root_path, relative_path)
+                try:
+                    stat = os.stat(file_path)
+                    page = store.pages.get(relative_path)
+                    if page is not None and page[0] == stat.st_mtime_ns and page[1] == stat.st_size:
+                        continue
+                    chunks = chunk_page(read_page_body(file_path), self.chunk_words)
+                except (OSError, UnicodeDecodeError) as e:
+                    print(f"Unable to read page {relative_path}: {e}", file=sys.stderr)
+                    continue
+                updates.append((relative_path, stat, [chunk_hash(text) for text in chunks], chunks))
+
+            if updates:
+                # Vectors already in the store, by chunk content, so edited pages only
+                # need their new or altered chunks embedded. Only the chunks being
+                # stored are looked up, and copied since store.vectors is a memory
+                # map and freeing a page zeroes its rows.
+                needed = {text_hash for _, _, hashes, _ in updates for text_hash in hashes}
+                known = {}
+                for row_id, row in enumerate(store.rows):
+                    if row is not None and row[2] in needed and row[2] not in known:
+                        known[row[2]] = np.array(store.vectors[row_id])
+                pending = {}
+                for relative_path, stat, hashes, chunks in updates:
+                    for text_hash, text in zip(hashes, chunks):
+                        if text_hash not in known:
+                            pending[text_hash] = text
+                if pending:
+                    embedded = normalize(self.embedder.embed(list(pending.values())))
+                    known.update(zip(pending, embedded))
+
+                rows = []
+                vectors = []
+                for relative_path, stat, hashes, chunks in updates:
+                    page = store.pages.get(relative_path)
+                    if page is not None:
+                        store.free(page[2])
+                    first = len(store.rows) + len(rows)
+                    rows.extend([relative_path, chunk_index, text_hash] for chunk_index, text_hash in enumerate(hashes))
+                    vectors.extend(known[text_hash] for text_hash in hashes)
+                    store.pages[relative_path] = [stat.st_mtime_ns, stat.st_size, list(range(first, first + len(hashes)))]
+                if rows:
+                    store.append(np.array(vectors, dtype=np.float32), rows)
+                changed = True
+
+            if changed:
+                if store.free_rows() > len(store.rows) // 2:
+                    store.compact()
+                store.save()
+            return changed
+
+    def retrieve(self, query, tokenizer, token_budget, top_k=8):
+        with self.lock:
+            query_vector = normalize(self.embedder.embed([query]))[0]
+            results = []
+            used = 0
+            page_chunks = {}
+            for score, row_id in self.store.search(query_vector, top_k):
+                relative_path, chunk_index, _ = self.store.rows[row_id]
+                if relative_path not in page_chunks:
+                    try:
+                        page_chunks[relative_path] = chunk_page(read_page_body(os.path.join(self.root_path, relative_path)), self.chunk_words)
+                    except (OSError, UnicodeDecodeError):
+                        page_chunks[relative_path] = []
+                chunks = page_chunks[relative_path]
+                if chunk_index >= len(chunks):
+                    continue
+                text = chunks[chunk_index]
+                tokens = tokenizer.count(text)
+                if used + tokens > token_budget:
+                    continue
+                used += tokens
+                results.append((relative_path, text))
+            return results
@@ -0,0 +1,173 @@
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# A stand-in for an OpenAI compatible LLM server, for benchmarking and trying
+# ChatZim out without a model loaded. Speaks /v1/chat/completions, streamed (SSE)
+# or not, plus KoboldCPP's token count endpoint. How fast it answers and how
+# often it fails can be set, see MockOpenAIServer. Run it on its own with
+# "python MockOpenAIServer.py" (see --help) and point ChatZim's API URL at it.
+
+filler = ("the dragon castle sword tavern goblin wizard quest treasure village king "
+          "forest river mountain dungeon spell potion knight ranger cleric rogue").split()
+
+class MockRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Otherwise the separate header and body writes stall on delayed ACKs.
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, data, status=200):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        mock = self.server.mock
+        request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        mock.count_request()
+        if self.path.endswith("/api/extra/tokencount"):
+            self.send_json({"value": len(request.get("prompt", "").split())})
+            return
+        if not self.path.endswith("/chat/completions"):
+            self.send_json({"error": "not found"}, 404)
+            return
+        if mock.roll(mock.error_rate):
+            self.send_json({"error": {"message": "injected error"}}, mock.error_status)
+            return
+
+        tokens = mock.reply_tokens(request)
+        prompt_tokens = sum(len(message.get("content", "").split()) for message in request.get("messages", []))
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": len(tokens)}
+        started = time.perf_counter()
+        if not request.get("stream"):
+            mock.wait_until(started + mock.ttft + len(tokens) * mock.token_interval())
+            self.send_json({"choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(tokens)},
+                                         "finish_reason": "stop"}], "usage": usage})
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        # Nothing says when the stream ends other than closing the connection.
+        self.close_connection = True
+        disconnect_at = len(tokens) // 2 if mock.roll(mock.disconnect_rate) else None
+        interval = mock.token_interval()
+        first = started + mock.ttft
+        try:
+            for start in range(0, len(tokens), mock.chunk_tokens):
+                if disconnect_at is not None and start >= disconnect_at:
+                    return
+                mock.wait_until(first + start * interval)
+                chunk = {"choices": [{"index": 0, "delta": {"content": "".join(tokens[start:start + mock.chunk_tokens])},
+                                      "finish_reason": None}]}
+                self.wfile.write(b"data: " + json.dumps(chunk).encode("utf-8") + b"\n\n")
+            final = {"choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}], "usage": usage}
+            self.wfile.write(b"data: " + json.dumps(final).encode("utf-8") + b"\n\ndata: [DONE]\n\n")
+        except (BrokenPipeError, ConnectionResetError):
+            # The client hung up, a real server would stop generating here.
+            mock.count_hang_up()
+
+class MockOpenAIServer:
+    """
+    ttft is the delay before the first token, tokens_per_second the pace after it
+    (0 for as fast as possible), chunk_tokens how many tokens go in each SSE event.
+    Replies are reply_tokens long, or max_completion_tokens if the request asks for
+    fewer. error_rate is the fraction of chat requests answered with error_status
+    and disconnect_rate the fraction of streams cut off halfway through.
+    """
+    def __init__(self, ttft=0.0, tokens_per_second=0, chunk_tokens=1, reply_tokens=200,
+                 error_rate=0.0, error_status=500, disconnect_rate=0.0, port=0, seed=None):
+        self.ttft = ttft
+        self.tokens_per_second = tokens_per_second
+        self.chunk_tokens = max(1, chunk_tokens)
+        self.reply_length = reply_tokens
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.disconnect_rate = disconnect_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.hang_ups = 0
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), MockRequestHandler)
+        self.server.daemon_threads = True
+        self.server.mock = self
+        self.thread = None
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server.server_address[1]}/v1/chat/completions"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def count_request(self):
+        with self.lock:
+            self.requests += 1
+
+    def count_hang_up(self):
+        with self.lock:
+            self.hang_ups += 1
+
+    def roll(self, rate):
+        with self.lock:
+            return rate > 0 and self.random.random() < rate
+
+    def token_interval(self):
+        return 1.0 / self.tokens_per_second if self.tokens_per_second else 0.0
+
+    def reply_tokens(self, request):
+        count = min(self.reply_length, request.get("max_completion_tokens") or request.get("max_tokens") or self.reply_length)
+        return [f" {filler[index % len(filler)]}" for index in range(count)]
+
+    @staticmethod
+    def wait_until(deadline):
+        delay = deadline - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a mock OpenAI compatible chat server.")
+    parser.add_argument("--port", type=int, default=5001)
+    parser.add_argument("--ttft", type=float, default=0.5, help="seconds before the first token")
+    parser.add_argument("--tokens-per-second", type=float, default=30, help="0 for as fast as possible")
+    parser.add_argument("--chunk-tokens", type=int, default=1, help="tokens per SSE event")
+    parser.add_argument("--reply-tokens", type=int, default=200)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--error-status", type=int, default=500)
+    parser.add_argument("--disconnect-rate", type=float, default=0.0)
+    args = parser.parse_args()
+
+    server = MockOpenAIServer(args.ttft, args.tokens_per_second, args.chunk_tokens, args.reply_tokens,
+                              args.error_rate, args.error_status, args.disconnect_rate, args.port)
+    print(f"Serving on {server.url}")
+    try:
+        server.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server.server_close()
+
+if __name__ == "__main__":
+    main()
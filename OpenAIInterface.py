@@ -1,85 +1,436 @@
 import json
+import socket
+import sys
+import threading
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from RequestMetrics import RequestMetrics, log_metrics, default_metrics_log
+from ResponseCache import ResponseCache, request_key
+from SSEParser import SSEParser, StreamDelta, StreamError, chat_event, json_loads
 
 #Documentation: https://platform.openai.com/docs/api-reference/chat/create
 #https://platform.openai.com/docs/api-reference/models
 
-def queryLLM(messages, config):
-    max_length = config.get("max_length", 1024)
-    generateUrl = config.get("api_url", "http://localhost:5001/v1/chat/completions")
-    api_key = config.get("api_key")
-    org_id = config.get("org_id")
-    project_id = config.get("project_id")
-    model = config.get("model")
-    headers = {'Content-Type': 'application/json'}
-    if api_key:
-        headers["Authorization"] = f"Bearer {api_key}"
-    if org_id:
-        headers["OpenAI-Organization"] = org_id
-    if project_id:
-        headers["OpenAI-Project"] = project_id
-    
-    # Send the request and get the response
-    try:
+default_api_url = "http://localhost:5001/v1/chat/completions"
+
+class StreamCanceller:
+    """
+    Stops a streamed request from another thread. The socket is shut down rather
+    than just closed, which wakes up a read blocked on it straight away and lets
+    the server see the disconnect and stop generating. If the response hasn't
+    started yet it's shut down as soon as it does.
+    """
+    def __init__(self):
+        self.event = threading.Event()
+        self.lock = threading.Lock()
+        self.response = None
+        self.children = []
+
+    def is_set(self):
+        return self.event.is_set()
+
+    def attach(self, response):
+        with self.lock:
+            self.response = response
+            if self.event.is_set():
+                shutdown_response(response)
+
+    def cancel(self):
+        with self.lock:
+            self.event.set()
+            if self.response is not None:
+                shutdown_response(self.response)
+            children = list(self.children)
+        for child in children:
+            child.cancel()
+
+    def child(self):
+        """
+        A canceller for one of several requests made together, cancelled along with this one.
+        """
+        child = StreamCanceller()
+        with self.lock:
+            self.children.append(child)
+            if self.event.is_set():
+                child.event.set()
+        return child
+
+class RequestSlots:
+    """
+    Caps how many chat requests are sent to the server at once, whatever they're
+    for: the tabs' answers, history summaries, warm-ups and map-reduce's parts all
+    wait here for a slot, in the order they asked. More than the server has slots
+    for would only be queued (or slowed down) by the server instead, where they
+    can't be stopped before they start.
+    """
+    # How often a waiting request checks whether it's been cancelled
+    poll_interval = 0.05 # seconds
+
+    def __init__(self, limit):
+        self.semaphore = threading.BoundedSemaphore(max(1, limit))
+
+    def acquire(self, canceller=None):
+        """
+        Wait for a slot. Returns False, without one, if canceller is cancelled first.
+        """
+        if canceller is None:
+            return self.semaphore.acquire()
+        while not canceller.is_set():
+            if self.semaphore.acquire(timeout=self.poll_interval):
+                return True
+        return False
+
+    def release(self):
+        self.semaphore.release()
+
+def shutdown_response(response):
+    # The socket is only reachable through private attributes of urllib3 and
+    # http.client, which differ between versions. If it isn't where it's expected
+    # the response is closed instead, which stops the reader less promptly.
+    sock = response.raw
+    for name in ("_fp", "fp", "raw", "_sock"):
+        sock = getattr(sock, name, None)
+    if sock is not None:
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+            return
+        except OSError:
+            pass
+    response.close()
+
+class LLMClient:
+    """
+    Owns a pooled requests.Session so that every request to the server reuses a
+    kept-alive connection instead of paying for a new TCP (and TLS) handshake.
+    Connection failures are retried with exponential backoff, and every request
+    has a connect and read timeout so a hung server can't wedge a worker forever.
+    The read timeout is the longest wait between bytes, which includes the
+    server's prompt processing before the first token, hence the generous default.
+    """
+    def __init__(self, config):
+        self.api_url = config.get("api_url") or default_api_url
+        self.model = config.get("model")
+        self.max_length = config.get("response_limit", config.get("max_length", 1024))
+        self.timeout = (config.get("connect_timeout", 10), config.get("read_timeout", 600))
+        self.metrics_log = config.get("metrics_log", default_metrics_log)
+        # "concurrent_streams" is how many chat requests the server can work on at once
+        self.slots = RequestSlots(config.get("concurrent_streams", 1))
+        self.response_cache = None
+        if config.get("response_cache"):
+            self.response_cache = ResponseCache(config["response_cache"], int(config.get("response_cache_mb", 100)) * 1024 * 1024)
+
+        self.headers = {'Content-Type': 'application/json'}
+        api_key = config.get("api_key")
+        org_id = config.get("organization_id") or config.get("org_id")
+        project_id = config.get("project_id")
+        if api_key:
+            self.headers["Authorization"] = f"Bearer {api_key}"
+        if org_id:
+            self.headers["OpenAI-Organization"] = org_id
+        if project_id:
+            self.headers["OpenAI-Project"] = project_id
+
+        # Only failures to connect are retried, a request the server may have
+        # started on isn't sent twice.
+        retry = Retry(total=None, connect=config.get("connect_retries", 3), read=0, status=0, other=0,
+                      backoff_factor=0.5)
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=config.get("max_connections", 8), max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers.update(self.headers)
+
+    def close(self):
+        self.session.close()
+        if self.response_cache is not None:
+            self.response_cache.close()
+
+    def post(self, url, data, stream=False, metrics=None):
+        body = json.dumps(data)
+        if metrics is not None:
+            metrics.prompt_bytes = len(body.encode("utf-8"))
+        response = self.session.post(url, data=body, stream=stream, timeout=self.timeout)
+        if metrics is not None:
+            metrics.connected()
+        return response
+
+    def start_metrics(self, metrics, kind, messages):
+        if metrics is None:
+            metrics = RequestMetrics(kind)
+        metrics.model = self.model
+        metrics.start(messages)
+        return metrics
+
+    def finish_metrics(self, metrics, status="ok", error=None):
+        metrics.finish(status, error)
+        log_metrics(metrics, self.metrics_log)
+
+    def chat_data(self, messages, stream, max_tokens=None):
         data = {
             "messages": messages,
-            "max_completion_tokens": max_length,
-            "stream": False,
+            "max_completion_tokens": max_tokens or self.max_length,
+            "stream": stream,
         }
-        if model:
-            data["model"] = model
-        response = requests.post(generateUrl, headers=headers, data=json.dumps(data))
-    except Exception as e:
-          print(f"An error occurred: {e}")
-          return False
-    # Check if the request was successful
-    if response.status_code == 200:
-        # Parse the response JSON into a Python dictionary
-        response_data = json.loads(response.text)
-        message = {"role": response_data["choices"][0]["message"]["role"],
-                   "content": response_data["choices"][0]["message"]["content"]
-                   }
-        return message
-    else:
-        print(f"Request failed with status code {response.status_code}")
-        return False
+        if self.model:
+            data["model"] = self.model
+        return data
+
+    def cached_response(self, data, use_cache):
+        """
+        The cache key for a request and the cached answer, if there is one and use_cache.
+        Without a response cache configured both are None.
+        """
+        if self.response_cache is None:
+            return None, None
+        key = request_key(self.api_url, data)
+        return key, self.response_cache.get(key) if use_cache else None
+
+    def query(self, messages, metrics=None, use_cache=True):
+        data = self.chat_data(messages, False)
+        cache_key, cached = self.cached_response(data, use_cache)
+        if cached is not None:
+            metrics = self.start_metrics(metrics, "query", messages)
+            metrics.connected()
+            metrics.token()
+            metrics.response_text(cached)
+            self.finish_metrics(metrics, "cached")
+            return {"role": "assistant", "content": cached}
+        # Send the request and get the response, once there's a slot for it. The
+        # timings start when it's sent.
+        self.slots.acquire()
+        metrics = self.start_metrics(metrics, "query", messages)
+        try:
+            response = self.post(self.api_url, data, metrics=metrics)
+        except Exception as e:
+            print(f"An error occurred: {e}", file=sys.stderr)
+            self.finish_metrics(metrics, "error", str(e))
+            return False
+        finally:
+            self.slots.release()
+        # Check if the request was successful
+        if response.status_code == 200:
+            # Parse the response JSON into a Python dictionary
+            response_data = json.loads(response.text)
+            message = {"role": response_data["choices"][0]["message"]["role"],
+                       "content": response_data["choices"][0]["message"]["content"]
+                       }
+            # The whole reply arrives at once, so the first token is the last.
+            metrics.token()
+            metrics.usage(response_data.get("usage") or {})
+            metrics.response_text(message["content"] or "")
+            self.finish_metrics(metrics)
+            if cache_key is not None and message["content"]:
+                self.response_cache.put(cache_key, message["content"])
+            return message
+        else:
+            print(f"Request failed with status code {response.status_code}", file=sys.stderr)
+            self.finish_metrics(metrics, "error", f"status {response.status_code}")
+            return False
+
+    def query_streamed(self, messages, metrics=None, kind="stream", canceller=None, use_cache=True, max_tokens=None):
+        """
+        Yields a StreamDelta for each piece of the response, or a StreamError if
+        it fails, which is the last thing yielded. metrics, if given, is filled in
+        as the response arrives and can be read meanwhile. A StreamCanceller ends
+        the response early, without an error. With a response cache, a cached
+        answer comes back as a single StreamDelta marked cached, use_cache=False
+        asks the server anyway (and caches its answer). max_tokens overrides the
+        configured response limit. The request waits for one of the client's
+        RequestSlots first, metrics.started is set once it's actually sent.
+        """
+        data = self.chat_data(messages, True, max_tokens)
+        cache_key, cached = self.cached_response(data, use_cache)
+        if cached is not None:
+            yield from self.replay_cached(cached, self.start_metrics(metrics, kind, messages))
+            return
+        if not self.slots.acquire(canceller):
+            # Stopped while waiting, it was never sent so there's nothing to log.
+            return
+        metrics = self.start_metrics(metrics, kind, messages)
+        # Only complete answers are cached, so the text is collected as it goes.
+        parts = [] if cache_key is not None else None
+        status, error = "closed", None
+        malformed = 0
+        try:
+            with self.post(self.api_url, data, stream=True, metrics=metrics) as response:
+                if canceller is not None:
+                    canceller.attach(response)
+                if response.status_code != 200:
+                    print(f"Request failed with status code {response.status_code}", file=sys.stderr)
+                    status, error = "error", f"status {response.status_code}"
+                    yield StreamError(f"Request failed with status code {response.status_code}")
+                    return
+                for event in stream_events(response, canceller):
+                    if event.data == b"[DONE]":
+                        break
+                    try:
+                        delta = chat_event(json_loads(event.data))
+                    except (ValueError, AttributeError) as e:
+                        if event.event == "error":
+                            delta = StreamError(event.data.decode("utf-8", "replace"))
+                        else:
+                            # One bad event isn't worth losing the rest of the response over.
+                            print(f"Skipping an event that isn't a chat completion chunk ({e}): {event.data[:200]!r}", file=sys.stderr)
+                            malformed += 1
+                            continue
+                    if event.event == "error" and not isinstance(delta, StreamError):
+                        delta = StreamError(event.data.decode("utf-8", "replace"))
+                    if isinstance(delta, StreamError):
+                        print(f"The server reported an error: {delta.message}", file=sys.stderr)
+                        status, error = "error", delta.message
+                        yield delta
+                        return
+                    if delta.content:
+                        metrics.token()
+                        if parts is not None:
+                            parts.append(delta.content)
+                    if delta.usage:
+                        metrics.usage(delta.usage)
+                    yield delta
+                status = "cancelled" if canceller is not None and canceller.is_set() else "ok"
+                if malformed:
+                    error = f"{malformed} malformed events skipped"
+                elif status == "ok" and parts:
+                    self.response_cache.put(cache_key, "".join(parts))
+        except Exception as e:
+            if canceller is not None and canceller.is_set():
+                status = "cancelled"
+                return
+            print(f"An error occurred: {e}", file=sys.stderr)
+            status, error = "error", str(e)
+            yield StreamError(str(e))
+        finally:
+            # Also reached when the caller stops reading early, which is logged as "closed".
+            self.slots.release()
+            self.finish_metrics(metrics, status, error)
+
+    def replay_cached(self, content, metrics):
+        status = "closed"
+        try:
+            metrics.connected()
+            metrics.token()
+            metrics.response_text(content)
+            yield StreamDelta(content, "assistant", "stop", cached=True)
+            status = "cached"
+        finally:
+            self.finish_metrics(metrics, status)
+
+    def warm_up(self, messages, canceller):
+        """
+        Have the server process messages into its prompt cache by asking for a
+        single token, which is thrown away. Nothing waits on it, and a
+        StreamCanceller drops the connection once the server starts answering.
+        """
+        data = self.chat_data(messages, True)
+        data["max_completion_tokens"] = 1
+        if not self.slots.acquire(canceller):
+            return
+        metrics = self.start_metrics(None, "warm_up", messages)
+        status, error = "ok", None
+        try:
+            with self.post(self.api_url, data, stream=True, metrics=metrics) as response:
+                canceller.attach(response)
+                for event in stream_events(response, canceller):
+                    if event.data != b"[DONE]":
+                        metrics.token()
+        except Exception as e:
+            if not canceller.is_set():
+                print(f"Warm-up request failed: {e}", file=sys.stderr)
+                status, error = "error", str(e)
+        finally:
+            self.slots.release()
+        if canceller.is_set():
+            status = "cancelled"
+        self.finish_metrics(metrics, status, error)
+
+def stream_events(response, canceller=None, read_size=65536):
+    """
+    The server-sent events of a streamed response as they arrive. Reads take
+    whatever has arrived, up to read_size bytes, rather than waiting for a
+    full buffer, so events aren't held back. A compressed response is
+    decompressed as it's read.
+    """
+    parser = SSEParser()
+    raw = response.raw
+    while canceller is None or not canceller.is_set():
+        chunk = raw.read1(read_size, decode_content=True)
+        if not chunk:
+            return
+        for event in parser.feed(chunk):
+            if canceller is not None and canceller.is_set():
+                return
+            yield event
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+def client_key(config):
+    return tuple(config.get(key) for key in ("api_url", "api_key", "organization_id", "org_id", "project_id", "model",
+                                             "response_limit", "max_length", "connect_timeout", "read_timeout",
+                                             "connect_retries", "max_connections", "metrics_log", "response_cache",
+                                             "response_cache_mb", "concurrent_streams"))
+
+def get_client(config):
+    """
+    The LLMClient for config, shared by every caller in the process. A new one
+    (with a new connection pool) is only made when the connection settings change.
+    """
+    key = client_key(config)
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            # Settings changed. Closing the old client only shuts its idle connections
+            # and cache, a request still streaming on it finishes on its own connection.
+            evicted = list(_clients.values())
+            _clients.clear()
+            client = _clients[key] = LLMClient(config)
+        else:
+            evicted = []
+    for old_client in evicted:
+        old_client.close()
+    return client
+
+def queryLLM(messages, config, metrics=None, use_cache=True):
+    return get_client(config).query(messages, metrics, use_cache=use_cache)
+
+def queryLLMStreamed(messages, config, metrics=None, canceller=None, use_cache=True):
+    return get_client(config).query_streamed(messages, metrics, canceller=canceller, use_cache=use_cache)
+
+def warmUpLLM(messages, config):
+    """
+    Start a warm-up request on a background thread, returns the StreamCanceller
+    that stops it.
+    """
+    canceller = StreamCanceller()
+    thread = threading.Thread(target=get_client(config).warm_up, args=(messages, canceller), daemon=True)
+    thread.start()
+    return canceller
+
+def embeddings_url(config):
+    url = config.get("embeddings_url")
+    if url:
+        return url
+    api_url = config.get("api_url") or default_api_url
+    if api_url.endswith("/chat/completions"):
+        return api_url[:-len("/chat/completions")] + "/embeddings"
+    return api_url.rstrip("/") + "/embeddings"
 
-def queryLLMStreamed(messages, config):
-    max_length = config.get("max_length", 1024)
-    generateUrl = config.get("api_url", "http://localhost:5001/v1/chat/completions")
-    api_key = config.get("api_key")
-    org_id = config.get("org_id")
-    project_id = config.get("project_id")
-    model = config.get("model")
-    headers = {'Content-Type': 'application/json'}
-    if api_key:
-        headers["Authorization"] = f"Bearer {api_key}"
-    if org_id:
-        headers["OpenAI-Organization"] = org_id
-    if project_id:
-        headers["OpenAI-Project"] = project_id
-    data = {
-        "messages": messages,
-        "max_completion_tokens": max_length,
-        "stream": True  # Enable streaming
-    }
-
-    try:
-        with requests.post(generateUrl, headers=headers, data=json.dumps(data), stream=True) as response:
-            if response.status_code == 200:
-                for line in response.iter_lines():
-                    if line and line != b'data: [DONE]':
-                        try:
-                            yield json.loads(line.decode('utf-8')[len("data: "):])
-                        except Exception as e:
-                            print(f"An error in json decoding occurred: {e}")
-                            print("Line was:")
-                            print(line)
-                            yield None
-            else:
-                print(f"Request failed with status code {response.status_code}")
-                yield None
-    except Exception as e:
-        print(f"An error occurred: {e}")
-        yield None
+#https://platform.openai.com/docs/api-reference/embeddings/create
+def queryEmbeddings(texts, config):
+    """
+    Embed a batch of texts, returns a list of vectors in the same order.
+    Raises on failure since there's no sensible partial result.
+    """
+    client = get_client(config)
+    data = {"input": texts}
+    model = config.get("embedding_model") or config.get("model")
+    if model:
+        data["model"] = model
 
+    response = client.post(embeddings_url(config), data)
+    if response.status_code != 200:
+        raise RuntimeError(f"Embedding request failed with status code {response.status_code}")
+    embeddings = sorted(response.json()["data"], key=lambda item: item["index"])
+    return [item["embedding"] for item in embeddings]
@@ -0,0 +1,148 @@
+import json
+import sys
+import threading
+import time
+
+# Timing of every chat request sent to the LLM server. OpenAIInterface fills in a
+# RequestMetrics as the request goes and appends it to a JSONL log when it's done,
+# one object per line, so logs from several people can simply be concatenated and
+# aggregated. The log file is the "metrics_log" config setting, blank turns it off.
+
+default_metrics_log = "ChatZim.metrics.jsonl"
+
+_log_lock = threading.Lock()
+
+def percentile(values, fraction):
+    # Nearest rank on an already sorted list.
+    if not values:
+        return None
+    index = min(len(values) - 1, max(0, int(round(fraction * (len(values) - 1)))))
+    return values[index]
+
+class RequestMetrics:
+    """
+    Times are in seconds from when the request was sent. "connect" is the time
+    until the response headers arrived, for a streamed request that's usually the
+    connection alone, otherwise it includes all of the server's work. Tokens are
+    counted as the content deltas arrive unless the server reports its own usage.
+    """
+    def __init__(self, kind="stream"):
+        self.kind = kind
+        self.model = None
+        self.prompt_bytes = 0
+        self.prompt_tokens = None
+        self.completion_tokens = None
+        self.started = None
+        self.connect = None
+        self.first_token = None
+        self.last_token = None
+        self.token_times = []
+        self.duration = None
+        self.status = "running"
+        self.error = None
+        # (name, parts, seconds) of any work done before the request, like map-reduce's map stage
+        self.stages = []
+
+    def start(self, messages):
+        # Imported here as TokenCounter needs OpenAIInterface, which needs this.
+        from TokenCounter import EstimateTokenizer
+        self.prompt_tokens = EstimateTokenizer().count("".join(message["content"] for message in messages))
+        self.started = time.perf_counter()
+
+    def stage(self, name, parts, seconds):
+        self.stages.append((name, parts, seconds))
+
+    def connected(self):
+        self.connect = time.perf_counter() - self.started
+
+    def token(self):
+        now = time.perf_counter() - self.started
+        if self.first_token is None:
+            self.first_token = now
+        self.last_token = now
+        self.token_times.append(now)
+
+    def usage(self, usage):
+        # Servers that report their own counts know better than the estimate.
+        if usage.get("prompt_tokens"):
+            self.prompt_tokens = usage["prompt_tokens"]
+        if usage.get("completion_tokens"):
+            self.completion_tokens = usage["completion_tokens"]
+
+    def response_text(self, text):
+        # For a reply that came all at once, there are no deltas to count.
+        if self.completion_tokens is None:
+            from TokenCounter import EstimateTokenizer
+            self.completion_tokens = EstimateTokenizer().count(text)
+
+    def finish(self, status="ok", error=None):
+        self.duration = time.perf_counter() - self.started
+        self.status = status
+        self.error = error
+
+    def tokens(self):
+        if self.completion_tokens is not None:
+            return self.completion_tokens
+        return len(self.token_times)
+
+    def tokens_per_second(self):
+        if self.first_token is None or self.last_token == self.first_token:
+            return None
+        # The first token marks the end of prompt processing, generation is timed from there.
+        return (self.tokens() - 1) / (self.last_token - self.first_token)
+
+    def inter_token(self):
+        gaps = sorted(later - earlier for earlier, later in zip(self.token_times, self.token_times[1:]))
+        return {"p50": percentile(gaps, 0.5), "p90": percentile(gaps, 0.9), "p99": percentile(gaps, 0.99)}
+
+    def to_dict(self):
+        return {
+            "time": time.time(),
+            "kind": self.kind,
+            "model": self.model,
+            "status": self.status,
+            "error": self.error,
+            "prompt_bytes": self.prompt_bytes,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.tokens(),
+            "connect": self.connect,
+            "ttft": self.first_token,
+            "inter_token": self.inter_token(),
+            "tokens_per_second": self.tokens_per_second(),
+            "duration": self.duration,
+            "stages": [{"name": name, "parts": parts, "seconds": seconds} for name, parts, seconds in self.stages],
+        }
+
+    def summary(self):
+        """
+        One line for the status bar, works while the request is still going too.
+        """
+        parts = [f"{name} {count} parts {seconds:.2f} s" for name, count, seconds in self.stages if count > 1]
+        parts.append(f"{self.prompt_tokens} prompt tokens")
+        if self.connect is not None:
+            parts.append(f"connect {self.connect * 1000:.0f} ms")
+        if self.first_token is not None:
+            parts.append(f"first token {self.first_token:.2f} s")
+            parts.append(f"{self.tokens()} tokens")
+        rate = self.tokens_per_second()
+        if rate is not None:
+            parts.append(f"{rate:.1f} tok/s")
+        if self.duration is not None:
+            inter_token = self.inter_token()
+            if inter_token["p50"] is not None:
+                parts.append(f'inter-token p50 {inter_token["p50"] * 1000:.0f} / p99 {inter_token["p99"] * 1000:.0f} ms')
+            parts.append(f"{self.duration:.2f} s total")
+            if self.status != "ok":
+                parts.append(self.status)
+        return ", ".join(parts)
+
+def log_metrics(metrics, path):
+    if not path:
+        return
+    line = json.dumps(metrics.to_dict())
+    try:
+        with _log_lock:
+            with open(path, "a", encoding="utf-8") as file:
+                file.write(line + "\n")
+    except OSError as e:
+        print(f"Unable to write metrics log {path}: {e}", file=sys.stderr)
@@ -0,0 +1,99 @@
+import hashlib
+import json
+import sqlite3
+import sys
+import threading
+import time
+
+# Answers from the LLM kept on disk, so asking the same question of the same
+# pages again (after starting a new conversation, or in another session) comes
+# back straight away instead of being generated all over again. Requests are
+# keyed by a hash of everything sent that affects the answer: the server, the
+# model, the messages (system message included) and the sampling settings. The
+# least recently used answers are dropped once the cache is over its size. The
+# file is the "response_cache" config setting, blank (the default) turns it off.
+
+schema_version = 1
+
+def request_key(api_url, data):
+    """
+    Hash of a chat request body, whether it's streamed or not doesn't matter.
+    """
+    data = dict(data, api_url=api_url)
+    data.pop("stream", None)
+    return hashlib.sha256(json.dumps(data, sort_keys=True).encode("utf-8")).hexdigest()
+
+class ResponseCache:
+    def __init__(self, path, max_bytes=100 * 1024 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        # One connection shared by the worker threads, taking turns.
+        self.lock = threading.Lock()
+        try:
+            self.connection = sqlite3.connect(path, check_same_thread=False)
+            self._create_tables()
+        except sqlite3.Error as e:
+            print(f"Unable to open response cache {path}: {e}", file=sys.stderr)
+            self.connection = sqlite3.connect(":memory:", check_same_thread=False)
+            self._create_tables()
+
+    def _create_tables(self):
+        version = self.connection.execute("PRAGMA user_version").fetchone()[0]
+        if version != schema_version:
+            self.connection.execute("DROP TABLE IF EXISTS responses")
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS responses (
+            key TEXT PRIMARY KEY,
+            content TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            used REAL NOT NULL)""")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS responses_used ON responses (used)")
+        self.connection.execute(f"PRAGMA user_version = {schema_version}")
+        self.connection.commit()
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    def get(self, key):
+        """
+        The cached answer for key, or None.
+        """
+        try:
+            with self.lock:
+                row = self.connection.execute("SELECT content FROM responses WHERE key = ?", (key,)).fetchone()
+                if row is None:
+                    return None
+                self.connection.execute("UPDATE responses SET used = ? WHERE key = ?", (time.time(), key))
+                self.connection.commit()
+                return row[0]
+        except sqlite3.Error as e:
+            print(f"Unable to read the response cache: {e}", file=sys.stderr)
+            return None
+
+    def put(self, key, content):
+        size = len(content.encode("utf-8"))
+        if size > self.max_bytes:
+            return
+        try:
+            with self.lock:
+                self.connection.execute("INSERT OR REPLACE INTO responses (key, content, size, used) VALUES (?, ?, ?, ?)",
+                                        (key, content, size, time.time()))
+                self.evict()
+                self.connection.commit()
+        except sqlite3.Error as e:
+            print(f"Unable to write the response cache: {e}", file=sys.stderr)
+
+    def evict(self):
+        total = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        # Oldest first until enough has gone
+        excess = total - self.max_bytes
+        keys = []
+        for key, size in self.connection.execute("SELECT key, size FROM responses ORDER BY used"):
+            keys.append((key,))
+            excess -= size
+            if excess <= 0:
+                break
+        self.connection.executemany("DELETE FROM responses WHERE key = ?", keys)
+
@@ -0,0 +1,156 @@
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Parses the server-sent events stream of a streamed chat completion, as the
+# response arrives in whatever size pieces the network delivers. Follows the
+# event stream format of the HTML spec: lines may end in \n, \r\n or \r, an
+# event can have several data lines, lines starting with ":" are comments
+# (servers send them as keep-alives) and "event:", "id:" and "retry:" fields
+# are understood. The data of each chat event is turned into a StreamDelta, or a
+# StreamError if the server reports one. orjson is used for the JSON if it's
+# installed.
+
+_decoder = json.JSONDecoder()
+
+def stdlib_json_loads(data):
+    # Decoding to str first is quicker than json.loads working out the encoding
+    # of bytes, and raw_decode skips its checks for surrounding whitespace, which
+    # add up over thousands of small events. Anything unusual goes to json.loads.
+    text = data.decode("utf-8")
+    try:
+        value, end = _decoder.raw_decode(text)
+        if end == len(text):
+            return value
+    except ValueError:
+        pass
+    return json.loads(text)
+
+# Both raise a ValueError on bad JSON.
+json_loads = orjson.loads if orjson is not None else stdlib_json_loads
+
+class ServerSentEvent:
+    __slots__ = ("event", "data", "id")
+
+    def __init__(self, event, data, id):
+        # data is left as bytes, the JSON decoders take them as they are.
+        self.event = event
+        self.data = data
+        self.id = id
+
+class SSEParser:
+    def __init__(self):
+        self.buffer = b""
+        self.data = []
+        self.event = ""
+        self.last_id = ""
+        # Reconnection time the server asked for, in milliseconds. Kept for completeness, nothing reconnects.
+        self.retry = None
+        self.started = False
+
+    def feed(self, chunk):
+        """
+        Parse the next piece of the stream, returns the events it completed. As
+        the spec says, an event still unfinished when the stream ends is dropped.
+        """
+        buffer = self.buffer + chunk if self.buffer else chunk
+        if not self.started:
+            if len(buffer) < 3 and b"\xef\xbb\xbf".startswith(buffer):
+                self.buffer = buffer
+                return []
+            self.started = True
+            if buffer.startswith(b"\xef\xbb\xbf"):
+                buffer = buffer[3:]
+        held = b""
+        if b"\r" in buffer:
+            # A \r at the very end may be the first half of a \r\n.
+            if buffer.endswith(b"\r"):
+                buffer, held = buffer[:-1], b"\r"
+            buffer = buffer.replace(b"\r\n", b"\n").replace(b"\r", b"\n")
+        # Events end with a blank line, so each piece but the last is a whole event.
+        blocks = buffer.split(b"\n\n")
+        self.buffer = blocks.pop() + held
+        events = []
+        for block in blocks:
+            # Almost every event is a single "data: " line, those are taken as they are.
+            if block[:6] == b"data: " and b"\n" not in block:
+                events.append(ServerSentEvent("message", block[6:], self.last_id))
+                continue
+            for line in block.split(b"\n"):
+                self.parse_line(line, events)
+            self.dispatch(events)
+        return events
+
+    def parse_line(self, line, events):
+        if not line:
+            self.dispatch(events)
+            return
+        if line[0] == 58: # ":", a comment
+            return
+        field, colon, value = line.partition(b":")
+        if value[:1] == b" ":
+            value = value[1:]
+        if field == b"data":
+            self.data.append(value)
+        elif field == b"event":
+            self.event = value.decode("utf-8", "replace")
+        elif field == b"id":
+            if b"\0" not in value:
+                self.last_id = value.decode("utf-8", "replace")
+        elif field == b"retry":
+            if value.isdigit():
+                self.retry = int(value)
+
+    def dispatch(self, events):
+        # A blank line: the event so far is complete, if it has any data.
+        if self.data:
+            events.append(ServerSentEvent(self.event or "message", b"\n".join(self.data), self.last_id))
+        self.data = []
+        self.event = ""
+
+class StreamDelta:
+    """
+    One piece of a streamed chat response. content is "" for pieces that only
+    carry the role, the finish reason or the usage counts.
+    """
+    __slots__ = ("content", "role", "finish_reason", "usage", "cached")
+
+    def __init__(self, content="", role=None, finish_reason=None, usage=None, cached=False):
+        self.content = content
+        self.role = role
+        self.finish_reason = finish_reason
+        self.usage = usage
+        self.cached = cached
+
+class StreamError:
+    """
+    The request failed, message says why. Nothing more follows it.
+    """
+    __slots__ = ("message",)
+
+    def __init__(self, message):
+        self.message = message
+
+def chat_event(data):
+    """
+    The StreamDelta for a decoded chat completion chunk, or a StreamError if the server sent an error instead.
+    """
+    try:
+        # The usual shape, checked for first
+        choice = data["choices"][0]
+        delta = choice["delta"]
+        return StreamDelta(delta.get("content") or "", delta.get("role"), choice.get("finish_reason"), data.get("usage"))
+    except (KeyError, IndexError, TypeError):
+        pass
+    error = data.get("error")
+    if error:
+        return StreamError(error.get("message", str(error)) if isinstance(error, dict) else str(error))
+    choices = data.get("choices")
+    if choices and isinstance(choices[0], dict):
+        choice = choices[0]
+        delta = choice.get("delta") or {}
+        return StreamDelta(delta.get("content") or "", delta.get("role"), choice.get("finish_reason"), data.get("usage"))
+    return StreamDelta(usage=data.get("usage"))
@@ -0,0 +1,131 @@
+import json
+import re
+import sys
+import time
+import requests
+from requests.adapters import HTTPAdapter
+
+from OpenAIInterface import get_client, default_api_url
+
+# Token counting for the context budget. Which tokenizer is used is picked by the
+# "tokenizer" config setting:
+#   "estimate" (the default) - a local approximation, no dependencies
+#   "server"                 - ask the LLM server, KoboldCPP and llama.cpp both have an endpoint for it
+#   anything else            - path to a Hugging Face tokenizer.json, needs the "tokenizers" package
+
+# Every tokenizer's count takes estimate=True. Counts that get stored (the page
+# index) pass estimate=False, and a tokenizer that can't give a real count then
+# raises TokenizerUnavailable rather than having an estimate saved under its name.
+
+token_pattern = re.compile(r"\w+|[^\w\s]", re.UNICODE)
+
+class TokenizerUnavailable(Exception):
+    pass
+
+class EstimateTokenizer:
+    """
+    Counts words and punctuation marks separately, which tracks real tokenizers
+    far better than splitting on whitespace does. Also stands in for a real
+    tokenizer when there's no server to ask.
+    """
+    name = "estimate"
+
+    def count(self, text, estimate=True):
+        return len(token_pattern.findall(text))
+
+class FileTokenizer:
+    def __init__(self, path):
+        from tokenizers import Tokenizer
+        self.tokenizer = Tokenizer.from_file(path)
+        self.name = f"file:{path}"
+
+    def count(self, text, estimate=True):
+        return len(self.tokenizer.encode(text, add_special_tokens=False).ids)
+
+def server_base_url(api_url):
+    """
+    Strip the OpenAI API path off the configured URL to get at the server's own endpoints.
+    """
+    for suffix in ("/v1/chat/completions", "/chat/completions", "/v1"):
+        if api_url.endswith(suffix):
+            return api_url[:-len(suffix)]
+    return api_url.rstrip("/")
+
+class ServerTokenizer:
+    """
+    Uses the tokenizer of the model that's actually loaded. Tries KoboldCPP's
+    token count endpoint and then llama.cpp's tokenize endpoint, falling back to
+    the local estimate if the server has neither or can't be reached. A failure
+    is remembered for retry_interval seconds so a server that's down isn't asked
+    again for every page, and the requests aren't retried and time out quickly
+    since the GUI waits on them.
+    """
+    def __init__(self, config, retry_interval=60):
+        self.config = config
+        self.base_url = server_base_url(config.get("api_url") or default_api_url)
+        self.name = f"server:{self.base_url}"
+        self.fallback = EstimateTokenizer()
+        self.endpoint = None
+        self.timeout = (config.get("tokenizer_connect_timeout", 1), config.get("tokenizer_read_timeout", 30))
+        self.retry_interval = retry_interval
+        self.unavailable_until = 0.0
+        # Its own session, the chat client's retries connecting with backoff.
+        self.session = requests.Session()
+        self.session.mount("http://", HTTPAdapter(max_retries=0))
+        self.session.mount("https://", HTTPAdapter(max_retries=0))
+        self.session.headers.update(get_client(config).headers)
+
+    def _query(self, endpoint, text):
+        if endpoint == "kobold":
+            response = self.session.post(f"{self.base_url}/api/extra/tokencount", data=json.dumps({"prompt": text}), timeout=self.timeout)
+            response.raise_for_status()
+            return response.json()["value"]
+        response = self.session.post(f"{self.base_url}/tokenize", data=json.dumps({"content": text}), timeout=self.timeout)
+        response.raise_for_status()
+        return len(response.json()["tokens"])
+
+    def count(self, text, estimate=True):
+        if time.monotonic() >= self.unavailable_until:
+            endpoints = [self.endpoint] if self.endpoint else ["kobold", "llamacpp"]
+            for endpoint in endpoints:
+                try:
+                    count = self._query(endpoint, text)
+                    self.endpoint = endpoint
+                    return count
+                except (requests.RequestException, ValueError, KeyError):
+                    continue
+            print(f"Unable to count tokens with {self.base_url}, using an estimate for the next {self.retry_interval}s", file=sys.stderr)
+            self.unavailable_until = time.monotonic() + self.retry_interval
+        if not estimate:
+            raise TokenizerUnavailable(f"{self.base_url} can't be reached to count tokens")
+        return self.fallback.count(text)
+
+_tokenizers = {}
+
+def get_tokenizer(config):
+    """
+    The tokenizer selected by config, created once and then reused.
+    """
+    setting = config.get("tokenizer") or "estimate"
+    if setting == "server":
+        key = ("server", config.get("api_url"))
+    else:
+        key = (setting,)
+    tokenizer = _tokenizers.get(key)
+    if tokenizer is None:
+        if setting == "estimate":
+            tokenizer = EstimateTokenizer()
+        elif setting == "server":
+            tokenizer = ServerTokenizer(config)
+        else:
+            try:
+                tokenizer = FileTokenizer(setting)
+            except Exception as e:
+                print(f"Unable to load tokenizer {setting}: {e}", file=sys.stderr)
+                tokenizer = EstimateTokenizer()
+        _tokenizers[key] = tokenizer
+    return tokenizer
+
+def count_message_tokens(messages, tokenizer):
+    # A few tokens per message for the chat template's role markers.
+    return sum(tokenizer.count(message["content"]) + 4 for message in messages)
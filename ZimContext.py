@@ -0,0 +1,247 @@
+import os
+import sys
+from collections import OrderedDict
+
+from ZimPageScanner import read_page_body
+from ZimMarkup import compact_page, markup_modes
+from ZimDedup import deduplicate
+
+# Assembles the system message from the selected Zim pages. Kept free of Qt so
+# it can be used outside the GUI.
+
+class PageContentCache:
+    """
+    LRU cache of page bodies (everything after the three header lines), keyed by path
+    and validated against the file's mtime and size, so rebuilding the system message
+    only reads pages that are new or changed since they were last seen. Pages are
+    held as they go in the context, after any markup compaction (see ZimMarkup),
+    so that only needs doing once per page as well.
+    max_chars bounds the total text held.
+    """
+    def __init__(self, max_chars=64 * 1024 * 1024):
+        self.max_chars = max_chars
+        self.total_chars = 0
+        self.entries = OrderedDict()
+
+    def get(self, file_path, markup="raw"):
+        """
+        Returns the page body, reading it from disk if the cached copy is missing or stale.
+        Raises OSError/UnicodeDecodeError if the page can't be read.
+        """
+        stat = os.stat(file_path)
+        key = (stat.st_mtime_ns, stat.st_size)
+        entry = self.entries.get((file_path, markup))
+        if entry is not None and entry[0] == key:
+            self.entries.move_to_end((file_path, markup))
+            return entry[1]
+
+        content = compact_page(read_page_body(file_path), markup)
+        self.put(file_path, key, content, markup)
+        return content
+
+    def put(self, file_path, key, content, markup="raw"):
+        self._pop((file_path, markup))
+        self.entries[(file_path, markup)] = (key, content)
+        self.total_chars += len(content)
+        while self.total_chars > self.max_chars and len(self.entries) > 1:
+            _, (_, evicted) = self.entries.popitem(last=False)
+            self.total_chars -= len(evicted)
+
+    def _pop(self, entry_key):
+        entry = self.entries.pop(entry_key, None)
+        if entry is not None:
+            self.total_chars -= len(entry[1])
+
+    def discard(self, file_path):
+        for markup in markup_modes:
+            self._pop((file_path, markup))
+
+    def clear(self):
+        self.entries.clear()
+        self.total_chars = 0
+
+# Shared by everything in the process that builds system messages.
+page_cache = PageContentCache()
+
+def selected_file_paths(context_settings, stable=False):
+    """
+    Paths of the selected pages in the order they go into the system message.
+    Normally that's alphabetical, but selecting a page early in the alphabet then
+    changes everything after it and the server has to process the whole context
+    again. With stable set the order is kept in context_settings["page_order"]:
+    pages stay where they are and newly selected ones are added at the end, so
+    the start of the context (which the server has cached) stays the same.
+    The order is only read here, update_page_order records it.
+    """
+    relative_paths = [page["relative_path"] for page in context_settings["pages"].values() if page["selected"]]
+    if stable:
+        relative_paths = stable_page_order(context_settings, relative_paths)
+    else:
+        relative_paths.sort()
+    return [os.path.join(context_settings["root_path"], relative_path) for relative_path in relative_paths]
+
+def stable_page_order(context_settings, relative_paths):
+    selected = set(relative_paths)
+    order = [relative_path for relative_path in context_settings.get("page_order", []) if relative_path in selected]
+    ordered = set(order)
+    order.extend(sorted(relative_path for relative_path in relative_paths if relative_path not in ordered))
+    return order
+
+def update_page_order(context_settings):
+    """
+    Record the stable page order for the current selection, to be called when the selection changes.
+    """
+    context_settings["page_order"] = stable_page_order(
+        context_settings, [page["relative_path"] for page in context_settings["pages"].values() if page["selected"]])
+
+def compact_page_order(context_settings):
+    """
+    Put the stable page order back into alphabetical order. This changes the
+    start of the context, so the server will process all of it again once.
+    """
+    context_settings["page_order"] = sorted(page["relative_path"] for page in context_settings["pages"].values() if page["selected"])
+
+def selected_page_texts(context_settings, config, cache=page_cache):
+    """
+    (file_path, text) of the selected pages in context order, with repeated
+    paragraphs dropped if that's on. Also returns the dropped paragraphs.
+    """
+    pages = []
+    markup = config.get("markup", "raw")
+    for file_path in selected_file_paths(context_settings, config.get("context_order") == "stable"):
+        try:
+            pages.append((file_path, cache.get(file_path, markup)))
+        except (OSError, UnicodeDecodeError):
+            print(f"Unable to read file {file_path}", file=sys.stderr)
+    dedup = config.get("dedup", "off")
+    if dedup == "off":
+        return pages, []
+    texts, removed = deduplicate(pages, dedup == "reference", config.get("dedup_threshold", 0.7))
+    return [(file_path, text) for (file_path, _), text in zip(pages, texts)], removed
+
+def dedup_savings(context_settings, config, tokenizer, cache=page_cache):
+    """
+    Tokens saved by dropping repeated paragraphs from the selected pages.
+    """
+    _, removed = selected_page_texts(context_settings, config, cache)
+    return tokenizer.count("\n\n".join(removed)) if removed else 0
+
+def get_system_message(context_settings, config, cache=page_cache):
+    pages, _ = selected_page_texts(context_settings, config, cache)
+    context_list = [text for _, text in pages]
+
+    message = {
+        "role": "system",
+        "content": config["system_prompt"] + "\n\n" + "\n\n".join(context_list)
+        }
+    return message
+
+class SystemContext:
+    """
+    A system message and its size, shared by every conversation. It's never
+    changed once made, a new one replaces it when the pages change, so however
+    many conversations are open the page text is held (and counted) once.
+    """
+    __slots__ = ("message", "words", "tokens")
+
+    def __init__(self, message, tokenizer):
+        self.message = message
+        self.words = word_count(message["content"])
+        self.tokens = tokenizer.count(message["content"])
+
+def prompt_text(messages):
+    # Close enough to what a chat template makes of the messages for comparing prefixes.
+    return "".join(f'{message["role"]}\n{message["content"]}\n' for message in messages)
+
+def common_prefix_length(a, b):
+    """
+    Length of the common prefix of two strings, by binary search over slice
+    comparisons so long contexts are compared at C speed.
+    """
+    low, high = 0, min(len(a), len(b))
+    while low < high:
+        middle = (low + high + 1) // 2
+        if a[:middle] == b[:middle]:
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+class PrefixTracker:
+    """
+    Remembers the last prompt sent and reports how much of the start of the next
+    one is unchanged, which is the part the server can take from its prompt cache.
+    update() only compares the text, so it costs nothing before the request goes
+    out; count_tokens() fills in the report afterwards.
+    """
+    def __init__(self):
+        self.last_text = None
+        # (messages, their prompt texts, unchanged characters) of the request not yet counted
+        self.pending = None
+        # (unchanged bytes, total bytes, unchanged tokens, total tokens) for the latest counted request
+        self.report = None
+
+    def update(self, messages):
+        texts = [prompt_text([message]) for message in messages]
+        text = "".join(texts)
+        unchanged = common_prefix_length(self.last_text, text) if self.last_text is not None else 0
+        self.pending = (messages, texts, unchanged)
+        self.last_text = text
+
+    def count_tokens(self, count):
+        """
+        Work out the report for the last update. count(message) gives a message's
+        tokens (so cached counts can be used); the message the unchanged part ends
+        in is counted in proportion to its characters.
+        """
+        if self.pending is None:
+            return self.report
+        messages, texts, unchanged = self.pending
+        self.pending = None
+        unchanged_tokens = total_tokens = 0
+        remaining = unchanged
+        for message, text in zip(messages, texts):
+            tokens = count(message)
+            total_tokens += tokens
+            if remaining >= len(text):
+                unchanged_tokens += tokens
+            elif remaining > 0:
+                unchanged_tokens += tokens * remaining // len(text)
+            remaining -= len(text)
+        text = "".join(texts)
+        self.report = (len(text[:unchanged].encode("utf-8")), len(text.encode("utf-8")), unchanged_tokens, total_tokens)
+        return self.report
+
+    def reset(self):
+        self.last_text = None
+        self.pending = None
+        self.report = None
+
+#Very quick and dirty.
+def word_count(context):
+    return len(context.split())
+
+def context_budget(config, history_tokens=0):
+    """
+    Tokens left for the system message once the history and the response are
+    accounted for, or None if no context size has been configured.
+    """
+    context_size = config.get("context_size", 0)
+    if not context_size:
+        return None
+    return context_size - config.get("response_limit", 1024) - history_tokens
+
+def pages_over_budget(page_tokens, budget):
+    """
+    page_tokens maps page keys to token counts. Returns the keys to leave out so
+    the rest fit in budget, dropping the largest pages first so as few pages as
+    possible are lost.
+    """
+    total = sum(page_tokens.values())
+    dropped = []
+    for key, tokens in sorted(page_tokens.items(), key=lambda item: item[1], reverse=True):
+        if total <= budget:
+            break
+        dropped.append(key)
+        total -= tokens
+    return dropped
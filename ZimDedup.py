@@ -0,0 +1,183 @@
+import heapq
+import os
+import re
+import threading
+from collections import OrderedDict, defaultdict
+
+# Drops paragraphs that have already appeared earlier in the context, such as
+# stat blocks and boilerplate pasted into page after page. Exact repeats are
+# found by hashing, near repeats (a changed number, an extra word) by comparing
+# bottom-k MinHash sketches of the paragraphs' word shingles. The first copy is
+# kept, later ones are removed or replaced by a short note saying where the text
+# appeared. Selected with the "dedup" config setting: "off", "drop" or "reference".
+
+paragraph_split_pattern = re.compile(r"\n\s*\n")
+word_pattern = re.compile(r"\w+", re.UNICODE)
+
+class ParagraphFingerprint:
+    __slots__ = ("text", "words", "exact", "sketch", "sketch_set")
+
+    def __init__(self, text, shingle_words=3, sketch_size=32):
+        self.text = text
+        words = word_pattern.findall(text.lower())
+        self.words = len(words)
+        self.exact = hash(" ".join(words))
+        shingles = {hash(" ".join(words[start:start + shingle_words]))
+                    for start in range(max(1, len(words) - shingle_words + 1))}
+        # The sketch_size smallest shingle hashes stand in for the whole set.
+        self.sketch = heapq.nsmallest(sketch_size, shingles)
+        self.sketch_set = frozenset(self.sketch)
+
+def similarity(a, b, sketch_size=32):
+    """
+    Estimated Jaccard similarity of two paragraphs' shingle sets from their sketches.
+    """
+    union = heapq.nsmallest(sketch_size, a.sketch_set | b.sketch_set)
+    if not union:
+        return 0.0
+    shared = sum(1 for value in union if value in a.sketch_set and value in b.sketch_set)
+    return shared / len(union)
+
+def fingerprint_page(text):
+    return [ParagraphFingerprint(paragraph) for paragraph in paragraph_split_pattern.split(text) if paragraph.strip()]
+
+class FingerprintCache:
+    """
+    Paragraph fingerprints per page, kept until the page's text changes so
+    only new or edited pages are fingerprinted when the context is rebuilt.
+    Hashes are Python's own, so fingerprints are only good for this process.
+    """
+    def __init__(self, max_pages=20000):
+        self.max_pages = max_pages
+        self.entries = OrderedDict()
+
+    def get(self, file_path, text):
+        entry = self.entries.get(file_path)
+        # str caches its hash, so checking it is cheap after the first time.
+        if entry is not None and entry[0] == (len(text), hash(text)):
+            self.entries.move_to_end(file_path)
+            return entry[1]
+        fingerprints = fingerprint_page(text)
+        self.entries[file_path] = ((len(text), hash(text)), fingerprints)
+        self.entries.move_to_end(file_path)
+        while len(self.entries) > self.max_pages:
+            self.entries.popitem(last=False)
+        return fingerprints
+
+    def discard(self, file_path):
+        self.entries.pop(file_path, None)
+
+fingerprint_cache = FingerprintCache()
+
+def page_name(file_path):
+    return os.path.splitext(os.path.basename(file_path))[0].replace("_", " ")
+
+class DedupState:
+    """
+    What the last deduplicate() call worked out: the exact hashes and sketch
+    postings of the paragraphs it kept, and each page's result in order. A later
+    call only compares the pages from the first one that's different, so
+    rebuilding the context after an edit, or after selecting another page in
+    the stable page order, doesn't go over every page again.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.settings = None
+        self.clear()
+
+    def clear(self, settings=None):
+        self.settings = settings
+        self.seen_exact = {}
+        # Sketch value -> earlier paragraphs having it, to find candidates to compare with.
+        self.sketch_index = defaultdict(list)
+        # (file_path, fingerprints, text, kept paragraphs, removed paragraphs) of each page
+        self.pages = []
+
+    def keep(self, paragraph, file_path, max_postings):
+        self.seen_exact[paragraph.exact] = file_path
+        for value in paragraph.sketch:
+            postings = self.sketch_index[value]
+            # Values shared by more than max_postings paragraphs are common phrases that
+            # don't tell paragraphs apart, they stop being indexed and are skipped.
+            if len(postings) <= max_postings:
+                postings.append((paragraph, file_path))
+
+    def truncate(self, count, max_postings):
+        # Back to how it was after the first count pages, the index is rebuilt from what they kept.
+        pages = self.pages[:count]
+        self.clear(self.settings)
+        for page in pages:
+            for paragraph in page[3]:
+                self.keep(paragraph, page[0], max_postings)
+        self.pages = pages
+
+dedup_state = DedupState()
+
+def deduplicate(pages, references=True, threshold=0.7, min_words=8, cache=fingerprint_cache, max_postings=64, state=dedup_state):
+    """
+    pages is a list of (file_path, text) in context order. Returns the texts with
+    repeated paragraphs removed, and the removed paragraphs. Paragraphs shorter
+    than min_words (headings, dates) are always kept.
+    """
+    settings = (references, threshold, min_words, max_postings)
+    with state.lock:
+        fingerprints = [cache.get(file_path, text) for file_path, text in pages]
+        if state.settings != settings:
+            state.clear(settings)
+        # The fingerprint cache hands back the same list while a page's text is unchanged.
+        same = 0
+        while (same < len(pages) and same < len(state.pages) and state.pages[same][0] == pages[same][0]
+               and state.pages[same][1] is fingerprints[same]):
+            same += 1
+        if same < len(state.pages):
+            state.truncate(same, max_postings)
+        for (file_path, text), page_fingerprints in zip(pages[same:], fingerprints[same:]):
+            state.pages.append(deduplicate_page(state, file_path, text, page_fingerprints,
+                                                references, threshold, min_words, max_postings))
+        return [page[2] for page in state.pages], [paragraph for page in state.pages for paragraph in page[4]]
+
+def deduplicate_page(state, file_path, text, fingerprints, references, threshold, min_words, max_postings):
+    kept = []
+    kept_paragraphs = []
+    removed = []
+    last_reference = None
+    for paragraph in fingerprints:
+        source = None
+        if paragraph.words >= min_words:
+            source = state.seen_exact.get(paragraph.exact)
+            if source is None:
+                source = near_duplicate_source(paragraph, state.sketch_index, threshold, max_postings)
+        if source is None:
+            kept.append(paragraph.text)
+            last_reference = None
+            if paragraph.words >= min_words:
+                kept_paragraphs.append(paragraph)
+                state.keep(paragraph, file_path, max_postings)
+            continue
+        removed.append(paragraph.text)
+        # One note for a run of paragraphs repeated from the same page
+        if references and source != last_reference:
+            kept.append(f"(Repeats text from {page_name(source)}.)")
+        last_reference = source
+    return file_path, fingerprints, "\n\n".join(kept) if removed else text, kept_paragraphs, removed
+
+def near_duplicate_source(paragraph, sketch_index, threshold, max_postings):
+    # Earlier paragraphs sharing sketch values with this one, and how many they share
+    shared = {}
+    for value in paragraph.sketch:
+        postings = sketch_index.get(value, ())
+        if len(postings) > max_postings:
+            continue
+        for earlier in postings:
+            entry = shared.get(id(earlier[0]))
+            if entry is None:
+                shared[id(earlier[0])] = [1, earlier]
+            else:
+                entry[0] += 1
+    for count, (earlier, source) in shared.values():
+        # The estimate can't be more than the shared values over the larger sketch.
+        if count < threshold * max(len(paragraph.sketch), len(earlier.sketch)):
+            continue
+        if similarity(paragraph, earlier) >= threshold:
+            return source
+    return None
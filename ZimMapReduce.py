@@ -0,0 +1,143 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from OpenAIInterface import get_client
+from SSEParser import StreamError
+from ZimContext import selected_page_texts, context_budget
+from ZimRetrieval import chunk_page
+from ZimDedup import page_name
+
+# Map-reduce mode, for page selections too big for the model's context. The
+# selected pages are packed into parts that each fit, and every part is asked
+# about the question on its own, several at once (the map stage). The notes that
+# come back go into the system message of the actual request, which is streamed
+# as usual (the reduce stage). If the notes are themselves too long they are
+# first combined in parts in the same way. A selection that fits in one part is
+# sent as it is.
+
+map_prompt = ("Below is one part of a larger set of notes. Using only this part, write down everything in it that helps"
+              " answer the question that follows: facts, names, numbers, quotes. If nothing in it is relevant, reply"
+              " with just: Nothing relevant.")
+combine_prompt = ("Below are notes taken from different parts of a larger set of notes, in answer to the question that"
+                  " follows. Combine them into one set of notes, keeping every relevant fact and dropping repetition.")
+notes_intro = "Notes taken from each part of the source material, in answer to the latest question:"
+no_notes = "None of the source material turned out to be relevant to the latest question."
+nothing_relevant = "nothing relevant"
+
+def part_question(messages):
+    """
+    What each part is asked: the newest question, with the exchange before it
+    so a follow up question makes sense on its own.
+    """
+    conversation = [message for message in messages[1:] if message["content"]]
+    if not conversation:
+        return ""
+    question = conversation[-1]["content"]
+    earlier = conversation[-3:-1]
+    if not earlier:
+        return question
+    context = "\n".join(f'{message["role"].capitalize()}: {message["content"]}' for message in earlier)
+    return f"Earlier in the conversation:\n{context}\n\nQuestion: {question}"
+
+def part_tokens(config, tokenizer, question):
+    """
+    How much of the pages fits in each part alongside the prompt, the question and the answer.
+    """
+    overhead = tokenizer.count(map_prompt) + tokenizer.count(question) + 16
+    budget = context_budget(dict(config, response_limit=config.get("map_response_limit", 512)), overhead)
+    if budget is None:
+        return config.get("part_tokens", 4096)
+    return max(budget, 256)
+
+def make_parts(pages, tokenizer, max_tokens):
+    """
+    Pack (file_path, text) pages in order into parts of at most max_tokens,
+    splitting pages that are too big for a part on their own.
+    """
+    parts = []
+    current = []
+    current_tokens = 0
+    for file_path, text in pages:
+        tokens = tokenizer.count(text)
+        if tokens <= max_tokens:
+            pieces = [(text, tokens)]
+        else:
+            chunks = chunk_page(text)
+            if file_path is not None:
+                chunks = [f"From {page_name(file_path)}:\n{chunk}" for chunk in chunks]
+            pieces = [(chunk, tokenizer.count(chunk)) for chunk in chunks]
+        for piece, tokens in pieces:
+            if current and current_tokens + tokens > max_tokens:
+                parts.append("\n\n".join(current))
+                current = []
+                current_tokens = 0
+            current.append(piece)
+            current_tokens += tokens
+    if current:
+        parts.append("\n\n".join(current))
+    return parts
+
+def ask_part(config, prompt, part, question, canceller, kind):
+    messages = [{"role": "system", "content": f"{prompt}\n\n{part}"}, {"role": "user", "content": question}]
+    answer = []
+    for event in get_client(config).query_streamed(messages, kind=kind, canceller=canceller,
+                                                   max_tokens=config.get("map_response_limit", 512)):
+        if isinstance(event, StreamError):
+            # Already printed, the other parts may still have something.
+            return ""
+        answer.append(event.content)
+    return "".join(answer).strip()
+
+def ask_parts(config, prompt, parts, question, canceller=None, kind="map"):
+    """
+    Ask every part the question, map_concurrency of them at a time (and no more
+    than the client's concurrent_streams). Returns the answers in order.
+    """
+    def ask(part):
+        part_canceller = canceller.child() if canceller is not None else None
+        if part_canceller is not None and part_canceller.is_set():
+            return ""
+        return ask_part(config, prompt, part, question, part_canceller, kind)
+    with ThreadPoolExecutor(max(1, config.get("map_concurrency", 4))) as executor:
+        return list(executor.map(ask, parts))
+
+def relevant(note):
+    return note and not note.lower().startswith(nothing_relevant)
+
+def map_reduce_system_message(context_settings, messages, config, tokenizer, metrics=None, canceller=None):
+    """
+    The system message for answering the newest question in messages from the
+    selected pages, asking the pages in parts first if they don't all fit.
+    The time each stage took is recorded in metrics.
+    """
+    start = time.perf_counter()
+    question = part_question(messages)
+    pages, _ = selected_page_texts(context_settings, config)
+    max_tokens = part_tokens(config, tokenizer, question)
+    parts = make_parts(pages, tokenizer, max_tokens)
+    if metrics is not None:
+        metrics.stage("split", len(parts), time.perf_counter() - start)
+    if len(parts) <= 1:
+        return {"role": "system", "content": config["system_prompt"] + "\n\n" + "\n\n".join(text for _, text in pages)}
+
+    start = time.perf_counter()
+    notes = [note for note in ask_parts(config, map_prompt, parts, question, canceller) if relevant(note)]
+    if metrics is not None:
+        metrics.stage("map", len(parts), time.perf_counter() - start)
+    # Too many notes to fit, combine them a part at a time. Each round shrinks
+    # them, a few rounds is plenty.
+    for _ in range(config.get("combine_rounds", 3)):
+        if len(notes) <= 1 or canceller is not None and canceller.is_set():
+            break
+        note_parts = make_parts([(None, note) for note in notes], tokenizer, max_tokens)
+        if len(note_parts) <= 1:
+            break
+        start = time.perf_counter()
+        notes = [note for note in ask_parts(config, combine_prompt, note_parts, question, canceller, "combine") if relevant(note)]
+        if metrics is not None:
+            metrics.stage("combine", len(note_parts), time.perf_counter() - start)
+
+    if not notes:
+        return {"role": "system", "content": config["system_prompt"] + "\n\n" + no_notes}
+    numbered = [f"Part {number}:\n{note}" for number, note in enumerate(notes, 1)]
+    return {"role": "system", "content": config["system_prompt"] + "\n\n" + notes_intro + "\n\n" + "\n\n".join(numbered)}
@@ -0,0 +1,96 @@
+import re
+
+# Turns Zim wiki markup into something more compact to put in the context, since
+# heading bars, link brackets, image references and blank lines all cost tokens
+# without telling the LLM anything. The "markup" config setting picks the mode:
+#   "raw"      - the page as Zim wrote it (the default)
+#   "markdown" - light markdown: headings, checkboxes and emphasis kept in markdown form
+#   "plain"    - plain text, only the words
+
+markup_modes = ("raw", "markdown", "plain")
+
+# A heading needs a title, a bare ==== line is a horizontal rule.
+heading_pattern = re.compile(r"^(={2,6})[ \t]*([^=\s].*?)[ \t]*=*[ \t]*$", re.MULTILINE)
+image_pattern = re.compile(r"\{\{[^}]*\}\}")
+link_pattern = re.compile(r"\[\[([^\]|]*)(?:\|([^\]]*))?\]\]")
+# Bare URLs, less any punctuation straight after them. They're kept out of the
+# emphasis rules, // in a URL isn't italics.
+url_pattern = re.compile(r"\b\w+://\S+?(?=[*_~'.,;:!?)]*(?:\s|$))")
+placeholder_pattern = re.compile("\x00(\\d+)\x00")
+checkbox_pattern = re.compile(r"^(\s*)(?:\* )?\[([ *x><])\] ", re.MULTILINE)
+glyph_pattern = re.compile(r"[☐☑☒]")
+italic_pattern = re.compile(r"(?<![:/])//(?=\S)(.+?)(?<=\S)//")
+verbatim_pattern = re.compile(r"''(.+?)''")
+underline_pattern = re.compile(r"__(.+?)__")
+bold_pattern = re.compile(r"\*\*(.+?)\*\*")
+strike_pattern = re.compile(r"~~(.+?)~~")
+trailing_space_pattern = re.compile(r"[ \t]+$", re.MULTILINE)
+blank_lines_pattern = re.compile(r"\n{3,}")
+
+# Zim's checkbox states: open, done, not done, moved (both ways)
+checkboxes = {" ": "[ ]", "*": "[x]", "x": "[-]", ">": "[>]", "<": "[<]"}
+glyphs = {"☐": "[ ]", "☑": "[x]", "☒": "[-]"}
+
+def link_text(match):
+    target, label = match.group(1), match.group(2)
+    if label:
+        return label
+    # Just the page name of a link like :Namespace:Page or +SubPage
+    return target.lstrip(":+").rsplit(":", 1)[-1]
+
+def heading(match, markdown):
+    # Zim has the most = signs on the top level heading.
+    if markdown:
+        return "#" * (7 - len(match.group(1))) + " " + match.group(2)
+    return match.group(2)
+
+def compact_page(text, markup="markdown"):
+    if markup == "raw":
+        return text
+    markdown = markup == "markdown"
+    text = heading_pattern.sub(lambda match: heading(match, markdown), text)
+    text = image_pattern.sub("", text)
+    # URLs, bare or linked, are swapped for placeholders until the inline rules
+    # are done. Only looked for on pages that could have them, it's a slow search.
+    protected = []
+    def protect(url):
+        protected.append(url)
+        return f"\x00{len(protected) - 1}\x00"
+    def link(match):
+        if not match.group(2) and url_pattern.match(match.group(1)):
+            return protect(match.group(1))
+        return link_text(match)
+    if "[[" in text:
+        text = link_pattern.sub(link, text)
+    if "://" in text:
+        text = url_pattern.sub(lambda match: protect(match.group(0)), text)
+    text = glyph_pattern.sub(lambda match: glyphs[match.group(0)], text)
+    if markdown:
+        text = checkbox_pattern.sub(lambda match: f"{match.group(1)}- {checkboxes[match.group(2)]} ", text)
+        text = italic_pattern.sub(r"*\1*", text)
+        text = verbatim_pattern.sub(r"`\1`", text)
+    else:
+        text = checkbox_pattern.sub(lambda match: f"{match.group(1)}{checkboxes[match.group(2)]} ", text)
+        text = bold_pattern.sub(r"\1", text)
+        text = italic_pattern.sub(r"\1", text)
+        text = verbatim_pattern.sub(r"\1", text)
+        text = strike_pattern.sub(r"\1", text)
+    text = underline_pattern.sub(r"\1", text)
+    if protected:
+        text = placeholder_pattern.sub(lambda match: protected[int(match.group(1))], text)
+    text = trailing_space_pattern.sub("", text)
+    text = blank_lines_pattern.sub("\n\n", text)
+    return text.strip()
+
+class CompactingTokenizer:
+    """
+    Counts the tokens of a page as it will be after compaction, under its own
+    name so the counts are stored separately from those of the raw pages.
+    """
+    def __init__(self, tokenizer, markup):
+        self.tokenizer = tokenizer
+        self.markup = markup
+        self.name = f"{tokenizer.name}/{markup}"
+
+    def count(self, text, estimate=True):
+        return self.tokenizer.count(compact_page(text, self.markup), estimate)
@@ -0,0 +1,65 @@
+import argparse
+import math
+import os
+import random
+import time
+
+# Writes synthetic Zim notebooks to benchmark and try things out on. Pages have
+# the usual three header lines, nest namespaces a few levels deep and vary in
+# length the way real notes do: mostly short, with a long tail of big ones.
+
+words = ("the dragon castle sword tavern goblin wizard quest treasure village king "
+         "forest river mountain dungeon spell potion knight ranger cleric rogue").split()
+
+def page_words(rng, mean_words, spread):
+    """
+    A log-normal page length with the given mean, spread 0 makes every page about the same.
+    """
+    if spread <= 0:
+        return max(1, rng.randint(mean_words // 2, mean_words * 3 // 2))
+    # Shifted so that the mean comes out at mean_words
+    return max(1, int(rng.lognormvariate(math.log(mean_words) - spread * spread / 2, spread)))
+
+def namespace_path(page, namespaces, depth):
+    # page spread over namespaces top level namespaces, each nested up to depth levels.
+    parts = [f"Namespace{page % namespaces}"]
+    for level in range(1, depth):
+        parts.append(f"Sub{level}_{(page // namespaces) % (level + 2)}")
+    return os.path.join(*parts)
+
+def make_synthetic_notebook(root_path, page_count, words_per_page=300, seed=0, namespaces=50, depth=1, spread=0.0):
+    """
+    Write a notebook.zim and page_count Zim pages with random text under root_path.
+    Each page is in one of namespaces top level namespaces, nested depth levels deep.
+    Page lengths average words_per_page, spread is the sigma of their log-normal
+    distribution (0 for pages all about the same length).
+    """
+    rng = random.Random(seed)
+    with open(os.path.join(root_path, "notebook.zim"), "w", encoding="utf-8") as file:
+        file.write("[Notebook]\nname=Synthetic\n")
+    for page in range(page_count):
+        page_dir = os.path.join(root_path, namespace_path(page, namespaces, depth))
+        os.makedirs(page_dir, exist_ok=True)
+        creation = time.strftime("%Y-%m-%dT%H:%M:%S+00:00", time.gmtime(1500000000 + page))
+        # Mostly common words, with some rarer made up names mixed in for searches to find.
+        body = " ".join(rng.choice(words) if rng.random() < 0.9 else f"{rng.choice(words)}{rng.randint(0, 5000)}"
+                        for _ in range(page_words(rng, words_per_page, spread)))
+        with open(os.path.join(page_dir, f"Page{page}.txt"), "w", encoding="utf-8") as file:
+            file.write("Content-Type: text/x-zim-wiki\nWiki-Format: zim 0.6\n")
+            file.write(f"Creation-Date: {creation}\n\n====== Page{page} ======\n{body}\n")
+
+def main():
+    parser = argparse.ArgumentParser(description="Write a synthetic Zim notebook.")
+    parser.add_argument("root_path")
+    parser.add_argument("--pages", type=int, default=1000)
+    parser.add_argument("--words", type=int, default=300, help="average words per page")
+    parser.add_argument("--spread", type=float, default=1.0, help="how much page lengths vary, 0 for not at all")
+    parser.add_argument("--namespaces", type=int, default=50, help="top level namespaces")
+    parser.add_argument("--depth", type=int, default=3, help="namespace nesting depth")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    os.makedirs(args.root_path, exist_ok=True)
+    make_synthetic_notebook(args.root_path, args.pages, args.words, args.seed, args.namespaces, args.depth, args.spread)
+
+if __name__ == "__main__":
+    main()
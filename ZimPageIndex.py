@@ -0,0 +1,208 @@
+import os
+import sqlite3
+import sys
+
+from ZimPageScanner import scan_notebook, count_page_tokens, read_page_body, _scan_records
+from TokenCounter import TokenizerUnavailable
+
+# Persistent index of the pages in a Zim notebook. It lives next to notebook.zim
+# so that reopening the "Select Pages" dialog only has to stat every page and
+# re-parse the ones that changed since the last scan.
+
+index_filename = ".chatzim_index.sqlite"
+
+# Bump this whenever the schema changes, old indexes are simply rebuilt.
+schema_version = 2
+
+# Pages with their token counts for two tokenizers (the second for compacted
+# pages, see ZimMarkup), where they're up to date.
+page_query = """SELECT pages.relative_path, creation_date, word_count, pages.mtime_ns, pages.size,
+        CASE WHEN token_counts.mtime_ns = pages.mtime_ns AND token_counts.size = pages.size
+             THEN token_counts.token_count END,
+        CASE WHEN compact.mtime_ns = pages.mtime_ns AND compact.size = pages.size
+             THEN compact.token_count END
+    FROM pages
+    LEFT JOIN token_counts ON token_counts.relative_path = pages.relative_path AND token_counts.tokenizer = ?
+    LEFT JOIN token_counts AS compact ON compact.relative_path = pages.relative_path AND compact.tokenizer = ?"""
+
+def page_dict(row):
+    return {"relative_path": row[0], "creation_date": row[1], "word_count": row[2],
+            "mtime_ns": row[3], "size": row[4], "token_count": row[5], "compact_token_count": row[6]}
+
+class ZimPageIndex:
+    def __init__(self, root_path, index_path=None):
+        self.root_path = root_path
+        if index_path is None:
+            index_path = os.path.join(root_path, index_filename)
+        try:
+            self.connection = sqlite3.connect(index_path)
+            self._create_tables()
+        except sqlite3.Error as e:
+            # Read-only notebook or similar, fall back to an index that only lasts this session.
+            print(f"Unable to open page index {index_path}: {e}", file=sys.stderr)
+            self.connection = sqlite3.connect(":memory:")
+            self._create_tables()
+
+    def _create_tables(self):
+        version = self.connection.execute("PRAGMA user_version").fetchone()[0]
+        if version == schema_version:
+            # Nothing to write, which would touch the notebook folder and wake the watcher.
+            return
+        self.connection.execute("DROP TABLE IF EXISTS pages")
+        self.connection.execute("DROP TABLE IF EXISTS token_counts")
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS pages (
+            relative_path TEXT PRIMARY KEY,
+            mtime_ns INTEGER NOT NULL,
+            size INTEGER NOT NULL,
+            creation_date TEXT,
+            word_count INTEGER NOT NULL)""")
+        # Token counts depend on the tokenizer, counts for a page are only valid
+        # while its mtime and size still match.
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS token_counts (
+            relative_path TEXT NOT NULL,
+            tokenizer TEXT NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            size INTEGER NOT NULL,
+            token_count INTEGER NOT NULL,
+            PRIMARY KEY (relative_path, tokenizer))""")
+        self.connection.execute(f"PRAGMA user_version = {schema_version}")
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        self.close()
+
+    def stale_pages(self, page_files):
+        """
+        Compare the stat results from list_page_files against the index.
+        Returns (changed, removed): the entries of page_files that need re-parsing
+        and the relative paths that are indexed but no longer exist.
+        """
+        known = self.page_keys()
+        changed = []
+        for relative_path, mtime_ns, size in page_files:
+            if known.pop(relative_path, None) != (mtime_ns, size):
+                changed.append((relative_path, mtime_ns, size))
+        return changed, list(known)
+
+    def update_pages(self, records):
+        """
+        Store freshly parsed pages. records is an iterable of
+        (relative_path, mtime_ns, size, creation_date, word_count).
+        """
+        self.connection.executemany("INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?)", records)
+        self.connection.commit()
+
+    def remove_pages(self, relative_paths):
+        paths = [(path,) for path in relative_paths]
+        self.connection.executemany("DELETE FROM pages WHERE relative_path = ?", paths)
+        self.connection.executemany("DELETE FROM token_counts WHERE relative_path = ?", paths)
+        self.connection.commit()
+
+    def page_keys(self):
+        """
+        {relative_path: (mtime_ns, size)} for every indexed page, to spot changes without statting them.
+        """
+        return {row[0]: (row[1], row[2]) for row in
+                self.connection.execute("SELECT relative_path, mtime_ns, size FROM pages")}
+
+    def missing_token_counts(self, tokenizer_name):
+        """
+        Pages (relative_path, mtime_ns, size) that have no up to date count for the tokenizer.
+        """
+        cursor = self.connection.execute("""SELECT pages.relative_path, pages.mtime_ns, pages.size FROM pages
+            LEFT JOIN token_counts ON token_counts.relative_path = pages.relative_path AND token_counts.tokenizer = ?
+            WHERE pages.creation_date IS NOT NULL AND (token_counts.token_count IS NULL
+                OR token_counts.mtime_ns != pages.mtime_ns OR token_counts.size != pages.size)""", (tokenizer_name,))
+        return cursor.fetchall()
+
+    def update_token_counts(self, tokenizer_name, records):
+        """
+        records is an iterable of (relative_path, mtime_ns, size, token_count).
+        """
+        self.connection.executemany("INSERT OR REPLACE INTO token_counts VALUES (?, ?, ?, ?, ?)",
+                                    [(path, tokenizer_name, mtime_ns, size, count) for path, mtime_ns, size, count in records])
+        self.connection.commit()
+
+    def refresh(self, progress=None, cancel_event=None, tokenizer=None, compact_tokenizer=None):
+        """
+        Bring the index up to date with the notebook on disk, re-parsing only
+        the pages whose mtime or size changed, and return all pages.
+        If a tokenizer is given pages are token counted too, and with
+        compact_tokenizer counted again as they'll be after compaction, see pages().
+        Returns None if the scan was cancelled through cancel_event.
+        """
+        if not scan_notebook(self, progress, cancel_event):
+            return None
+        for counter in (tokenizer, compact_tokenizer):
+            if counter is not None and not count_page_tokens(self, counter, progress, cancel_event):
+                return None
+        return self.pages(tokenizer.name if tokenizer else None, compact_tokenizer.name if compact_tokenizer else None)
+
+    def refresh_paths(self, relative_paths, tokenizer=None, compact_tokenizer=None):
+        """
+        Bring just the given pages up to date, for when it's known which files
+        may have changed. Paths that no longer exist are dropped from the index.
+        Changed pages are token counted with the same tokenizers as refresh().
+        Returns (changed, removed) relative paths.
+        """
+        page_files = []
+        gone = []
+        for relative_path in relative_paths:
+            try:
+                stat = os.stat(os.path.join(self.root_path, relative_path))
+            except OSError:
+                gone.append(relative_path)
+                continue
+            page_files.append((relative_path, stat.st_mtime_ns, stat.st_size))
+        known = {}
+        for relative_path in relative_paths:
+            row = self.connection.execute("SELECT mtime_ns, size FROM pages WHERE relative_path = ?", (relative_path,)).fetchone()
+            if row is not None:
+                known[relative_path] = row
+        changed = [page_file for page_file in page_files if known.get(page_file[0]) != page_file[1:]]
+        removed = [relative_path for relative_path in gone if relative_path in known]
+        self.remove_pages(removed)
+        records = _scan_records(self.root_path, changed, None)
+        self.update_pages(records)
+        counters = [counter for counter in (tokenizer, compact_tokenizer) if counter is not None]
+        if counters:
+            counts = {counter.name: [] for counter in counters}
+            for relative_path, mtime_ns, size, creation_date, words in records:
+                if creation_date is None:
+                    continue
+                try:
+                    body = read_page_body(os.path.join(self.root_path, relative_path))
+                    for counter in counters:
+                        counts[counter.name].append((relative_path, mtime_ns, size, counter.count(body, estimate=False)))
+                except (OSError, UnicodeDecodeError) as e:
+                    print(f"Unable to read page {relative_path}: {e}", file=sys.stderr)
+                except TokenizerUnavailable as e:
+                    # Counted on the next full scan instead.
+                    print(f"Leaving changed pages without a token count: {e}", file=sys.stderr)
+                    break
+            for name, counted in counts.items():
+                self.update_token_counts(name, counted)
+        return [page_file[0] for page_file in changed], removed
+
+    def page(self, relative_path, tokenizer_name=None, compact_tokenizer_name=None):
+        """
+        One page as a dict like pages() gives, or None if it isn't indexed.
+        """
+        row = self.connection.execute(page_query + " WHERE pages.relative_path = ?",
+                                      (tokenizer_name, compact_tokenizer_name, relative_path)).fetchone()
+        return page_dict(row) if row is not None else None
+
+    def pages(self, tokenizer_name=None, compact_tokenizer_name=None):
+        """
+        All indexed pages as dicts, sorted by relative path. token_count is the
+        cached count for tokenizer_name, or None if there isn't an up to date one,
+        and compact_token_count the same for compact_tokenizer_name.
+        """
+        cursor = self.connection.execute(page_query + " ORDER BY pages.relative_path", (tokenizer_name, compact_tokenizer_name))
+        return [page_dict(row) for row in cursor]
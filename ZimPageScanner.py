@@ -0,0 +1,183 @@
+import os
+import sys
+import time
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from TokenCounter import TokenizerUnavailable
+
+# Scans the pages of a Zim notebook. Only the bounded header at the top of each
+# page is parsed for the creation date, and the body is word counted while it's
+# streamed in rather than read into memory all at once. Pages are handled on a
+# thread pool since on a network share most of the time is spent waiting on I/O.
+
+# Zim page files start with a fixed three line header, the page body follows.
+header_lines = 3
+read_chunk_size = 64 * 1024
+
+def parse_creation_date(header):
+    """
+    Convert the Creation-Date line of a page header to Unix epoch seconds, as a string.
+    Returns None if the header doesn't have one where Zim puts it.
+    """
+    if len(header) >= 3:
+        creation_date_line = header[2].strip()
+        if creation_date_line.startswith("Creation-Date:"):
+            creation_date_str = creation_date_line.split(":", 1)[1].strip()
+            # Page ids have always been mktime() of the date as written, ignoring its
+            # UTC offset, so that has to be kept for existing .pages files to match.
+            # fromisoformat is much quicker than strptime and gives the same time tuple.
+            try:
+                time_tuple = datetime.fromisoformat(creation_date_str).timetuple()
+            except ValueError:
+                time_tuple = time.strptime(creation_date_str, "%Y-%m-%dT%H:%M:%S%z")
+            return str(int(time.mktime(time_tuple)))
+    return None
+
+def count_words_streamed(file):
+    """
+    Count whitespace separated words in the rest of an open text file, a chunk at a time.
+    """
+    words = 0
+    ended_in_word = False
+    while True:
+        chunk = file.read(read_chunk_size)
+        if not chunk:
+            return words
+        words += len(chunk.split())
+        # A word that straddles two chunks was counted once in each.
+        if ended_in_word and not chunk[0].isspace():
+            words -= 1
+        ended_in_word = not chunk[-1].isspace()
+
+def scan_page(file_path):
+    """
+    Returns (creation_date, word_count) for a page, reading it from disk once.
+    Pages without a creation date aren't word counted.
+    """
+    with open(file_path, 'r', encoding="utf-8") as file:
+        header = [file.readline() for _ in range(header_lines)]
+        creation_date = parse_creation_date(header)
+        if creation_date is None:
+            return None, 0
+        return creation_date, count_words_streamed(file)
+
+def read_page_body(file_path):
+    """
+    The text of a page after its header.
+    """
+    with open(file_path, 'r', encoding="utf-8") as file:
+        for _ in range(header_lines):
+            file.readline()
+        return file.read()
+
+def list_page_files(root_path):
+    """
+    Walk the notebook and return (relative_path, mtime_ns, size) for every page file.
+    Only stats the files, nothing is read.
+    """
+    page_files = []
+    for root, dirs, files in os.walk(root_path):
+        for file in files:
+            if file.endswith(".txt"):
+                file_path = os.path.join(root, file)
+                try:
+                    stat = os.stat(file_path)
+                except OSError:
+                    continue
+                page_files.append((os.path.relpath(file_path, root_path), stat.st_mtime_ns, stat.st_size))
+    return page_files
+
+def _scan_records(root_path, page_files, cancel_event):
+    records = []
+    for relative_path, mtime_ns, size in page_files:
+        if cancel_event is not None and cancel_event.is_set():
+            break
+        try:
+            creation_date, words = scan_page(os.path.join(root_path, relative_path))
+        except (OSError, UnicodeDecodeError, ValueError) as e:
+            print(f"Unable to read page {relative_path}: {e}", file=sys.stderr)
+            creation_date, words = None, 0
+        records.append((relative_path, mtime_ns, size, creation_date, words))
+    return records
+
+def scan_notebook(index, progress=None, cancel_event=None, max_workers=None, batch_size=64):
+    """
+    Bring a ZimPageIndex up to date, re-scanning the pages that changed on a thread pool.
+
+    Pages are handed to the pool batch_size at a time, progress is called as
+    progress(done, total) as each batch completes. If cancel_event
+    (a threading.Event) gets set the scan stops early and False is returned; the
+    pages scanned so far are kept in the index so the next scan picks up from there.
+    Returns True once the index is complete.
+    """
+    changed, removed = index.stale_pages(list_page_files(index.root_path))
+    index.remove_pages(removed)
+    total = len(changed)
+    if progress:
+        progress(0, total)
+    if total == 0:
+        return True
+
+    if max_workers == 1:
+        # Serial scan, quicker on fast local disks where there's no I/O wait to overlap.
+        done = 0
+        for start in range(0, total, batch_size):
+            records = _scan_records(index.root_path, changed[start:start + batch_size], cancel_event)
+            index.update_pages(records)
+            done += len(records)
+            if cancel_event is not None and cancel_event.is_set():
+                break
+            if progress:
+                progress(done, total)
+        return done == total
+
+    done = 0
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(_scan_records, index.root_path, changed[start:start + batch_size], cancel_event)
+                   for start in range(0, total, batch_size)]
+        for future in as_completed(futures):
+            records = future.result()
+            index.update_pages(records)
+            done += len(records)
+            if cancel_event is not None and cancel_event.is_set():
+                for pending in futures:
+                    pending.cancel()
+                break
+            if progress:
+                progress(done, total)
+    return done == total
+
+def count_page_tokens(index, tokenizer, progress=None, cancel_event=None, batch_size=64):
+    """
+    Token count the pages that don't have an up to date count for tokenizer yet
+    and store the counts in the index. Same progress and cancellation handling
+    as scan_notebook. If the tokenizer can't count (a server that's down) the
+    rest are left without a count, to be tried again next time.
+    """
+    missing = index.missing_token_counts(tokenizer.name)
+    total = len(missing)
+    if progress:
+        progress(0, total)
+    records = []
+    for done, (relative_path, mtime_ns, size) in enumerate(missing, 1):
+        if cancel_event is not None and cancel_event.is_set():
+            index.update_token_counts(tokenizer.name, records)
+            return False
+        try:
+            records.append((relative_path, mtime_ns, size,
+                            tokenizer.count(read_page_body(os.path.join(index.root_path, relative_path)), estimate=False)))
+        except (OSError, UnicodeDecodeError) as e:
+            print(f"Unable to read page {relative_path}: {e}", file=sys.stderr)
+        except TokenizerUnavailable as e:
+            print(f"Leaving the remaining pages without a token count: {e}", file=sys.stderr)
+            index.update_token_counts(tokenizer.name, records)
+            if progress:
+                progress(total, total)
+            return True
+        if len(records) >= batch_size or done == total:
+            index.update_token_counts(tokenizer.name, records)
+            records = []
+            if progress:
+                progress(done, total)
+    return True
@@ -0,0 +1,206 @@
+import os
+import json
+import sqlite3
+import sys
+import threading
+from itertools import groupby
+
+from BM25Index import BM25Index, chunk_term_counts
+from ZimPageScanner import read_page_body
+
+# Retrieval mode: instead of putting every selected page into the system message,
+# the notebook is split into chunks and only the chunks most relevant to the
+# current question are sent along with it.
+
+retrieval_index_filename = ".chatzim_bm25.sqlite"
+# Bump this when the schema changes, old indexes are simply rebuilt.
+retrieval_index_version = 2
+# Where earlier versions pickled the index. Never loaded, unpickling a file from
+# a synced or shared folder could run anything.
+legacy_index_filename = ".chatzim_bm25.pickle"
+
+def chunk_page(text, chunk_words=200):
+    """
+    Split a page into chunks of roughly chunk_words words along paragraph
+    boundaries. Paragraphs much longer than that get split up on their own.
+    """
+    chunks = []
+    current = []
+    current_words = 0
+    for paragraph in text.split("\n\n"):
+        paragraph = paragraph.strip()
+        if not paragraph:
+            continue
+        words = paragraph.split()
+        if len(words) > chunk_words * 2:
+            for start in range(0, len(words), chunk_words):
+                chunks.append(" ".join(words[start:start + chunk_words]))
+            continue
+        current.append(paragraph)
+        current_words += len(words)
+        if current_words >= chunk_words:
+            chunks.append("\n\n".join(current))
+            current = []
+            current_words = 0
+    if current:
+        chunks.append("\n\n".join(current))
+    return chunks
+
+def page_title(relative_path):
+    # Zim's own notation for page names, "Namespace:Page"
+    return os.path.splitext(relative_path)[0].replace(os.sep, ":")
+
+def query_text(messages, history_turns=2):
+    """
+    The text to search for: the newest user message plus the last few turns
+    before it, so follow up questions still find the right material.
+    """
+    conversation = [message for message in messages[1:] if message["content"]]
+    return "\n".join(message["content"] for message in conversation[-(history_turns * 2 + 1):])
+
+class NotebookRetriever:
+    """
+    Keeps a BM25 index of a notebook's pages in memory. The chunks and their
+    term counts are stored in an SQLite file next to notebook.zim, so only
+    pages whose mtime or size changed are re-chunked and only their rows are
+    rewritten. Every page is statted to spot changes, the notebook watcher only
+    follows the selected pages and retrieval searches them all. Safe to use
+    from a worker thread.
+    """
+    def __init__(self, root_path, chunk_words=200, index_path=None):
+        self.root_path = root_path
+        self.chunk_words = chunk_words
+        self.index_path = index_path or os.path.join(root_path, retrieval_index_filename)
+        self.lock = threading.Lock()
+        self.index = BM25Index()
+        try:
+            os.remove(os.path.join(root_path, legacy_index_filename))
+        except OSError:
+            pass
+        try:
+            self.connection = sqlite3.connect(self.index_path, check_same_thread=False)
+            self._create_tables()
+            self._load()
+        except sqlite3.Error as e:
+            print(f"Unable to open retrieval index {self.index_path}: {e}", file=sys.stderr)
+            self.connection = sqlite3.connect(":memory:", check_same_thread=False)
+            self._create_tables()
+
+    def _create_tables(self):
+        version = self.connection.execute("PRAGMA user_version").fetchone()[0]
+        if version != retrieval_index_version:
+            self.connection.execute("DROP TABLE IF EXISTS pages")
+            self.connection.execute("DROP TABLE IF EXISTS chunks")
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS pages (
+            relative_path TEXT PRIMARY KEY,
+            mtime_ns INTEGER NOT NULL,
+            size INTEGER NOT NULL,
+            chunk_words INTEGER NOT NULL)""")
+        # term_counts is the chunk's {term: frequency} as JSON, its share of the postings.
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS chunks (
+            relative_path TEXT NOT NULL,
+            position INTEGER NOT NULL,
+            text TEXT NOT NULL,
+            term_counts TEXT NOT NULL,
+            PRIMARY KEY (relative_path, position))""")
+        self.connection.execute(f"PRAGMA user_version = {retrieval_index_version}")
+        self.connection.commit()
+
+    def _load(self):
+        # Pages chunked to a different size are left out, and so get re-chunked.
+        cursor = self.connection.execute("""SELECT pages.relative_path, mtime_ns, size, text, term_counts
+            FROM pages LEFT JOIN chunks ON chunks.relative_path = pages.relative_path
+            WHERE chunk_words = ? ORDER BY pages.relative_path, position""", (self.chunk_words,))
+        for relative_path, rows in groupby(cursor, key=lambda row: row[0]):
+            rows = list(rows)
+            # A page with no text has the one row with no chunk.
+            chunks = [row[3] for row in rows if row[3] is not None]
+            term_counts = [json.loads(row[4]) for row in rows if row[3] is not None]
+            self.index.add_page(relative_path, (rows[0][1], rows[0][2]), chunks, term_counts)
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    def save(self, removed, updated):
+        """
+        Rewrite the rows of the pages that were removed or re-chunked. updated
+        is a list of (relative_path, key, chunks, term_counts).
+        """
+        try:
+            with self.connection:
+                paths = [(relative_path,) for relative_path in removed] + [(update[0],) for update in updated]
+                self.connection.executemany("DELETE FROM pages WHERE relative_path = ?", paths)
+                self.connection.executemany("DELETE FROM chunks WHERE relative_path = ?", paths)
+                self.connection.executemany("INSERT INTO pages VALUES (?, ?, ?, ?)",
+                                            [(relative_path, key[0], key[1], self.chunk_words)
+                                             for relative_path, key, _, _ in updated])
+                self.connection.executemany("INSERT INTO chunks VALUES (?, ?, ?, ?)",
+                                            [(relative_path, position, text, json.dumps(counts))
+                                             for relative_path, _, chunks, term_counts in updated
+                                             for position, (text, counts) in enumerate(zip(chunks, term_counts))])
+        except sqlite3.Error as e:
+            print(f"Unable to save retrieval index {self.index_path}: {e}", file=sys.stderr)
+
+    def refresh(self, relative_paths):
+        """
+        Bring the index in line with the given pages, re-chunking new and modified
+        ones and dropping the ones not listed. Saves the changes if there are any.
+        """
+        with self.lock:
+            wanted = set(relative_paths)
+            removed = [relative_path for relative_path in self.index.pages if relative_path not in wanted]
+            for relative_path in removed:
+                self.index.remove_page(relative_path)
+            updated = []
+            for relative_path in wanted:
+                file_path = os.path.join(self.root_path, relative_path)
+                try:
+                    stat = os.stat(file_path)
+                    key = (stat.st_mtime_ns, stat.st_size)
+                    if self.index.page_key(relative_path) == key:
+                        continue
+                    text = read_page_body(file_path)
+                except (OSError, UnicodeDecodeError) as e:
+                    print(f"Unable to read page {relative_path}: {e}", file=sys.stderr)
+                    continue
+                chunks = chunk_page(text, self.chunk_words)
+                term_counts = chunk_term_counts(chunks)
+                self.index.add_page(relative_path, key, chunks, term_counts)
+                updated.append((relative_path, key, chunks, term_counts))
+            if removed or updated:
+                self.save(removed, updated)
+            return bool(removed or updated)
+
+    def retrieve(self, query, tokenizer, token_budget, top_k=8):
+        """
+        The best matching chunks for query as (relative_path, text), best first,
+        stopping at top_k chunks or when token_budget would be exceeded.
+        """
+        with self.lock:
+            results = []
+            used = 0
+            for score, chunk_id in self.index.search(query, top_k):
+                relative_path, text, _ = self.index.chunks[chunk_id]
+                tokens = tokenizer.count(text)
+                if used + tokens > token_budget:
+                    continue
+                used += tokens
+                results.append((relative_path, text))
+            return results
+
+def build_retrieval_message(config, chunks):
+    excerpts = [f"From {page_title(relative_path)}:\n{text}" for relative_path, text in chunks]
+    return {
+        "role": "system",
+        "content": config["system_prompt"] + "\n\n" + "\n\n".join(excerpts)
+        }
+
+def retrieval_system_message(retriever, relative_paths, messages, config, tokenizer):
+    """
+    Refresh the retriever and build the system message for the newest question in messages.
+    """
+    retriever.refresh(relative_paths)
+    query = query_text(messages, config.get("retrieval_history_turns", 2))
+    chunks = retriever.retrieve(query, tokenizer, config.get("retrieval_tokens", 2048), config.get("retrieval_top_k", 8))
+    return build_retrieval_message(config, chunks)
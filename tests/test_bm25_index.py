@@ -0,0 +1,37 @@
+from BM25Index import BM25Index
+
+def build():
+    index = BM25Index()
+    index.add_page("Dragons.txt", 1, ["The red dragon sleeps in the mountain.", "Dragons hoard gold."])
+    index.add_page("Tavern.txt", 1, ["The tavern keeper sells ale.", "The tavern is by the river."])
+    index.add_page("River.txt", 1, ["The river floods in spring."])
+    return index
+
+def found(index, query, top_k=10):
+    return [index.chunks[chunk_id][0] for _, chunk_id in index.search(query, top_k)]
+
+def test_search_ranks_matching_chunks_first():
+    index = build()
+    assert found(index, "dragon", 1) == ["Dragons.txt"]
+    assert found(index, "tavern river")[0] == "Tavern.txt"
+    assert found(index, "unicorn") == []
+
+def test_common_terms_are_skipped_unless_nothing_else_matches():
+    index = build()
+    # "the" is in most chunks, only "ale" counts
+    assert found(index, "the ale") == ["Tavern.txt"]
+    assert len(found(index, "the")) == 4
+
+def test_replacing_and_removing_pages_keeps_postings_consistent():
+    index = build()
+    index.add_page("Dragons.txt", 2, ["Wyverns nest in the cliffs."])
+    assert index.page_key("Dragons.txt") == 2
+    assert found(index, "dragon") == []
+    assert found(index, "wyverns") == ["Dragons.txt"]
+    index.remove_page("Dragons.txt")
+    index.remove_page("Tavern.txt")
+    index.remove_page("River.txt")
+    assert len(index) == 0
+    assert index.postings == {}
+    assert index.total_length == 0
+    assert index.search("river") == []
@@ -0,0 +1,59 @@
+import json
+
+from ChatJournal import ConversationJournal, group_turns, import_conversation, is_journal, read_conversation
+
+def turn(question, answer):
+    return [{"role": "user", "content": question}, {"role": "assistant", "content": answer}]
+
+def test_round_trip(tmp_path):
+    path = str(tmp_path / "chat.jsonl")
+    journal = ConversationJournal.create(path, [turn("a", "1")])
+    journal.append_turn(turn("b", "2"))
+    journal.append_turn(turn("c", "3"))
+    journal.roll_back()
+    journal.write_summary({"text": "so far", "messages": 2})
+    assert is_journal(path)
+
+    reopened = ConversationJournal(path)
+    messages, summary = reopened.open(load_all=True)
+    assert messages == turn("a", "1") + turn("b", "2")
+    assert summary == {"text": "so far", "messages": 2}
+
+def test_open_leaves_summarized_turns_on_disk(tmp_path):
+    path = str(tmp_path / "chat.jsonl")
+    turns = [turn(f"q{n}", f"a{n}") for n in range(5)]
+    ConversationJournal.create(path, turns, {"text": "so far", "messages": 6})
+    journal = ConversationJournal(path)
+    messages, summary = journal.open(initial_turns=2)
+    assert messages == turns[3] + turns[4]
+    assert journal.unloaded_messages == 6
+    assert summary["messages"] == 0
+    assert journal.load_earlier(1) == turns[2]
+    assert journal.unloaded_messages == 4
+
+def test_incomplete_record_is_dropped(tmp_path):
+    path = str(tmp_path / "chat.jsonl")
+    ConversationJournal.create(path, [turn("a", "1")])
+    with open(path, "a", encoding="utf-8") as file:
+        file.write('{"type": "turn", "size": 2, "messages": [{"ro')
+    journal = ConversationJournal(path)
+    assert journal.open()[0] == turn("a", "1")
+    journal.append_turn(turn("b", "2"))
+    assert ConversationJournal(path).open()[0] == turn("a", "1") + turn("b", "2")
+
+def test_save_as_drops_undone_turns(tmp_path):
+    journal = ConversationJournal.create(str(tmp_path / "chat.jsonl"), [turn("a", "1"), turn("b", "2")])
+    journal.roll_back()
+    copy = journal.save_as(str(tmp_path / "copy.jsonl"))
+    with open(copy.path, encoding="utf-8") as file:
+        assert [json.loads(line)["type"] for line in file] == ["journal", "turn"]
+
+def test_legacy_conversation(tmp_path):
+    conv_path = str(tmp_path / "old.conv")
+    with open(conv_path, "w") as file:
+        json.dump({"messages": turn("a", "1") + turn("b", "2"), "summary": {"text": "s", "messages": 0}}, file)
+    assert not is_journal(conv_path)
+    messages, summary = read_conversation(conv_path)
+    assert group_turns(messages) == [turn("a", "1"), turn("b", "2")]
+    journal = import_conversation(conv_path, str(tmp_path / "new.jsonl"))
+    assert journal.open() == (messages, summary)
@@ -0,0 +1,207 @@
+import json
+import os
+import threading
+import time
+
+import pytest
+
+pytest.importorskip("PyQt6.QtWidgets")
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+from PyQt6 import sip
+from PyQt6.QtCore import QEvent
+from PyQt6.QtWidgets import QApplication
+
+import ChatZimSession
+from SSEParser import StreamDelta
+
+@pytest.fixture
+def session(tmp_path, monkeypatch):
+    # ChatZim.conf is read from the working directory, this way the defaults are used.
+    monkeypatch.chdir(tmp_path)
+    app = QApplication.instance() or QApplication([])
+    from ChatZim import ChatWindow
+    window = ChatWindow()
+    window.config["journal_dir"] = ""
+    yield window.current_session()
+    window.close()
+    app.processEvents()
+
+def wait_until(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        QApplication.processEvents()
+        time.sleep(0.005)
+
+def ask(session, monkeypatch, stream):
+    monkeypatch.setattr(ChatZimSession, "queryLLMStreamed", lambda *args: stream())
+    session.text_input.setText("Hello")
+    session.handle_return_pressed()
+
+def test_tokens_are_shown_in_batches(session, monkeypatch):
+    tokens = [f" word{n}" for n in range(2000)]
+    def stream():
+        for token in tokens:
+            yield StreamDelta(token)
+            time.sleep(0.0001)
+    shown = []
+    append_text = session.append_text
+    monkeypatch.setattr(session, "append_text", lambda text: (shown.append(text), append_text(text)))
+    ask(session, monkeypatch, stream)
+    wait_until(lambda: not session.busy())
+
+    assert session.messages[-1]["content"] == "".join(tokens)
+    assert "".join(shown) == "".join(tokens)
+    assert len(shown) < len(tokens) // 10
+
+def test_buffered_text_is_shown_while_the_stream_stalls(session, monkeypatch):
+    more = threading.Event()
+    release = threading.Event()
+    def stream():
+        yield StreamDelta("one")
+        more.wait(5)
+        for token in (" two", " three"):
+            yield StreamDelta(token)
+        release.wait(5)
+        yield StreamDelta(" four")
+    ask(session, monkeypatch, stream)
+
+    # The first token is shown straight away.
+    wait_until(lambda: session.response_parts == ["one"])
+    more.set()
+    # Nothing more arrives until release is set, the timer has to show what's held.
+    wait_until(lambda: "".join(session.response_parts) == "one two three")
+    assert session.busy()
+    release.set()
+    wait_until(lambda: not session.busy())
+    assert session.messages[-1]["content"] == "one two three four"
+
+def test_stopping_keeps_the_text_that_arrived(session, monkeypatch):
+    release = threading.Event()
+    def stream():
+        yield StreamDelta("partial")
+        release.wait(5)
+    ask(session, monkeypatch, stream)
+    wait_until(lambda: session.response_parts)
+    session.stop_response()
+    release.set()
+    assert session.messages[-1]["content"] == "partial"
+    assert not session.flush_timer.isActive()
+    wait_until(session.idle)
+
+def answer(session, monkeypatch, question, reply):
+    monkeypatch.setattr(ChatZimSession, "queryLLMStreamed", lambda *args: iter([StreamDelta(reply)]))
+    session.text_input.setText(question)
+    session.handle_return_pressed()
+    wait_until(lambda: not session.busy())
+
+def save(session, monkeypatch, path):
+    monkeypatch.setattr(ChatZimSession.QFileDialog, "getSaveFileName", lambda *args: (path, ""))
+    session.save_conversation()
+
+def questions(path):
+    messages, _ = ChatZimSession.ConversationJournal(path).open(load_all=True)
+    return [message["content"] for message in messages if message["role"] == "user"]
+
+def test_undo_without_autosave_leaves_the_saved_file_alone(session, monkeypatch, tmp_path):
+    path = str(tmp_path / "saved.jsonl")
+    answer(session, monkeypatch, "A", "1")
+    answer(session, monkeypatch, "B", "2")
+    save(session, monkeypatch, path)
+    answer(session, monkeypatch, "C", "3")
+    session.roll_back()
+    assert questions(path) == ["A", "B"]
+
+    answer(session, monkeypatch, "D", "4")
+    save(session, monkeypatch, path)
+    assert questions(path) == ["A", "B", "D"]
+
+def test_legacy_conversation_without_autosave_writes_nothing(session, tmp_path):
+    conv_path = tmp_path / "old.conv"
+    conv_path.write_text(json.dumps([{"role": "user", "content": "A"}, {"role": "assistant", "content": "1"}]))
+    session.open_conversation(str(conv_path))
+    assert [message["content"] for message in session.messages[1:]] == ["A", "1"]
+    assert sorted(os.listdir(tmp_path)) == ["old.conv"]
+
+def test_stopping_before_it_is_sent_drops_the_question(session, monkeypatch):
+    release = threading.Event()
+    def stream():
+        # Waiting for a slot, nothing sent yet
+        release.wait(5)
+        yield StreamDelta("too late")
+    ask(session, monkeypatch, stream)
+    session.stop_response()
+    release.set()
+    assert session.messages == [session.chat_window.system_context.message]
+    assert session.text_input.text() == "Hello"
+    assert session.status == "Stopped before it was sent"
+    wait_until(session.idle)
+
+def test_closed_tabs_are_deleted(session, monkeypatch):
+    window = session.chat_window
+    release = threading.Event()
+    def stream():
+        yield StreamDelta("partial")
+        release.wait(5)
+    ask(session, monkeypatch, stream)
+    wait_until(lambda: session.response_parts)
+    idle_session = window.new_session()
+    window.close_session(window.tabs.indexOf(idle_session))
+    window.close_session(window.tabs.indexOf(session))
+    QApplication.sendPostedEvents(None, QEvent.Type.DeferredDelete)
+    assert sip.isdeleted(idle_session)
+    # Kept until its worker has unwound
+    assert not sip.isdeleted(session)
+    release.set()
+    wait_until(lambda: not window.closed_sessions)
+    QApplication.sendPostedEvents(None, QEvent.Type.DeferredDelete)
+    assert sip.isdeleted(session)
+
+def test_streaming_does_not_recount_the_history(session, monkeypatch):
+    window = session.chat_window
+    flushes = []
+    counts = []
+    show_session_status = window.show_session_status
+    monkeypatch.setattr(window, "show_session_status", lambda session: (flushes.append(True), show_session_status(session)))
+    history_token_count = session.history_token_count
+    monkeypatch.setattr(session, "history_token_count", lambda: (counts.append(True), history_token_count())[1])
+    def stream():
+        for n in range(30):
+            yield StreamDelta(f" word{n}")
+            time.sleep(0.01)
+    ask(session, monkeypatch, stream)
+    counts.clear()
+    wait_until(lambda: not session.busy())
+    assert len(flushes) > 3
+    # Once, for the header at the end of the turn
+    assert len(counts) == 1
+
+def test_a_failed_summary_lets_the_next_one_start(session, monkeypatch):
+    calls = []
+    def failing_query(messages, config):
+        calls.append(messages)
+        raise ValueError("not a chat completion")
+    monkeypatch.setattr(ChatZimSession, "queryLLM", failing_query)
+    session.config["history_tokens"] = 10
+    answer(session, monkeypatch, "A long enough question to go over the budget", "And an answer to match it")
+    wait_until(lambda: calls and session.summary_thread is None)
+    answer(session, monkeypatch, "Another question", "Another answer")
+    wait_until(lambda: len(calls) == 2 and session.summary_thread is None)
+
+def test_undo_is_disabled_while_answering(session, monkeypatch, tmp_path):
+    window = session.chat_window
+    session.config["journal_dir"] = str(tmp_path / "conversations")
+    answer(session, monkeypatch, "A", "1")
+    release = threading.Event()
+    def stream():
+        yield StreamDelta("2")
+        release.wait(5)
+    ask(session, monkeypatch, stream)
+    assert not window.roll_back_action.isEnabled()
+    window.roll_back()
+    release.set()
+    wait_until(lambda: not session.busy())
+    assert window.roll_back_action.isEnabled()
+    assert [message["content"] for message in session.messages[1:]] == ["A", "1", "Hello", "2"]
+    assert questions(session.journal.path) == ["A", "Hello"]
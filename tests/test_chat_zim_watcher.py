@@ -0,0 +1,56 @@
+import os
+import time
+
+import pytest
+
+pytest.importorskip("PyQt6.QtWidgets")
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+from PyQt6.QtWidgets import QApplication
+
+from ChatZimWatcher import NotebookWatcher
+from ZimPageIndex import ZimPageIndex, index_filename
+
+header = "Content-Type: text/x-zim-wiki\nWiki-Format: zim 0.6\nCreation-Date: 2024-01-01T00:00:00+00:00\n"
+
+def pump(seconds):
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        QApplication.processEvents()
+        time.sleep(0.005)
+
+@pytest.fixture
+def notebook(tmp_path):
+    app = QApplication.instance() or QApplication([])
+    root = str(tmp_path)
+    with open(os.path.join(root, "Home.txt"), "w", encoding="utf-8") as file:
+        file.write(header + "one two")
+    watcher = NotebookWatcher(debounce_ms=50)
+    reports = []
+    watcher.pages_changed.connect(reports.append)
+    watcher.watch(root, ["Home.txt"])
+    yield root, reports
+    watcher.stop()
+    app.processEvents()
+
+def test_other_files_in_a_watched_folder_are_ignored(notebook):
+    root, reports = notebook
+    with open(os.path.join(root, "notes.tmp"), "w") as file:
+        file.write("not a page")
+    os.remove(os.path.join(root, "notes.tmp"))
+    pump(0.3)
+    assert reports == []
+
+def test_the_page_index_does_not_wake_the_watcher(notebook):
+    root, reports = notebook
+    with open(os.path.join(root, "Home.txt"), "a", encoding="utf-8") as file:
+        file.write(" three")
+    pump(0.3)
+    assert reports == [["Home.txt"]]
+    # What ChatWindow.on_pages_changed does with each report
+    for _ in range(3):
+        with ZimPageIndex(root) as index:
+            index.refresh_paths(reports[-1])
+        pump(0.3)
+    assert reports == [["Home.txt"]]
+    assert os.path.exists(os.path.join(root, index_filename))
@@ -0,0 +1,75 @@
+import os
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from EmbeddingStore import HashingEmbedder, SemanticRetriever, normalize
+
+def write_page(root, name, body):
+    with open(os.path.join(root, name), "w", encoding="utf-8") as file:
+        file.write("Content-Type: text/x-zim-wiki\nWiki-Format: zim 0.6\nCreation-Date: 2024-01-01T00:00:00+00:00\n")
+        file.write(body)
+
+def paragraphs(*topics):
+    return "\n\n".join(" ".join(f"{topic}{n}" for n in range(20)) for topic in topics)
+
+def live_norms(store):
+    return [float(np.linalg.norm(store.vectors[row_id])) for row_id, row in enumerate(store.rows) if row is not None]
+
+def test_editing_one_chunk_keeps_the_others(tmp_path):
+    root = str(tmp_path)
+    write_page(root, "page.txt", paragraphs("apple", "banana", "cherry", "damson"))
+    retriever = SemanticRetriever(root, HashingEmbedder(), chunk_words=20)
+    assert retriever.refresh(["page.txt"])
+    assert len(live_norms(retriever.store)) == 4
+
+    write_page(root, "page.txt", paragraphs("apple", "banana", "cherry", "elder"))
+    os.utime(os.path.join(root, "page.txt"), ns=(1, 1))
+    assert retriever.refresh(["page.txt"])
+
+    norms = live_norms(retriever.store)
+    assert len(norms) == 4
+    assert all(norm > 0.99 for norm in norms)
+
+def test_search_skips_free_rows(tmp_path):
+    root = str(tmp_path)
+    write_page(root, "a.txt", paragraphs("apple", "banana"))
+    write_page(root, "b.txt", paragraphs("cherry", "damson", "elder"))
+    retriever = SemanticRetriever(root, HashingEmbedder(), chunk_words=20)
+    retriever.refresh(["a.txt", "b.txt"])
+    retriever.refresh(["b.txt"])
+    store = retriever.store
+    assert store.free_rows() == 2
+
+    query = normalize(HashingEmbedder().embed(["apple0 apple1"]))[0]
+    hits = store.search(query, 3)
+    assert len(hits) == 3
+    assert all(store.rows[row_id] is not None for _, row_id in hits)
+    assert len(store.search(query, 10)) == 3
+
+class CountingNumpy:
+    def __init__(self):
+        self.arrays = 0
+
+    def array(self, *args, **kwargs):
+        self.arrays += 1
+        return np.array(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(np, name)
+
+def test_only_the_edited_pages_vectors_are_copied(tmp_path, monkeypatch):
+    root = str(tmp_path)
+    write_page(root, "a.txt", paragraphs("apple", "banana", "fig", "grape"))
+    write_page(root, "b.txt", paragraphs("cherry", "damson"))
+    retriever = SemanticRetriever(root, HashingEmbedder(), chunk_words=20)
+    retriever.refresh(["a.txt", "b.txt"])
+
+    write_page(root, "b.txt", paragraphs("cherry", "elder"))
+    os.utime(os.path.join(root, "b.txt"), ns=(1, 1))
+    counting = CountingNumpy()
+    monkeypatch.setattr("EmbeddingStore.np", counting)
+    assert retriever.refresh(["a.txt", "b.txt"])
+    # The kept cherry chunk, then the new rows being appended
+    assert counting.arrays == 2
@@ -0,0 +1,83 @@
+import gzip
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+
+from MockOpenAIServer import MockOpenAIServer
+from OpenAIInterface import RequestSlots, StreamCanceller, queryLLM, queryLLMStreamed, shutdown_response
+from SSEParser import StreamDelta
+
+class GzipHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        events = [{"choices": [{"index": 0, "delta": {"content": word}, "finish_reason": None}]} for word in ("Hello", " there")]
+        body = b"".join(b"data: " + json.dumps(event).encode("utf-8") + b"\n\n" for event in events) + b"data: [DONE]\n\n"
+        body = gzip.compress(body)
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+@pytest.fixture
+def gzip_server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), GzipHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}/v1/chat/completions"
+    server.shutdown()
+    server.server_close()
+
+def test_compressed_stream_is_decoded(gzip_server):
+    config = {"api_url": gzip_server, "metrics_log": "", "connect_retries": 0}
+    events = list(queryLLMStreamed([{"role": "user", "content": "hi"}], config))
+    assert all(isinstance(event, StreamDelta) for event in events)
+    assert "".join(event.content for event in events) == "Hello there"
+
+def test_shutdown_falls_back_to_closing():
+    response = requests.Response()
+    closed = []
+    response.raw = object()
+    response.close = lambda: closed.append(True)
+    shutdown_response(response)
+    assert closed == [True]
+
+def test_canceller_shuts_down_a_response_attached_later():
+    canceller = StreamCanceller()
+    canceller.cancel()
+    response = requests.Response()
+    closed = []
+    response.raw = object()
+    response.close = lambda: closed.append(True)
+    canceller.attach(response)
+    assert closed == [True]
+
+def test_requests_wait_for_a_slot():
+    with MockOpenAIServer(tokens_per_second=100, reply_tokens=20) as server:
+        config = {"api_url": server.url, "metrics_log": "", "concurrent_streams": 1}
+        stream = queryLLMStreamed([{"role": "user", "content": "hi"}], config)
+        next(stream)
+        answers = []
+        thread = threading.Thread(target=lambda: answers.append(queryLLM([{"role": "user", "content": "hi"}], config)))
+        thread.start()
+        time.sleep(0.2)
+        # The summary-style query is held back until the stream is done with its slot.
+        assert server.requests == 1 and not answers
+        list(stream)
+        thread.join(5)
+        assert server.requests == 2 and answers[0]
+
+def test_waiting_for_a_slot_can_be_cancelled():
+    slots = RequestSlots(1)
+    assert slots.acquire()
+    canceller = StreamCanceller()
+    threading.Timer(0.1, canceller.cancel).start()
+    assert not slots.acquire(canceller)
@@ -0,0 +1,45 @@
+import json
+
+import pytest
+
+import SSEParser
+from SSEParser import SSEParser as Parser, StreamDelta, StreamError, chat_event, stdlib_json_loads
+
+def feed_all(parser, data, size):
+    events = []
+    for start in range(0, len(data), size):
+        events.extend(parser.feed(data[start:start + size]))
+    return events
+
+@pytest.mark.parametrize("size", [1, 2, 3, 7, 1000])
+def test_events_split_anywhere(size):
+    data = (b"\xef\xbb\xbfdata: one\r\n\r\n: keep-alive\n\nevent: error\nid: 7\ndata: two\ndata: three\r\r"
+            b"data:four\n\nretry: 500\n\ndata: unfinished")
+    parser = Parser()
+    events = feed_all(parser, data, size)
+    assert [(event.event, event.data, event.id) for event in events] == [
+        ("message", b"one", ""), ("error", b"two\nthree", "7"), ("message", b"four", "7")]
+    assert parser.retry == 500
+
+def test_stdlib_json_loads_matches_json():
+    for text in [b'{"a": [1, 2.5, null, "\\u00e9"]}', b'  {"a": 1}  ', b'"x"']:
+        assert stdlib_json_loads(text) == json.loads(text)
+    for text in [b'{"a": 1} junk', b'{"a": ', b""]:
+        with pytest.raises(ValueError):
+            stdlib_json_loads(text)
+
+def test_json_loads_raises_value_error():
+    with pytest.raises(ValueError):
+        SSEParser.json_loads(b"[DONE")
+
+def test_chat_event():
+    delta = chat_event({"choices": [{"index": 0, "delta": {"role": "assistant", "content": "Hi"}, "finish_reason": None}]})
+    assert isinstance(delta, StreamDelta)
+    assert (delta.content, delta.role, delta.finish_reason) == ("Hi", "assistant", None)
+
+    final = chat_event({"choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}], "usage": {"completion_tokens": 3}})
+    assert (final.content, final.finish_reason, final.usage) == ("", "stop", {"completion_tokens": 3})
+    assert chat_event({"choices": [], "usage": {"prompt_tokens": 5}}).usage == {"prompt_tokens": 5}
+
+    error = chat_event({"error": {"message": "out of memory"}})
+    assert isinstance(error, StreamError) and error.message == "out of memory"
@@ -0,0 +1,35 @@
+from ZimContext import PrefixTracker, selected_file_paths, update_page_order, prompt_text
+
+def settings(*selected):
+    pages = {str(n): {"relative_path": name, "selected": name in selected} for n, name in enumerate("abcd")}
+    return {"root_path": "", "pages": pages}
+
+def test_stable_order_is_only_written_by_update_page_order():
+    context_settings = settings("c", "d")
+    update_page_order(context_settings)
+    context_settings["pages"]["0"]["selected"] = True
+    assert selected_file_paths(context_settings, stable=True) == ["c", "d", "a"]
+    assert context_settings["page_order"] == ["c", "d"]
+    update_page_order(context_settings)
+    assert context_settings["page_order"] == ["c", "d", "a"]
+    assert selected_file_paths(context_settings) == ["a", "c", "d"]
+
+def test_prefix_report_uses_per_message_counts():
+    system = {"role": "system", "content": "pages " * 50}
+    first = [system, {"role": "user", "content": "question one"}]
+    second = first + [{"role": "assistant", "content": "answer"}, {"role": "user", "content": "question two"}]
+    counted = []
+    def count(message):
+        counted.append(message["content"])
+        return len(message["content"].split())
+
+    tracker = PrefixTracker()
+    tracker.update(first)
+    assert tracker.report is None and not counted
+    assert tracker.count_tokens(count) == (0, len(prompt_text(first)), 0, 52)
+
+    tracker.update(second)
+    unchanged_bytes, total_bytes, unchanged_tokens, total_tokens = tracker.count_tokens(count)
+    assert unchanged_bytes == len(prompt_text(first))
+    assert total_bytes == len(prompt_text(second))
+    assert (unchanged_tokens, total_tokens) == (52, 55)
@@ -0,0 +1,65 @@
+import ZimDedup
+from ZimDedup import DedupState, FingerprintCache, ParagraphFingerprint, deduplicate, similarity
+
+stat_block = "The goblin chief has twelve hit points, a rusty spear and a grudge against the baron of the valley."
+
+def test_exact_repeats_are_replaced_by_a_reference():
+    pages = [("Notes/Goblins.txt", f"Goblins\n\n{stat_block}"),
+             ("Notes/Cave_Lair.txt", f"The cave\n\n{stat_block}")]
+    texts, removed = deduplicate(pages, cache=FingerprintCache(), state=DedupState())
+    assert texts[0] == pages[0][1]
+    assert texts[1] == "The cave\n\n(Repeats text from Goblins.)"
+    assert removed == [stat_block]
+
+def test_near_repeats_are_dropped_without_references():
+    edited = stat_block.replace("twelve", "fourteen")
+    pages = [("a.txt", stat_block), ("b.txt", f"Intro\n\n{edited}")]
+    texts, removed = deduplicate(pages, references=False, threshold=0.5, cache=FingerprintCache(), state=DedupState())
+    assert texts == [stat_block, "Intro"]
+    assert removed == [edited]
+
+def test_short_paragraphs_are_always_kept():
+    pages = [("a.txt", "Stats\n\nSession one"), ("b.txt", "Stats\n\nSession two")]
+    texts, removed = deduplicate(pages, cache=FingerprintCache(), state=DedupState())
+    assert texts == [pages[0][1], pages[1][1]]
+    assert removed == []
+
+def test_unrelated_paragraphs_are_not_similar():
+    a = ParagraphFingerprint(stat_block)
+    b = ParagraphFingerprint("A long road winds north through the hills towards the ruined tower of the old mage.")
+    assert similarity(a, a) == 1.0
+    assert similarity(a, b) < 0.2
+
+def test_cache_refingerprints_changed_pages():
+    cache = FingerprintCache(max_pages=1)
+    first = cache.get("a.txt", stat_block)
+    assert cache.get("a.txt", stat_block) is first
+    assert cache.get("a.txt", stat_block + " More.") is not first
+    cache.get("b.txt", stat_block)
+    # Only one page is kept
+    assert list(cache.entries) == ["b.txt"]
+
+def campaign(intro):
+    return [("a.txt", f"{intro}\n\n{stat_block}"),
+            ("b.txt", f"Middle\n\n{stat_block}\n\nThe baron rides out at dawn with forty knights and a sullen wizard in tow."),
+            ("c.txt", "The baron rides out at dawn with forty knights and a sullen wizard in tow.")]
+
+def test_later_calls_only_compare_pages_from_the_first_change(monkeypatch):
+    compared = []
+    near_duplicate_source = ZimDedup.near_duplicate_source
+    monkeypatch.setattr(ZimDedup, "near_duplicate_source", lambda paragraph, *args: (compared.append(paragraph.text), near_duplicate_source(paragraph, *args))[1])
+    cache = FingerprintCache()
+    state = DedupState()
+    first = deduplicate(campaign("Intro"), cache=cache, state=state)
+    assert compared
+    compared.clear()
+    assert deduplicate(campaign("Intro"), cache=cache, state=state) == first
+    assert compared == []
+
+    pages = campaign("Intro")
+    pages[1] = ("b.txt", pages[1][1].replace("forty", "fifty"))
+    result = deduplicate(pages, cache=cache, state=state)
+    # a.txt is taken as it was
+    assert stat_block not in compared
+    assert result == deduplicate(pages, cache=FingerprintCache(), state=DedupState())
+    assert result[0][2] == "The baron rides out at dawn with forty knights and a sullen wizard in tow."
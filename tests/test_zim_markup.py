@@ -0,0 +1,62 @@
+from TokenCounter import EstimateTokenizer
+from ZimMarkup import compact_page, CompactingTokenizer
+
+page = """====== Trip ======
+Created Monday
+
+===== Packing =====
+[*] **boots** and //maps//
+[ ] ''stove''
+{{./photo.png}}
+See [[:Places:Harbour]] and [[+Crew|the crew]].
+
+
+
+===== Notes ====="""
+
+def test_raw_is_unchanged():
+    assert compact_page(page, "raw") == page
+
+def test_markdown():
+    assert compact_page(page, "markdown") == """# Trip
+Created Monday
+
+## Packing
+- [x] **boots** and *maps*
+- [ ] `stove`
+
+See Harbour and the crew.
+
+## Notes"""
+
+def test_plain():
+    assert compact_page(page, "plain") == """Trip
+Created Monday
+
+Packing
+[x] boots and maps
+[ ] stove
+
+See Harbour and the crew.
+
+Notes"""
+
+def test_urls_are_left_alone():
+    text = "Mirror at http://example.com//path// and **https://example.org/a__b__c**."
+    assert compact_page(text, "markdown") == text
+    assert compact_page(text, "plain") == "Mirror at http://example.com//path// and https://example.org/a__b__c."
+    assert compact_page("[[http://example.com//path//]] [[https://example.org|site]]", "plain") == "http://example.com//path// site"
+
+def test_link_labels_are_formatted():
+    assert compact_page("[[Page|a //b// c]] [[http://x.org|**d**]]", "plain") == "a b c d"
+
+def test_bare_rule_is_not_a_heading():
+    assert compact_page("above\n====\nbelow", "markdown") == "above\n====\nbelow"
+    assert compact_page("== Title ==", "markdown") == "##### Title"
+
+def test_compacting_tokenizer_counts_the_compacted_page():
+    tokenizer = EstimateTokenizer()
+    compact = CompactingTokenizer(tokenizer, "plain")
+    assert compact.name == "estimate/plain"
+    assert compact.count(page) == tokenizer.count(compact_page(page, "plain"))
+    assert compact.count(page) < tokenizer.count(page)
@@ -0,0 +1,47 @@
+import os
+
+from TokenCounter import EstimateTokenizer
+from ZimMarkup import CompactingTokenizer
+from ZimPageIndex import ZimPageIndex
+
+header = "Content-Type: text/x-zim-wiki\nWiki-Format: zim 0.6\nCreation-Date: 2024-01-01T00:00:00+00:00\n"
+
+def write_page(root, relative_path, body):
+    path = os.path.join(root, relative_path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w", encoding="utf-8") as file:
+        file.write(header + body)
+
+def test_refresh_finds_new_changed_and_removed_pages(tmp_path):
+    root = str(tmp_path)
+    write_page(root, "Home.txt", "one two three")
+    write_page(root, os.path.join("Notes", "Old.txt"), "four five")
+    with ZimPageIndex(root) as index:
+        pages = index.refresh()
+        assert [page["relative_path"] for page in pages] == ["Home.txt", os.path.join("Notes", "Old.txt")]
+        assert [page["word_count"] for page in pages] == [3, 2]
+
+        os.remove(os.path.join(root, "Notes", "Old.txt"))
+        write_page(root, "Home.txt", "one two three four")
+        os.utime(os.path.join(root, "Home.txt"), ns=(1, 1))
+        pages = index.refresh()
+        assert [(page["relative_path"], page["word_count"]) for page in pages] == [("Home.txt", 4)]
+
+def test_refresh_paths_updates_both_token_counts(tmp_path):
+    root = str(tmp_path)
+    write_page(root, "Home.txt", "====== Home ======\n**bold** words")
+    tokenizer = EstimateTokenizer()
+    compact_tokenizer = CompactingTokenizer(tokenizer, "plain")
+    with ZimPageIndex(root) as index:
+        index.refresh(tokenizer=tokenizer, compact_tokenizer=compact_tokenizer)
+        before = index.page("Home.txt", tokenizer.name, compact_tokenizer.name)
+
+        write_page(root, "Home.txt", "====== Home ======\n**bold** words and **more** of them")
+        os.utime(os.path.join(root, "Home.txt"), ns=(1, 1))
+        assert index.refresh_paths(["Home.txt"], tokenizer, compact_tokenizer) == (["Home.txt"], [])
+
+        page = index.page("Home.txt", tokenizer.name, compact_tokenizer.name)
+        assert page["token_count"] > before["token_count"]
+        assert page["compact_token_count"] is not None
+        assert page["compact_token_count"] > before["compact_token_count"]
+        assert page["compact_token_count"] < page["token_count"]
@@ -0,0 +1,52 @@
+import io
+import os
+import threading
+import time
+
+from ZimPageIndex import ZimPageIndex
+from ZimPageScanner import count_words_streamed, parse_creation_date, read_page_body, scan_notebook, scan_page
+
+header = "Content-Type: text/x-zim-wiki\nWiki-Format: zim 0.6\nCreation-Date: 2024-01-01T12:30:00+01:00\n"
+
+def write_page(root, relative_path, text):
+    path = os.path.join(root, relative_path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w", encoding="utf-8") as file:
+        file.write(text)
+    return path
+
+def test_creation_date_ignores_the_utc_offset():
+    # Page ids have always been mktime() of the date as written.
+    expected = str(int(time.mktime((2024, 1, 1, 12, 30, 0, 0, 1, -1))))
+    assert parse_creation_date(header.splitlines(True)) == expected
+    assert parse_creation_date(["Content-Type: text/x-zim-wiki\n", "Wiki-Format: zim 0.6\n"]) is None
+
+def test_words_straddling_chunks_are_counted_once(monkeypatch):
+    text = "alpha beta gamma delta " * 1000
+    monkeypatch.setattr("ZimPageScanner.read_chunk_size", 7)
+    assert count_words_streamed(io.StringIO(text)) == 4000
+
+def test_scan_page_reads_the_header_and_body(tmp_path):
+    path = write_page(str(tmp_path), "Home.txt", header + "one two\nthree")
+    assert scan_page(path)[1] == 3
+    assert read_page_body(path) == "one two\nthree"
+    # Without a creation date it isn't a page worth counting
+    assert scan_page(write_page(str(tmp_path), "Other.txt", "just text")) == (None, 0)
+
+def test_scan_notebook_can_be_cancelled_and_resumed(tmp_path):
+    root = str(tmp_path)
+    for number in range(10):
+        write_page(root, os.path.join("Pages", f"P{number}.txt"), header + "word " * number)
+    cancel_event = threading.Event()
+    progress = []
+    def cancel_after_first_batch(done, total):
+        progress.append((done, total))
+        if done:
+            cancel_event.set()
+    with ZimPageIndex(root) as index:
+        assert not scan_notebook(index, cancel_after_first_batch, cancel_event, max_workers=1, batch_size=4)
+        assert progress == [(0, 10), (4, 10)]
+        progress.clear()
+        assert scan_notebook(index, lambda done, total: progress.append((done, total)), max_workers=2, batch_size=4)
+        assert progress[0] == (0, 6) and progress[-1] == (6, 6)
+        assert sorted(page["word_count"] for page in index.pages()) == list(range(10))
@@ -0,0 +1,42 @@
+import os
+
+from TokenCounter import EstimateTokenizer
+from ZimPageIndex import ZimPageIndex
+from ZimRetrieval import NotebookRetriever
+
+header = "Content-Type: text/x-zim-wiki\nWiki-Format: zim 0.6\nCreation-Date: 2024-01-01T00:00:00+00:00\n"
+
+def write_page(root, relative_path, body, mtime_ns=None):
+    path = os.path.join(root, relative_path)
+    with open(path, "w", encoding="utf-8") as file:
+        file.write(header + body)
+    if mtime_ns is not None:
+        os.utime(path, ns=(mtime_ns, mtime_ns))
+
+def found(retriever, query):
+    return [text for _, text in retriever.retrieve(query, EstimateTokenizer(), 1000)]
+
+def test_edits_to_pages_the_index_does_not_follow_are_picked_up(tmp_path):
+    root = str(tmp_path)
+    write_page(root, "Dragons.txt", "The red dragon sleeps.", 1_000_000_000)
+    write_page(root, "Tavern.txt", "The tavern sells ale.", 1_000_000_000)
+    relative_paths = ["Dragons.txt", "Tavern.txt"]
+    with ZimPageIndex(root) as index:
+        index.refresh()
+    retriever = NotebookRetriever(root)
+    retriever.refresh(relative_paths)
+    assert found(retriever, "ale") == ["The tavern sells ale."]
+
+    # Tavern isn't selected, so the watcher doesn't update its row in the page index.
+    write_page(root, "Tavern.txt", "The tavern sells mead.", 2_000_000_000)
+    assert retriever.refresh(relative_paths)
+    assert found(retriever, "mead") == ["The tavern sells mead."]
+    assert found(retriever, "ale") == []
+    assert not retriever.refresh(relative_paths)
+    retriever.close()
+
+    # And the saved index has the edit too
+    retriever = NotebookRetriever(root)
+    assert not retriever.refresh(relative_paths)
+    assert found(retriever, "mead") == ["The tavern sells mead."]
+    retriever.close()